@@ -0,0 +1,234 @@
+from collections import Counter
+import numpy as np
+from model import Horde
+from simulation import SimulationResult
+
+
+class BatchEncounter:
+    """
+    A vectorized engine that simulates many trials of an encounter at once.
+
+    Each actor's hp, mobility, distance, alive flag and multiattack uses are
+    kept as NumPy arrays with one slot per trial, and every attack in a round
+    is resolved as one draw over all the trials in which it happens. The rules
+    are those of Encounter.run and Attack.attack, with targets always chosen by
+    exact expected damage. Trials drop out of the batch once they are decided.
+
+    Attributes:
+        actors (list): The players followed by the monsters.
+        player_count (int): The number of players.
+    """
+
+    def __init__(self, encounter):
+        """
+        Initializes the engine.
+
+        Args:
+            encounter (Encounter): The encounter to simulate.
+
+        Raises:
+            ValueError: If the encounter has a Horde or an actor with a turn policy.
+        """
+        self.actors = encounter.players + encounter.monsters
+        for actor in self.actors:
+            if isinstance(actor, Horde):
+                raise ValueError(actor.name + " is a Horde and cannot be simulated in batch.")
+            if getattr(actor, "policy", None) is not None:
+                raise ValueError(actor.name + " has a turn policy and cannot be simulated in batch.")
+        self.player_count = len(encounter.players)
+        self.multiattacks = [actor.attacks for actor in self.actors]
+        self._distributions = {}
+        self._dice_groups = {}
+
+    def run(self, trials, seed=None, batch_size=100000):
+        """
+        Simulates the encounter.
+
+        Args:
+            trials (int): Number of trials to run.
+            seed (int): Seed for the NumPy random generator.
+            batch_size (int): Maximum number of trials held in memory at once.
+
+        Returns:
+            SimulationResult: The number of trials won by the players.
+        """
+        rng = np.random.default_rng(seed)
+        wins = 0
+        remaining = trials
+        while remaining > 0:
+            size = min(batch_size, remaining)
+            wins += self._run_batch(size, rng)
+            remaining -= size
+        return SimulationResult(wins, trials)
+
+    def _run_batch(self, trials, rng):
+        state = _BatchState(self, trials, rng)
+        actor_count = len(self.actors)
+        wins = 0
+        while state.trials > 0:
+            for slot in range(actor_count):
+                for actor_index in range(actor_count):
+                    acting = np.nonzero((state.order[slot] == actor_index) & state.alive[actor_index])[0]
+                    if acting.size:
+                        self._perform_turn(state, actor_index, acting, rng)
+
+            player_alive = state.alive[:self.player_count].any(axis=0)
+            monster_alive = state.alive[self.player_count:].any(axis=0)
+            wins += int(np.count_nonzero(player_alive & ~monster_alive))
+            state.keep(player_alive & monster_alive)
+        return wins
+
+    def _opponents(self, actor_index):
+        if actor_index < self.player_count:
+            return range(self.player_count, len(self.actors))
+        return range(self.player_count)
+
+    def _perform_turn(self, state, actor_index, acting, rng):
+        actor = self.actors[actor_index]
+        state.mobility[actor_index, acting] += actor.speed
+        attacked = np.zeros(acting.size, dtype=bool)
+        pending = np.ones(acting.size, dtype=bool)
+        for multiattack_index, multiattack in enumerate(self.multiattacks[actor_index]):
+            uses = state.uses[actor_index][multiattack_index]
+            performing = pending & (uses[acting] > 0)
+            if not performing.any():
+                continue
+            pending &= ~performing
+            trials = acting[performing]
+            can_attack = self._perform_multiattack(state, actor_index, multiattack, trials, rng)
+            uses[trials[can_attack]] -= 1
+            attacked[performing] = can_attack
+        # actors with no target dash
+        state.mobility[actor_index, acting[~attacked]] += actor.speed
+
+    def _perform_multiattack(self, state, actor_index, multiattack, trials, rng):
+        opponents = self._opponents(actor_index)
+        can_attack = np.zeros(trials.size, dtype=bool)
+        for attack in multiattack.attacks:
+            scores = np.zeros((len(opponents), trials.size))
+            multipliers = []
+            for position, target_index in enumerate(opponents):
+                range_multiplier = self._range_multipliers(state, attack, actor_index, target_index, trials)
+                multipliers.append(range_multiplier)
+                scores[position] = self._expected_damage(state, attack, target_index, range_multiplier, trials)
+            if not multipliers:
+                break
+            best = scores.argmax(axis=0)
+            has_target = scores[best, np.arange(trials.size)] > 0
+            can_attack |= has_target
+            for position, target_index in enumerate(opponents):
+                chosen = has_target & (best == position)
+                if chosen.any():
+                    self._attack(state, attack, target_index, trials[chosen],
+                            multipliers[position][chosen], rng)
+        return can_attack
+
+    def _range_multipliers(self, state, attack, actor_index, target_index, trials):
+        effective_distance = np.maximum(0, state.distance[target_index, trials] - state.mobility[actor_index, trials])
+        distances, inverse = np.unique(effective_distance, return_inverse=True)
+        multipliers = np.array([attack.attack_range(distance.item()) for distance in distances], dtype=float)
+        return multipliers[inverse]
+
+    def _expected_damage(self, state, attack, target_index, range_multiplier, trials):
+        scores = np.zeros(trials.size)
+        hp = state.hp[target_index, trials]
+        alive = state.alive[target_index, trials]
+        for multiplier in np.unique(range_multiplier):
+            if multiplier == 0:
+                continue
+            values, cumulative, cumulative_damage, lethal_value = self._distribution(attack, target_index, multiplier.item())
+            mask = (range_multiplier == multiplier) & alive
+            index = np.searchsorted(values, hp[mask], side="left")
+            scores[mask] = cumulative_damage[index] + (1 - cumulative[index])*lethal_value
+        return scores
+
+    def _distribution(self, attack, target_index, multiplier):
+        key = (id(attack), target_index, multiplier)
+        arrays = self._distributions.get(key)
+        if arrays is None:
+            distribution = attack.damage_distribution(self.actors[target_index], range_multiplier=multiplier)
+            cumulative = np.cumsum([0] + distribution.probabilities)
+            cumulative_damage = np.cumsum([0] + [value*p for value, p in zip(distribution.values, distribution.probabilities)])
+            lethal_value = sum(damage_dice.max() for damage_type, damage_dice in attack.damage_profile)
+            arrays = (np.array(distribution.values, dtype=float), cumulative, cumulative_damage, lethal_value)
+            self._distributions[key] = arrays
+        return arrays
+
+    def _roll(self, dice, size, rng):
+        key = tuple(dice)
+        groups = self._dice_groups.get(key)
+        if groups is None:
+            groups = sorted(Counter(dice).items())
+            self._dice_groups[key] = groups
+        total = np.zeros(size, dtype=np.int64)
+        for sides, count in groups:
+            total += rng.integers(1, sides + 1, size=(count, size)).sum(axis=0)
+        return total
+
+    def _attack(self, state, attack, target_index, trials, range_multiplier, rng):
+        target = self.actors[target_index]
+        size = trials.size
+        damage_multiplier = range_multiplier
+        critical = np.zeros(size, dtype=bool)
+        if attack.attack_roll is not None:
+            mode = attack._roll_mode(False, False)
+            natural = self._roll(attack.attack_roll.dice, size, rng)
+            if mode > 0:
+                natural = np.maximum(natural, self._roll(attack.attack_roll.dice, size, rng))
+            elif mode < 0:
+                natural = np.minimum(natural, self._roll(attack.attack_roll.dice, size, rng))
+            critical = natural == 20
+            hit = critical | (natural + attack.attack_roll.modifier >= target.ac)
+            damage_multiplier = np.where(hit, damage_multiplier, 0)
+        elif attack.save_dc is not None:
+            save = target.saves[attack.save_ability]
+            saved = attack.save_dc >= self._roll(save.dice, size, rng) + save.modifier
+            damage_multiplier = np.where(saved, damage_multiplier*0.5, damage_multiplier)
+
+        total = np.zeros(size)
+        for damage_type, damage_dice in attack.damage_profile:
+            unmodified_damage = self._roll(damage_dice.dice, size, rng) + damage_dice.modifier
+            if critical.any():
+                unmodified_damage = unmodified_damage + np.where(critical, self._roll(damage_dice.dice, size, rng), 0)
+            damage = unmodified_damage*damage_multiplier
+            damage = np.where(damage > 0, damage, 0)
+            if damage_type in target.resistances:
+                damage = np.floor(damage/2)
+            elif damage_type in target.vulnerabilities:
+                damage = np.floor(damage*2)
+            total += damage
+
+        hp = state.hp[target_index, trials] - total
+        dead = hp <= 0
+        state.hp[target_index, trials] = np.where(dead, 0, hp)
+        state.alive[target_index, trials] &= ~dead
+
+
+class _BatchState:
+    """
+    The mutable state of a batch of trials, one column per trial.
+    """
+
+    def __init__(self, engine, trials, rng):
+        actors = engine.actors
+        self.trials = trials
+        self.hp = np.repeat(np.array([[actor.hp_current] for actor in actors], dtype=float), trials, axis=1)
+        self.alive = np.repeat(np.array([[actor.alive] for actor in actors], dtype=bool), trials, axis=1)
+        self.mobility = np.repeat(np.array([[actor.mobility] for actor in actors], dtype=float), trials, axis=1)
+        self.distance = np.repeat(np.array([[actor.distance] for actor in actors], dtype=float), trials, axis=1)
+        self.uses = [[np.full(trials, float(uses)) for uses in actor.state.uses] for actor in actors]
+        initiative = rng.integers(1, 21, size=(len(actors), trials)) + np.array([[actor.initiative] for actor in actors])
+        # a stable sort keeps ties in list order, as Encounter.run does
+        self.order = np.argsort(-initiative, axis=0, kind="stable")
+
+    def keep(self, mask):
+        """
+        Drops the trials not selected by mask.
+        """
+        self.trials = int(np.count_nonzero(mask))
+        self.hp = self.hp[:, mask]
+        self.alive = self.alive[:, mask]
+        self.mobility = self.mobility[:, mask]
+        self.distance = self.distance[:, mask]
+        self.uses = [[uses[mask] for uses in actor_uses] for actor_uses in self.uses]
+        self.order = self.order[:, mask]
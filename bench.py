@@ -0,0 +1,297 @@
+"""
+Benchmarks for the hot paths of the simulator.
+
+Run all benchmarks and print the results as JSON:
+    python bench.py --output results.json
+
+Compare against an earlier run and fail on regressions:
+    python bench.py --baseline results.json --tolerance 0.25
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from statistics import median
+
+from model import *
+from simulation import *
+from main import ipqi_vs_rot_troll
+
+SEED = 1234
+
+
+def party_vs_horde(goblins=20):
+    """
+    Returns an encounter between a party of four and a horde of goblins.
+    """
+    fighter = Actor("Fighter",60,18)
+    greatsword = Attack("Greatsword", [("slashing", DiceRoll([6,6],4))], fighter,
+            attack_roll = 7, attack_range = 5)
+    fighter.attacks = [Multiattack("Extra Attack", [greatsword, greatsword])]
+
+    cleric = Actor("Cleric",45,18)
+    mace = Attack("Mace", [("bludgeoning", DiceRoll([6],3))], cleric,
+            attack_roll = 5, attack_range = 5)
+    cleric.attacks = [Multiattack("Mace", [mace])]
+
+    rogue = Actor("Rogue",40,15, distance=30)
+    shortbow = Attack("Shortbow", [("piercing", DiceRoll([6,6,6,6],4))], rogue,
+            attack_roll = 7, attack_range = 80)
+    rogue.attacks = [Multiattack("Sneak Attack", [shortbow])]
+
+    wizard = Actor("Wizard",30,12, distance=60)
+    fire_bolt = Attack("Fire Bolt", [("fire", DiceRoll([10,10],0))], wizard,
+            attack_roll = 7, attack_range = 120)
+    wizard.attacks = [Multiattack("Fire Bolt", [fire_bolt])]
+
+    horde = []
+    for index in range(goblins):
+        goblin = Actor("Goblin {}".format(index + 1),7,15, distance=30)
+        scimitar = Attack("Scimitar", [("slashing", DiceRoll([6],2))], goblin,
+                attack_roll = 4, attack_range = 5)
+        goblin.attacks = [Multiattack("Scimitar", [scimitar])]
+        horde.append(goblin)
+
+    return Encounter([fighter, cleric, rogue, wizard], horde)
+
+
+def party_vs_grouped_horde(goblins=100):
+    """
+    Returns an encounter between the party of party_vs_horde and a Horde of goblins.
+    """
+    encounter = party_vs_horde(goblins=1)
+    return Encounter(encounter.players, [Horde(encounter.monsters[0], goblins, "Goblin")])
+
+
+def spell_fight():
+    """
+    Returns an encounter between two spellcasters and three ogres, decided
+    mostly by saving throws.
+    """
+    sorcerer = Actor("Sorcerer",38,13, distance=60)
+    fireball = Attack("Fireball", [("fire", DiceRoll([6]*8,0))], sorcerer,
+            save_dc = 15, save_ability = "dexterity", attack_range = 150)
+    fire_bolt = Attack("Fire Bolt", [("fire", DiceRoll([10,10],0))], sorcerer,
+            attack_roll = 7, attack_range = 120)
+    sorcerer.attacks = [Multiattack("Fireball", [fireball], uses=3), Multiattack("Fire Bolt", [fire_bolt])]
+
+    cleric = Actor("Cleric",45,18, distance=30)
+    sacred_flame = Attack("Sacred Flame", [("radiant", DiceRoll([8,8],0))], cleric,
+            save_dc = 14, save_ability = "dexterity", attack_range = 60)
+    cleric.attacks = [Multiattack("Sacred Flame", [sacred_flame])]
+
+    ogre_saves = {ability: DiceRoll([20], -1) for ability in ABILITY_SCORES}
+    ogres = []
+    for index in range(3):
+        ogre = Actor("Ogre {}".format(index + 1),59,11, saves=ogre_saves)
+        greatclub = Attack("Greatclub", [("bludgeoning", DiceRoll([8,8],4))], ogre,
+                attack_roll = 6, attack_range = 5)
+        ogre.attacks = [Multiattack("Greatclub", [greatclub])]
+        ogres.append(ogre)
+
+    return Encounter([sorcerer, cleric], ogres)
+
+
+SCENARIOS = {
+    "ipqi_vs_rot_troll": ipqi_vs_rot_troll,
+    "party_vs_horde": party_vs_horde,
+    "party_vs_grouped_horde": party_vs_grouped_horde,
+    "spell_fight": spell_fight,
+}
+
+
+def _bench_dice_roll():
+    dice = DiceRoll([6,6,6],3)
+    def run(number):
+        for _ in range(number):
+            dice.roll()
+    return run
+
+
+def _bench_attack():
+    encounter = ipqi_vs_rot_troll()
+    target = encounter.players[0].copy()
+    target.hp_current = 10**9
+    target.distance = 0
+    bite = encounter.monsters[0].attacks[0].attacks[0]
+    def run(number):
+        for _ in range(number):
+            bite.attack(target)
+    return run
+
+
+def _bench_choose_target():
+    encounter = party_vs_horde()
+    fighter = encounter.players[0]
+    greatsword = fighter.attacks[0].attacks[0]
+    fighter.move(30)
+    def run(number):
+        for _ in range(number):
+            fighter.choose_target(encounter.monsters, greatsword)
+    return run
+
+
+def _bench_choose_target_indexed():
+    encounter = party_vs_horde()
+    fighter = encounter.players[0]
+    greatsword = fighter.attacks[0].attacks[0]
+    fighter.move(30)
+    index = TargetIndex(encounter.monsters)
+    def run(number):
+        for _ in range(number):
+            fighter.choose_target(index, greatsword)
+    return run
+
+
+def _bench_encounter_run(scenario):
+    def setup():
+        encounter = SCENARIOS[scenario]().copy()
+        actors = encounter.players + encounter.monsters
+        snapshots = [actor.snapshot() for actor in actors]
+        def run(number):
+            for _ in range(number):
+                for actor, snapshot in zip(actors, snapshots):
+                    actor.reset(snapshot)
+                encounter.run()
+        return run
+    return setup
+
+
+def _bench_monte_carlo(scenario):
+    def setup():
+        encounter = SCENARIOS[scenario]()
+        def run(number):
+            encounter.monte_carlo_simulation(iterations=number, seed=SEED, progress=False)
+        return run
+    return setup
+
+
+# name -> (setup function returning run(number), number of calls per repeat)
+BENCHMARKS = {
+    "dice_roll": (_bench_dice_roll, 100000),
+    "attack": (_bench_attack, 50000),
+    "choose_target": (_bench_choose_target, 5000),
+    "choose_target.indexed": (_bench_choose_target_indexed, 50000),
+}
+for _scenario in SCENARIOS:
+    BENCHMARKS["encounter_run." + _scenario] = (_bench_encounter_run(_scenario), 200)
+    BENCHMARKS["monte_carlo." + _scenario] = (_bench_monte_carlo(_scenario), 200)
+
+
+def measure(setup, number, repeat=5):
+    """
+    Times a benchmark after a warm-up run, reseeding the random module
+    before every repeat.
+
+    Returns:
+        dict: The number of calls, the best and median time per repeat in
+            seconds, and the best time per call in microseconds.
+    """
+    random.seed(SEED)
+    run = setup()
+    # warm up the distribution and plan caches
+    run(max(1, number//10))
+    times = []
+    for _ in range(repeat):
+        random.seed(SEED)
+        start = time.perf_counter()
+        run(number)
+        times.append(time.perf_counter() - start)
+    return {
+        "number": number,
+        "repeat": repeat,
+        "best": min(times),
+        "median": median(times),
+        "per_call_us": min(times)/number*1e6,
+    }
+
+
+def run_benchmarks(names=None, scale=1, repeat=5):
+    """
+    Runs benchmarks and returns their results in a JSON serializable dict.
+
+    Args:
+        names (list): The benchmarks to run, or None for all of them.
+        scale (float): Multiplies the number of calls of every benchmark.
+        repeat (int): Number of timed repeats of every benchmark.
+    """
+    results = {}
+    for name, (setup, number) in BENCHMARKS.items():
+        if names is not None and name not in names:
+            continue
+        results[name] = measure(setup, max(1, int(number*scale)), repeat)
+    return {
+        "seed": SEED,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compares results against a baseline by time per call.
+
+    Returns:
+        list: A (name, baseline us, current us, ratio, regressed) tuple for
+            every benchmark present in both.
+    """
+    rows = []
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        before = baseline["benchmarks"][name]["per_call_us"]
+        after = result["per_call_us"]
+        ratio = after/before if before else float("inf")
+        rows.append((name, before, after, ratio, ratio > 1 + tolerance))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulator.")
+    parser.add_argument("--output", help="write the results as JSON to this file instead of stdout")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+            help="allowed slowdown relative to the baseline, as a fraction (default 0.25)")
+    parser.add_argument("--benchmark", action="append", dest="names",
+            help="only run this benchmark (can be repeated)")
+    parser.add_argument("--quick", action="store_true", help="run a tenth of the calls, once")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+
+    if args.quick:
+        results = run_benchmarks(args.names, scale=0.1, repeat=1)
+    else:
+        results = run_benchmarks(args.names)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = 0
+        for name, before, after, ratio, regressed in compare(results, baseline, args.tolerance):
+            if regressed:
+                regressions += 1
+            print("{:<40} {:>12.2f}us {:>12.2f}us {:>7.2f}x{}".format(
+                    name, before, after, ratio, "  REGRESSION" if regressed else ""), file=sys.stderr)
+        if regressions:
+            print("{} benchmark(s) regressed by more than {:.0%}".format(regressions, args.tolerance),
+                    file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+A persistent cache of Monte Carlo results, keyed by encounter fingerprint.
+
+    with ResultCache("results.sqlite") as cache:
+        result = cache.simulate(encounter, iterations=10000, seed=1)
+
+A repeated query is answered from the cache, and a query for more iterations
+than are stored only runs the missing ones.
+"""
+import hashlib
+import json
+import sqlite3
+from model import Horde, RangeStep
+from simulation import SimulationResult, shard_seed
+
+# bump whenever a change to the rules would change the results of a simulation
+ENGINE_VERSION = 1
+
+
+def describe(encounter):
+    """
+    Returns a canonical, JSON serializable description of an encounter: its
+    actors, their current state and their attacks.
+
+    Raises:
+        ValueError: If an attack has a range function other than an integer
+            range, or an actor is a Horde.
+    """
+    return {
+        "players": [_describe_actor(player) for player in encounter.players],
+        "monsters": [_describe_actor(monster) for monster in encounter.monsters],
+    }
+
+
+def fingerprint(encounter, seed=None):
+    """
+    Returns a hex digest identifying the results of simulating an encounter
+    with a seed under the current engine version.
+    """
+    key = {"engine": ENGINE_VERSION, "seed": seed, "encounter": describe(encounter)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _describe_dice(dice_roll):
+    if dice_roll is None:
+        return None
+    return [sorted(dice_roll.dice), dice_roll.modifier]
+
+
+def _describe_attack(attack):
+    if not isinstance(attack.attack_range, RangeStep):
+        raise ValueError("Cannot fingerprint the range function of " + attack.name)
+    return {
+        "name": attack.name,
+        "damage": [[damage_type, _describe_dice(damage_dice)] for damage_type, damage_dice in attack.damage_profile],
+        "attack_roll": _describe_dice(attack.attack_roll),
+        "save_dc": attack.save_dc,
+        "save_ability": attack.save_ability,
+        "range": attack.attack_range.attack_range,
+        "advantage": attack.advantage_status,
+    }
+
+
+def _describe_actor(actor):
+    if isinstance(actor, Horde):
+        raise ValueError("Cannot fingerprint the Horde " + actor.name)
+    description = {
+        "name": actor.name,
+        "hp_max": actor.hp_max,
+        "hp_current": actor.hp_current,
+        "alive": actor.alive,
+        "ac": actor.ac,
+        "resistances": sorted(actor.resistances),
+        "vulnerabilities": sorted(actor.vulnerabilities),
+        "initiative": actor.initiative,
+        "distance": actor.distance,
+        "mobility": actor.mobility,
+        "speed": actor.speed,
+        "saves": {ability: _describe_dice(save) for ability, save in actor.saves.items()},
+        "targeting_simulations": actor.targeting_simulations,
+        "attacks": [{
+            "name": multiattack.name,
+            "uses": _describe_uses(uses),
+            "attacks": [_describe_attack(attack) for attack in multiattack.attacks],
+            } for multiattack, uses in zip(actor.attacks, actor.state.uses)],
+    }
+    # only actors with a policy describe it, so that the fingerprints of
+    # other encounters are unchanged
+    if getattr(actor, "policy", None) is not None:
+        description["policy"] = repr(actor.policy)
+    return description
+
+
+def _describe_uses(uses):
+    # JSON has no infinity
+    return None if uses == float("inf") else uses
+
+
+class ResultCache:
+    """
+    Monte Carlo results stored in an SQLite database, evicting the least
+    recently used results beyond a maximum number of entries.
+
+    Attributes:
+        path (str): The path of the database, or ":memory:".
+        max_entries (int): The maximum number of results kept.
+    """
+
+    def __init__(self, path="results.sqlite", max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                "fingerprint TEXT PRIMARY KEY, wins INTEGER, iterations INTEGER, last_used INTEGER)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def _next_use(self):
+        return self.connection.execute("SELECT COALESCE(MAX(last_used), 0) + 1 FROM results").fetchone()[0]
+
+    def get(self, key):
+        """
+        Returns the result stored under a fingerprint, or None, marking it
+        as recently used.
+        """
+        row = self.connection.execute("SELECT wins, iterations FROM results WHERE fingerprint = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE results SET last_used = ? WHERE fingerprint = ?", (self._next_use(), key))
+        self.connection.commit()
+        return SimulationResult(row[0], row[1])
+
+    def put(self, key, result):
+        """
+        Stores a result under a fingerprint, replacing any earlier one, and
+        evicts the least recently used results if the cache is full.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, result.wins, result.iterations, self._next_use()))
+        self.connection.execute("DELETE FROM results WHERE fingerprint NOT IN "
+                "(SELECT fingerprint FROM results ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute("DELETE FROM results")
+        self.connection.commit()
+
+    def simulate(self, encounter, iterations=100, workers=1, seed=None, progress=False):
+        """
+        Returns the result of a Monte Carlo simulation of the encounter with
+        at least the given number of iterations, simulating only the
+        iterations missing from the cache.
+
+        A stored result with more iterations than asked for is returned as
+        is. The iterations added to a stored result are seeded from the seed
+        and the number of iterations already stored, so a given sequence of
+        queries always gives the same results.
+
+        Args:
+            encounter (Encounter): The encounter to simulate.
+            iterations (int): The minimum number of iterations.
+            workers (int): Number of worker processes for missing iterations.
+            seed (int): Master seed, part of the fingerprint.
+            progress (bool): Whether to show a progress bar.
+
+        Returns:
+            SimulationResult: The cached or topped up result.
+        """
+        key = fingerprint(encounter, seed)
+        result = self.get(key) or SimulationResult()
+        if result.iterations >= iterations:
+            return result
+        run_seed = None if seed is None else shard_seed(seed, "cache" + str(result.iterations))
+        result = result.merge(encounter.monte_carlo_simulation(iterations - result.iterations, workers, run_seed,
+                progress=progress))
+        self.put(key, result)
+        return result
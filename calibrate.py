@@ -0,0 +1,181 @@
+"""
+Calibration of an encounter's difficulty: finding the value of a parameter
+that gives the players a target win rate.
+
+    calibrator = Calibrator(encounter, "Troll.count", range(1, 9))
+    calibration = calibrator.solve(target=0.6, seed=1)
+    print(calibration.value, calibration.low, calibration.high)
+
+Parameters are named as in sweep.py, such as "Troll.hp_max", "Troll.ac",
+"Troll.attack_bonus" or "Troll.count", and the win rate must rise or fall
+steadily with the parameter over the values searched.
+"""
+import random
+from simulation import SimulationResult, shard_seed
+from sweep import Sweep
+from tqdm import tqdm
+
+
+class Calibration:
+    """
+    The result of a calibration.
+
+    Attributes:
+        parameter (str): The parameter searched.
+        target (float): The target win rate.
+        value: The value whose win rate is closest to the target, among
+            those the search could not tell apart from it.
+        low: The value at or below value closest to it whose win rate was
+            found on its side of the target, or value if the search stopped
+            there. With the confidence of the search, the target is crossed
+            between low and high.
+        high: The same at or above value.
+        results (dict): Value -> SimulationResult of every value simulated.
+    """
+
+    def __init__(self, parameter, target, value, low, high, results):
+        self.parameter = parameter
+        self.target = target
+        self.value = value
+        self.low = low
+        self.high = high
+        self.results = results
+
+    def __repr__(self):
+        return "Calibration(parameter={}, target={}, value={}, low={}, high={})".format(
+                self.parameter, self.target, self.value, self.low, self.high)
+
+    @property
+    def iterations(self):
+        """
+        The total number of iterations simulated.
+        """
+        return sum(result.iterations for result in self.results.values())
+
+
+class Calibrator:
+    """
+    Searches the values of a parameter of an encounter for a target win rate
+    by noisy bisection.
+
+    Every value probed is simulated in batches only until its Wilson interval
+    excludes the target, which takes few trials far from the target and more
+    near it. The results of every value are kept, so solving again, for
+    another target or with a larger budget, only tops them up.
+
+    Attributes:
+        sweep (Sweep): The sweep that builds the variants of the encounter.
+        parameter (str): The parameter searched.
+        values (list): The values searched, in increasing order.
+        confidence (float): The confidence level of the intervals.
+        results (dict): Value -> SimulationResult of every value simulated.
+    """
+
+    def __init__(self, encounter, parameter, values, confidence=0.95):
+        """
+        Initializes the calibrator.
+
+        Args:
+            encounter (Encounter): The base encounter.
+            parameter (str): The parameter to search, "<actor name>.<attribute>".
+            values (iterable): The values to search.
+            confidence (float): The confidence level of the intervals.
+
+        Raises:
+            ValueError: If the parameter is unknown or there are no values.
+        """
+        self.values = sorted(values)
+        if not self.values:
+            raise ValueError("There are no values to search.")
+        self.sweep = Sweep(encounter, {parameter: self.values})
+        self.parameter = parameter
+        self.confidence = confidence
+        self.results = {}
+
+    def solve(self, target=0.5, batch_size=200, max_iterations=10000, workers=1, seed=None, progress=False):
+        """
+        Finds the value of the parameter whose win rate is closest to the target.
+
+        Args:
+            target (float): The target win rate of the players.
+            batch_size (int): Number of iterations added to a value at a time.
+            max_iterations (int): The most iterations simulated for one
+                value. A value still undecided at this budget is as close
+                to the target as the budget can tell.
+            workers (int): Number of worker processes per batch.
+            seed (int): Master seed. Each value and batch seeds its own
+                substream from it, so results are reproducible and can be
+                topped up. If None, the run is not reproducible.
+            progress (bool): Whether to show a progress bar over the probes.
+
+        Returns:
+            Calibration: The value found and the values bracketing the target.
+
+        Raises:
+            ValueError: If the target is not crossed over the values searched.
+        """
+        if seed is None:
+            seed = random.getrandbits(64)
+        bar = tqdm(disable=not progress)
+
+        def probe(index):
+            bar.update()
+            return self._probe(index, target, batch_size, max_iterations, workers, seed)
+
+        try:
+            low = 0
+            high = len(self.values) - 1
+            low_side = probe(low)
+            if low_side == 0 or high == low:
+                return self._calibration(target, low, low, low)
+            high_side = probe(high)
+            if high_side == 0:
+                return self._calibration(target, high, high, high)
+            if low_side == high_side:
+                raise ValueError("The win rate is {} the target {} over every value of {}: {:.3f} to {:.3f}".format(
+                        "above" if low_side > 0 else "below", target, self.parameter,
+                        self.results[self.values[low]].win_rate, self.results[self.values[high]].win_rate))
+
+            while high - low > 1:
+                middle = (low + high)//2
+                side = probe(middle)
+                if side == 0:
+                    return self._calibration(target, middle, low, high)
+                if side == low_side:
+                    low = middle
+                else:
+                    high = middle
+        finally:
+            bar.close()
+        closest = min((low, high), key=lambda index: abs(self.results[self.values[index]].win_rate - target))
+        return self._calibration(target, closest, low, high)
+
+    def _probe(self, index, target, batch_size, max_iterations, workers, seed):
+        """
+        Simulates a value until its win rate is significantly above or below
+        the target, or until max_iterations.
+
+        Returns:
+            int: 1 if the win rate is above the target, -1 if below, 0 if undecided.
+        """
+        value = self.values[index]
+        result = self.results.get(value, SimulationResult(confidence=self.confidence))
+        encounter = None
+        while True:
+            low, high = result.confidence_interval(self.confidence)
+            if low > target:
+                return 1
+            if high < target:
+                return -1
+            if result.iterations >= max_iterations:
+                return 0
+            if encounter is None:
+                encounter = self.sweep.variant({self.parameter: value})
+            batch_seed = shard_seed(shard_seed(seed, "value" + str(value)), result.iterations)
+            result = result.merge(encounter.monte_carlo_simulation(min(batch_size, max_iterations - result.iterations),
+                    workers, batch_seed, progress=False))
+            self.results[value] = result
+
+    def _calibration(self, target, index, low, high):
+        return Calibration(self.parameter, target, self.values[index], self.values[low], self.values[high],
+                dict(self.results))
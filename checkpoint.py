@@ -0,0 +1,163 @@
+"""
+Checkpoints of long Monte Carlo runs.
+
+    result = encounter.monte_carlo_simulation(iterations=10**7, workers=8, seed=1,
+            checkpoint="run.json", checkpoint_every=300)
+
+saves the accumulated counters, and histograms if stats=True, to run.json
+every five minutes and at the end. Running the same call again resumes from
+the file. Batches are seeded from the master seed and their number (see
+Encounter.iter_monte_carlo), so the seed and the number of batches done are
+all the random state a checkpoint needs. A resumed run keeps the batch size of
+the checkpoint, whatever batch_size it is called with, and gives exactly the
+result of an uninterrupted one with the same workers.
+"""
+import json
+import os
+from array import array
+from cache import ENGINE_VERSION, fingerprint
+from simulation import SimulationResult
+from stats import Histogram, OutcomeStats
+
+
+class Checkpoint:
+    """
+    The state of a checkpointed Monte Carlo run.
+
+    Attributes:
+        fingerprint (str): The fingerprint of the encounter, see cache.py.
+        seed (int): The master seed of the run.
+        batch_size (int): Number of iterations per batch.
+        batches (int): Number of batches done.
+        result (SimulationResult): The merged result of those batches.
+    """
+
+    def __init__(self, fingerprint, seed, batch_size, batches, result):
+        self.fingerprint = fingerprint
+        self.seed = seed
+        self.batch_size = batch_size
+        self.batches = batches
+        self.result = result
+
+    def __repr__(self):
+        return "Checkpoint(seed={}, batches={}, iterations={})".format(
+                self.seed, self.batches, self.result.iterations)
+
+    @classmethod
+    def start(cls, encounter, seed, batch_size, result):
+        """
+        Returns the checkpoint of a run of an encounter that has not run any batch.
+        """
+        return cls(fingerprint(encounter), seed, batch_size, 0, result)
+
+    def check(self, encounter, seed=None, stats=False):
+        """
+        Checks that a run can resume from this checkpoint.
+
+        Raises:
+            ValueError: If the checkpoint is of another encounter or engine
+                version, was written with another seed, or lacks the
+                statistics asked for or has statistics that were not, which
+                would leave them describing only some of the trials.
+        """
+        if self.fingerprint != fingerprint(encounter):
+            raise ValueError("The checkpoint is of another encounter or engine version.")
+        if seed is not None and seed != self.seed:
+            raise ValueError("The checkpoint was written with seed {}.".format(self.seed))
+        if stats and self.result.stats is None:
+            raise ValueError("The checkpoint has no outcome statistics.")
+        if not stats and self.result.stats is not None:
+            raise ValueError("The checkpoint has outcome statistics; resume it with stats=True.")
+
+    def save(self, path):
+        """
+        Writes the checkpoint to a file, replacing it atomically so that a
+        run killed while saving leaves the previous checkpoint intact.
+        """
+        data = {
+            "engine": ENGINE_VERSION,
+            "fingerprint": self.fingerprint,
+            "seed": self.seed,
+            "batch_size": self.batch_size,
+            "batches": self.batches,
+            "wins": self.result.wins,
+            "iterations": self.result.iterations,
+            "stats": None if self.result.stats is None else _stats_to_json(self.result.stats),
+        }
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(data, file)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a checkpoint from a file.
+        """
+        with open(path) as file:
+            data = json.load(file)
+        stats = None if data["stats"] is None else _stats_from_json(data["stats"])
+        return cls(data["fingerprint"], data["seed"], data["batch_size"], data["batches"],
+                SimulationResult(data["wins"], data["iterations"], stats=stats))
+
+
+def merge(checkpoints):
+    """
+    Returns the merged result of checkpoints of separate runs of the same
+    encounter, such as runs with different seeds on different machines.
+
+    Args:
+        checkpoints (list): Checkpoints, or paths of checkpoint files.
+
+    Returns:
+        SimulationResult: The merged result.
+
+    Raises:
+        ValueError: If the checkpoints are of different encounters, or two of
+            them share a seed, which would count the same trials twice.
+    """
+    checkpoints = [Checkpoint.load(checkpoint) if isinstance(checkpoint, str) else checkpoint
+            for checkpoint in checkpoints]
+    if len(set(checkpoint.fingerprint for checkpoint in checkpoints)) > 1:
+        raise ValueError("The checkpoints are of different encounters.")
+    if len(set(checkpoint.seed for checkpoint in checkpoints)) < len(checkpoints):
+        raise ValueError("The checkpoints share a seed and would count the same trials twice.")
+    result = SimulationResult()
+    for checkpoint in checkpoints:
+        result = result.merge(checkpoint.result)
+    return result
+
+
+def _histogram_to_json(histogram):
+    return {"low": histogram.low, "high": histogram.high, "counts": list(histogram.counts),
+            "total": histogram.total, "sum": histogram.sum}
+
+
+def _histogram_from_json(data):
+    histogram = Histogram(data["low"], data["high"])
+    histogram.counts = array("q", data["counts"])
+    histogram.total = data["total"]
+    histogram.sum = data["sum"]
+    return histogram
+
+
+def _stats_to_json(stats):
+    return {
+        "trials": stats.trials,
+        "wins": stats.wins,
+        "rounds": _histogram_to_json(stats.rounds),
+        "hp": {name: _histogram_to_json(histogram) for name, histogram in stats.hp.items()},
+        "deaths": stats.deaths,
+        "damage": {key: _histogram_to_json(histogram) for key, histogram in stats.damage.items()},
+    }
+
+
+def _stats_from_json(data):
+    stats = OutcomeStats(max_rounds=data["rounds"]["high"])
+    stats.trials = data["trials"]
+    stats.wins = data["wins"]
+    stats.rounds = _histogram_from_json(data["rounds"])
+    stats.hp = {name: _histogram_from_json(histogram) for name, histogram in data["hp"].items()}
+    stats.deaths = dict(data["deaths"])
+    stats.damage = {key: _histogram_from_json(histogram) for key, histogram in data["damage"].items()}
+    return stats
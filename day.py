@@ -0,0 +1,190 @@
+"""
+Adventuring days: a party fighting several encounters in a row, with its hp
+and multiattack uses carried from one fight into the next.
+
+    day = AdventuringDay(party, [goblins, ogre, dragon])
+    result = day.run(trials=10000, seed=1)
+    print(result.survival)
+
+The day is simulated one fight at a time over a weighted population of party
+states. Identical states, or states in the same hp bins, are merged, and each
+fight runs a fixed number of trials spread over the states by weight, so the
+cost of a day grows linearly with its number of fights instead of nesting one
+Monte Carlo loop per fight.
+"""
+import math
+import random
+from model import Horde
+from simulation import Encounter, shard_seed
+from tqdm import tqdm
+
+
+class DayResult:
+    """
+    The outcome of an adventuring day.
+
+    Attributes:
+        names (list): The names of the players.
+        survival (list): The probability that the party is still standing
+            after each fight.
+        states (dict): The state of the party at the end of the day ->
+            probability, over the days it survived. A state is a tuple of
+            (hp, uses) per player.
+        trials (int): The number of fights simulated.
+    """
+
+    def __init__(self, names, survival, states, trials):
+        self.names = names
+        self.survival = survival
+        self.states = states
+        self.trials = trials
+
+    def __repr__(self):
+        return "DayResult(survival={}, trials={})".format(self.survival, self.trials)
+
+    def wipe_probabilities(self):
+        """
+        Returns the probability that the party falls in each fight.
+        """
+        previous = 1
+        wipes = []
+        for survival in self.survival:
+            wipes.append(previous - survival)
+            previous = survival
+        return wipes
+
+    def death_probabilities(self):
+        """
+        Returns player name -> probability that the player is dead at the
+        end of the day, counting the days the party fell.
+        """
+        return {name: 1 - sum(p for state, p in self.states.items() if state[index][0] > 0)
+                for index, name in enumerate(self.names)}
+
+    def expected_hp(self):
+        """
+        Returns player name -> expected hp at the end of the days the party survived.
+        """
+        surviving = sum(self.states.values())
+        if surviving == 0:
+            return {name: 0 for name in self.names}
+        return {name: sum(state[index][0]*p for state, p in self.states.items())/surviving
+                for index, name in enumerate(self.names)}
+
+
+class AdventuringDay:
+    """
+    A party and the encounters it fights in order.
+
+    Attributes:
+        players (list): The party, in its state at the start of the day.
+        fights (list): The monsters of each encounter, in order.
+        hp_bin (int): States whose hp round to the same multiple of hp_bin
+            are merged. 1 only merges identical states.
+    """
+
+    def __init__(self, players, fights, hp_bin=1):
+        """
+        Initializes the day.
+
+        Args:
+            players (list): The party.
+            fights (list): The monsters of each encounter, as lists of
+                actors or Encounters whose monsters are used.
+            hp_bin (int): The width of the hp bins of merged states.
+
+        Raises:
+            ValueError: If a player or a monster is a Horde.
+        """
+        self.players = players
+        self.fights = [fight.monsters if isinstance(fight, Encounter) else fight for fight in fights]
+        self.hp_bin = hp_bin
+        for actor in self.players + [monster for monsters in self.fights for monster in monsters]:
+            if isinstance(actor, Horde):
+                raise ValueError(actor.name + " is a Horde, whose state is not carried between fights.")
+
+    def run(self, trials=1000, seed=None, progress=True):
+        """
+        Simulates the day.
+
+        Every fight runs trials trials, allocated to the party states that
+        reached it in proportion to their probability; each trial carries an
+        equal share of the probability of reaching the fight into the state
+        the party ends it in. Wiped out parties leave the population.
+
+        Args:
+            trials (int): Number of trials per fight.
+            seed (int): Master seed. If None, the run is not reproducible.
+            progress (bool): Whether to show a progress bar.
+
+        Returns:
+            DayResult: The outcome of the day.
+        """
+        if seed is None:
+            seed = random.getrandbits(64)
+        players = [player.copy() for player in self.players]
+        fresh = [player.snapshot() for player in players]
+        states = {self._state(players): 1.0}
+        survival = []
+        simulated = 0
+        for index, monsters in enumerate(tqdm(self.fights, disable=not progress)):
+            rng = random.Random(shard_seed(seed, "allocation" + str(index)))
+            random.seed(shard_seed(seed, "fight" + str(index)))
+            monsters = [monster.copy() for monster in monsters]
+            monster_snapshots = [monster.snapshot() for monster in monsters]
+            encounter = Encounter(players, monsters)
+            next_states = {}
+            for state, (count, weight) in _allocate(states, trials, rng).items():
+                for _ in range(count):
+                    for player, snapshot, (hp, uses) in zip(players, fresh, state):
+                        player_state = snapshot.copy()
+                        player_state.hp_current = hp
+                        player_state.alive = hp > 0
+                        player_state.uses = list(uses)
+                        player.reset(player_state)
+                    for monster, snapshot in zip(monsters, monster_snapshots):
+                        monster.reset(snapshot)
+                    simulated += 1
+                    if encounter.run():
+                        key = self._state(players)
+                        next_states[key] = next_states.get(key, 0) + weight
+            states = next_states
+            survival.append(sum(states.values()))
+        return DayResult([player.name for player in players], survival, states, simulated)
+
+    def _state(self, players):
+        """
+        Returns the binned state of the party.
+        """
+        state = []
+        for player in players:
+            hp = player.hp_current if player.alive else 0
+            if hp > 0 and self.hp_bin > 1:
+                hp = min(max(1, round(hp/self.hp_bin)*self.hp_bin), player.hp_max)
+            state.append((hp, tuple(player.state.uses)))
+        return tuple(state)
+
+
+def _allocate(states, trials, rng):
+    """
+    Spreads trials over weighted states in proportion to their weights, by
+    systematic sampling: every state gets its expected number of trials
+    rounded up or down at random, and every trial carries the same weight,
+    so the expected weight carried from each state is its own.
+
+    Returns:
+        dict: state -> (number of trials, weight carried by each trial).
+    """
+    total = sum(states.values())
+    if total == 0:
+        return {}
+    allocation = {}
+    position = rng.random()
+    cumulative = 0
+    for state, weight in states.items():
+        start = cumulative
+        cumulative += weight/total*trials
+        count = math.ceil(cumulative - position) - math.ceil(start - position)
+        if count > 0:
+            allocation[state] = (count, total/trials)
+    return allocation
@@ -0,0 +1,155 @@
+"""
+Structured events emitted while an encounter runs.
+
+Each event is a dict with an "event" key naming its kind:
+    trial: trial
+    initiative: actor, initiative
+    move: actor, mobility, dash
+    attack_roll: actor, target, attack, roll, result (critical, hit, miss)
+    save_roll: actor, target, attack, roll, dc, result (save, fail)
+    out_of_range: actor, target, attack
+    damage: actor, target, attack, damage_type, damage, hp
+    horde_attack: actor, target, attack, attacks, damage, hp
+    death: actor
+    round_end: round, hp (a dict of actor name -> hp)
+    end: round, players_win
+
+Emitters check sink.enabled before building an event, so nothing is
+formatted or allocated when the sink is the NULL_SINK.
+"""
+import json
+from collections import deque
+
+
+class NullSink:
+    """
+    A sink that discards every event.
+    """
+    enabled = False
+
+    def emit(self, event):
+        pass
+
+
+NULL_SINK = NullSink()
+
+
+class RingBufferSink:
+    """
+    A sink that keeps the most recent events in memory.
+
+    Attributes:
+        capacity (int): The maximum number of events kept, or None for all.
+    """
+    enabled = True
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.buffer = deque(maxlen=capacity)
+
+    def emit(self, event):
+        self.buffer.append(event)
+
+    def events(self):
+        """
+        Returns the buffered events, oldest first.
+        """
+        return list(self.buffer)
+
+    def clear(self):
+        self.buffer.clear()
+
+
+class JsonlSink:
+    """
+    A sink that writes one JSON object per event to a file.
+
+    Attributes:
+        path (str): The path of the file.
+    """
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def emit(self, event):
+        self.file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class PrintSink:
+    """
+    A sink that prints a human readable line per event.
+    """
+    enabled = True
+
+    def emit(self, event):
+        print(format_event(event))
+
+
+def format_event(event):
+    """
+    Returns a human readable description of an event.
+    """
+    kind = event["event"]
+    if kind == "trial":
+        return "===== TRIAL {} =====".format(event["trial"])
+    elif kind == "initiative":
+        return "{} rolls {} for initiative".format(event["actor"], event["initiative"])
+    elif kind == "move":
+        if event["dash"]:
+            return "{} has no targets, dashing (mobility {})".format(event["actor"], event["mobility"])
+        return "{} moves (mobility {})".format(event["actor"], event["mobility"])
+    elif kind == "attack_roll":
+        return "{} attacks {} with {}: rolls {}, {}".format(
+                event["actor"], event["target"], event["attack"], event["roll"], event["result"])
+    elif kind == "save_roll":
+        return "{} targets {} with {}: rolls {} against DC {}, {}".format(
+                event["actor"], event["target"], event["attack"], event["roll"], event["dc"], event["result"])
+    elif kind == "out_of_range":
+        return "{} attacks {} with {}: out of range".format(event["actor"], event["target"], event["attack"])
+    elif kind == "damage":
+        return "{} takes {} {} damage ({} hp left)".format(
+                event["target"], event["damage"], event["damage_type"], event["hp"])
+    elif kind == "horde_attack":
+        return "{} attack {} {} times with {}: {} damage ({} hp left)".format(
+                event["actor"], event["target"], event["attacks"], event["attack"], event["damage"], event["hp"])
+    elif kind == "death":
+        return "{} dies".format(event["actor"])
+    elif kind == "round_end":
+        return "----- END OF ROUND {} ----- ".format(event["round"]) + ", ".join(
+                "{}: {}".format(name, hp) for name, hp in event["hp"].items())
+    elif kind == "end":
+        return "{} lose after {} rounds".format("Monsters" if event["players_win"] else "Players", event["round"])
+    return json.dumps(event)
+
+
+def replay(events, output=print):
+    """
+    Replays a sequence of events in human readable form.
+
+    Args:
+        events (iterable): The events to replay.
+        output (function): Called with each formatted line.
+    """
+    for event in events:
+        output(format_event(event))
+
+
+def read_jsonl(path):
+    """
+    Yields the events stored in a JSONL file.
+    """
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
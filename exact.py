@@ -0,0 +1,415 @@
+from itertools import permutations
+from model import DiceRoll, Horde, _convolve
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def initiative_orders(actors):
+    """
+    Returns every possible initiative order of the actors with its exact
+    probability. Ties keep list order, as in Encounter.run.
+
+    Args:
+        actors (list): The actors, in the order they are listed in the encounter.
+
+    Returns:
+        list: (order, probability) pairs, where order is a tuple of indices
+            into actors, highest initiative first.
+    """
+    distributions = [DiceRoll([20], actor.initiative).distribution() for actor in actors]
+    orders = []
+    for order in permutations(range(len(actors))):
+        # probability that each actor of the order rolled each value, given
+        # that the actors before it are sorted before it
+        mass = dict(distributions[order[0]])
+        for previous, index in zip(order, order[1:]):
+            # an actor listed before the previous one must roll strictly lower to go after it
+            strict = previous > index
+            next_mass = {}
+            for value, p in distributions[index].items():
+                total = sum(q for before, q in mass.items() if before > value or (not strict and before == value))
+                if total:
+                    next_mass[value] = p*total
+            mass = next_mass
+        probability = sum(mass.values())
+        if probability > 0:
+            orders.append((order, probability))
+    return orders
+
+
+class ExactSolution:
+    """
+    The exact outcome distribution of an encounter.
+
+    Attributes:
+        win_probability (float): The probability that the players win.
+        loss_probability (float): The probability that the players lose.
+        unresolved (float): The probability mass dropped by truncation or
+            still undecided after the last round solved.
+        rounds (dict): Number of rounds -> probability that the fight ends
+            after exactly that many rounds.
+    """
+
+    def __init__(self, win_probability, loss_probability, unresolved, rounds):
+        self.win_probability = win_probability
+        self.loss_probability = loss_probability
+        self.unresolved = unresolved
+        self.rounds = rounds
+
+    def __repr__(self):
+        return "ExactSolution(win_probability={}, loss_probability={}, unresolved={})".format(
+                self.win_probability, self.loss_probability, self.unresolved)
+
+    def mean_rounds(self):
+        """
+        Returns the expected number of rounds of the fights that were decided.
+        """
+        decided = sum(self.rounds.values())
+        if decided == 0:
+            return 0
+        return sum(rounds*p for rounds, p in self.rounds.items())/decided
+
+
+class ExactSolver:
+    """
+    Solves an encounter exactly by propagating probability mass over its
+    states turn by turn, in every initiative order.
+
+    A state holds the hp, mobility and multiattack uses of every actor;
+    distances never change during an encounter. Targets are chosen by the
+    actors' own choose_target, and every attack branches over its exact
+    damage distribution, so the rules are those of Encounter.run.
+
+    States are flat tuples of an index into the interned mobilities and uses
+    of all actors, followed by the hp of each actor, which keeps them cheap
+    to hash. Once a single opponent is left standing, the states that only
+    differ in its hp take the damage of a multiattack as one convolution,
+    with NumPy if it is installed.
+
+    The number of states grows with the product of the actors' hp and the
+    number of initiative orders with the factorial of the number of actors,
+    so this is for duels and small skirmishes: with NumPy, two actors with
+    tens of hp take a few tenths of a second and Ipqi against the Rot-Troll
+    about a second, several times that without NumPy. Larger encounters
+    should be simulated.
+
+    Attributes:
+        actors (list): Copies of the players followed by the monsters.
+        player_count (int): The number of players.
+    """
+
+    def __init__(self, encounter):
+        """
+        Initializes the solver.
+
+        Args:
+            encounter (Encounter): The encounter to solve.
+
+        Raises:
+            ValueError: If an actor chooses its targets by simulation, has
+                a turn policy or is a Horde.
+        """
+        encounter = encounter.copy()
+        self.actors = encounter.players + encounter.monsters
+        self.player_count = len(encounter.players)
+        for actor in self.actors:
+            if isinstance(actor, Horde):
+                raise ValueError(actor.name + " is a Horde and cannot be solved exactly.")
+            if actor.targeting_simulations is not None:
+                raise ValueError(actor.name + " chooses targets by simulation and cannot be solved exactly.")
+            if getattr(actor, "policy", None) is not None:
+                raise ValueError(actor.name + " has a turn policy and cannot be solved exactly.")
+        # past the distance of the farthest opponent more mobility changes
+        # nothing, so it is capped there to keep the number of states small
+        self._mobility_caps = [max([self.actors[opponent].distance for opponent in self._opponents(index)] + [0])
+                for index in range(len(self.actors))]
+        self._positions = []
+        self._position_ids = {}
+        self._moves = {}
+        self._targets = {}
+        self._outcome_cache = {}
+        self._multiattack_damage = {}
+
+    def solve(self, epsilon=1e-12, max_rounds=100):
+        """
+        Solves the encounter.
+
+        Args:
+            epsilon (float): States whose probability falls below epsilon
+                after a turn are dropped, and counted as unresolved. 0 keeps
+                every state.
+            max_rounds (int): The number of rounds after which the remaining
+                mass is counted as unresolved.
+
+        Returns:
+            ExactSolution: The outcome distribution.
+        """
+        position = tuple((min(actor.mobility, cap), tuple(actor.state.uses))
+                for actor, cap in zip(self.actors, self._mobility_caps))
+        start = (self._intern(position),) + tuple(actor.hp_current if actor.alive else 0 for actor in self.actors)
+        players = range(1, self.player_count + 1)
+        monsters = range(self.player_count + 1, len(self.actors) + 1)
+        win = 0
+        loss = 0
+        unresolved = 0
+        rounds = {}
+        for order, probability in initiative_orders(self.actors):
+            states = {start: probability}
+            round_number = 1
+            while states and round_number <= max_rounds:
+                for index in order:
+                    states = self._turn(index, states)
+                    if epsilon:
+                        kept = {}
+                        for state, mass in states.items():
+                            if mass < epsilon:
+                                unresolved += mass
+                            else:
+                                kept[state] = mass
+                        states = kept
+
+                remaining = {}
+                decided = 0
+                for state, mass in states.items():
+                    player_alive = any(state[i] > 0 for i in players)
+                    monster_alive = any(state[i] > 0 for i in monsters)
+                    if player_alive and monster_alive:
+                        remaining[state] = mass
+                        continue
+                    if player_alive:
+                        win += mass
+                    else:
+                        loss += mass
+                    decided += mass
+                if decided:
+                    rounds[round_number] = rounds.get(round_number, 0) + decided
+                states = remaining
+                round_number += 1
+            unresolved += sum(states.values())
+        return ExactSolution(win, loss, unresolved, dict(sorted(rounds.items())))
+
+    def _intern(self, position):
+        """
+        Returns the index of the mobilities and uses of all actors.
+        """
+        position_id = self._position_ids.get(position)
+        if position_id is None:
+            position_id = len(self._positions)
+            self._positions.append(position)
+            self._position_ids[position] = position_id
+        return position_id
+
+    def _move(self, index, position_id):
+        """
+        Returns the multiattack an actor uses on its turn, after moving, and
+        the indices of the positions after the turn if it attacked and if it
+        dashed instead.
+        """
+        key = (index, position_id)
+        move = self._moves.get(key)
+        if move is None:
+            actor = self.actors[index]
+            cap = self._mobility_caps[index]
+            position = self._positions[position_id]
+            mobility, uses = position[index]
+            mobility = min(mobility + actor.speed, cap)
+            choice = None
+            for i, remaining_uses in enumerate(uses):
+                if remaining_uses > 0:
+                    choice = i
+                    break
+            moved = _replace(position, index, (mobility, uses))
+            dashed = _replace(position, index, (min(mobility + actor.speed, cap), uses))
+            attacked = dashed
+            if choice is not None:
+                attacked = _replace(position, index,
+                        (mobility, uses[:choice] + (uses[choice] - 1,) + uses[choice + 1:]))
+            move = (choice, self._intern(moved), self._intern(attacked), self._intern(dashed))
+            self._moves[key] = move
+        return move
+
+    def _turn(self, index, states):
+        """
+        Returns the distribution of states after the turn of an actor.
+        """
+        actor = self.actors[index]
+        slot = index + 1
+        opponents = [opponent + 1 for opponent in self._opponents(index)]
+        result = {}
+        # states that only differ in the hp of the last opponent standing,
+        # whose damage is spread over all of them at once
+        groups = {}
+        for state, mass in states.items():
+            if state[slot] <= 0:
+                result[state] = result.get(state, 0) + mass
+                continue
+            choice, moved, attacked_position, dashed_position = self._move(index, state[0])
+            if choice is None:
+                key = (dashed_position,) + state[1:]
+                result[key] = result.get(key, 0) + mass
+                continue
+
+            state = (moved,) + state[1:]
+            living = [opponent for opponent in opponents if state[opponent] > 0]
+            if len(living) == 1:
+                # with a single opponent left every attack goes to it, so the
+                # multiattack is one draw from the sum of the attacks' damage
+                target = living[0]
+                damage = self._multiattack_distribution(index, choice, target - 1, state)
+                if damage is None:
+                    key = (dashed_position,) + state[1:]
+                    result[key] = result.get(key, 0) + mass
+                    continue
+                before = (attacked_position,) + state[1:target]
+                after = state[target + 1:]
+                if damage[1] is not None and type(state[target]) is int:
+                    group = groups.get((before, after))
+                    if group is None:
+                        group = groups[(before, after)] = (damage[1], {})
+                    masses = group[1]
+                    masses[state[target]] = masses.get(state[target], 0) + mass
+                    continue
+                outcome_key = (index, choice, target, self._positions[moved][index][0], state[target])
+                outcomes = self._outcome_cache.get(outcome_key)
+                if outcomes is None:
+                    outcomes = self._outcome_cache[outcome_key] = _hp_outcomes(state[target], damage[0])
+                for target_hp, p in outcomes:
+                    key = before + (target_hp,) + after
+                    result[key] = result.get(key, 0) + mass*p
+                continue
+
+            branches = {(state, False): mass}
+            for plan in actor.attacks[choice].plan().plans:
+                next_branches = {}
+                for (branch, attacked), branch_mass in branches.items():
+                    target = self._choose_target(index, plan.attack, branch)
+                    if target is None:
+                        key = (branch, attacked)
+                        next_branches[key] = next_branches.get(key, 0) + branch_mass
+                        continue
+                    for target_hp, p in self._outcomes(index, plan.attack, target, branch):
+                        key = (_replace(branch, target + 1, target_hp), True)
+                        next_branches[key] = next_branches.get(key, 0) + branch_mass*p
+                branches = next_branches
+
+            for (branch, attacked), branch_mass in branches.items():
+                # actors that could not attack dash
+                key = (attacked_position if attacked else dashed_position,) + branch[1:]
+                result[key] = result.get(key, 0) + branch_mass
+
+        for (before, after), (kernel, masses) in groups.items():
+            hps = np.zeros(max(masses) + 1)
+            for hp, mass in masses.items():
+                hps[hp] = mass
+            # spread[i] is the mass left with i - shift hp
+            spread = np.convolve(hps, kernel[::-1]).tolist()
+            shift = len(kernel) - 1
+            lethal = sum(spread[:shift + 1])
+            if lethal > 0:
+                key = before + (0,) + after
+                result[key] = result.get(key, 0) + lethal
+            for hp in range(1, len(spread) - shift):
+                mass = spread[shift + hp]
+                if mass > 0:
+                    key = before + (hp,) + after
+                    result[key] = result.get(key, 0) + mass
+        return result
+
+    def _opponents(self, index):
+        if index < self.player_count:
+            return range(self.player_count, len(self.actors))
+        return range(self.player_count)
+
+    def _load(self, state):
+        """
+        Puts the actors in a state, so that their own targeting and damage
+        methods can be used.
+        """
+        for actor, hp, (mobility, _) in zip(self.actors, state[1:], self._positions[state[0]]):
+            actor.hp_current = hp
+            actor.alive = hp > 0
+            actor.mobility = mobility
+
+    def _choose_target(self, index, attack, state):
+        opponents = self._opponents(index)
+        mobility = self._positions[state[0]][index][0]
+        key = (index, id(attack), mobility, tuple(state[opponent + 1] for opponent in opponents))
+        if key in self._targets:
+            return self._targets[key]
+        self._load(state)
+        actor = self.actors[index]
+        target = actor.choose_target([self.actors[opponent] for opponent in opponents], attack)
+        target_index = None
+        if target is not None:
+            target_index = self.actors.index(target)
+        self._targets[key] = target_index
+        return target_index
+
+    def _outcomes(self, index, attack, target, state):
+        """
+        Returns the distribution of the target's hp after an attack as
+        (hp, probability) pairs.
+        """
+        hp = state[target + 1]
+        key = (index, id(attack), target, self._positions[state[0]][index][0], hp)
+        outcomes = self._outcome_cache.get(key)
+        if outcomes is None:
+            self._load(state)
+            distribution = attack.damage_distribution(self.actors[target], attacker=self.actors[index])
+            outcomes = _hp_outcomes(hp, zip(distribution.values, distribution.probabilities))
+            self._outcome_cache[key] = outcomes
+        return outcomes
+
+    def _multiattack_distribution(self, index, choice, target, state):
+        """
+        Returns the distribution of the total damage of the attacks of a
+        multiattack that can reach the target, as a list of (damage,
+        probability) pairs and, if NumPy is installed and the damage is
+        whole, an array of the probability of each damage, or None if no
+        attack can reach it.
+        """
+        mobility = self._positions[state[0]][index][0]
+        key = (index, choice, target, mobility)
+        if key in self._multiattack_damage:
+            return self._multiattack_damage[key]
+        self._load(state)
+        total = None
+        for plan in self.actors[index].attacks[choice].plan().plans:
+            if self._choose_target(index, plan.attack, state) != target:
+                continue
+            distribution = plan.attack.damage_distribution(self.actors[target], attacker=self.actors[index])
+            pmf = dict(zip(distribution.values, distribution.probabilities))
+            total = pmf if total is None else _convolve(total, pmf)
+        damage = None
+        if total is not None:
+            items = [(value, p) for value, p in sorted(total.items()) if p > 0]
+            kernel = None
+            if np is not None and all(value >= 0 and float(value).is_integer() for value, _ in items):
+                kernel = np.zeros(int(items[-1][0]) + 1)
+                for value, p in items:
+                    kernel[int(value)] += p
+            damage = (items, kernel)
+        self._multiattack_damage[key] = damage
+        return damage
+
+
+def _hp_outcomes(hp, damage_distribution):
+    """
+    Returns the distribution of hp left after taking damage, as (hp,
+    probability) pairs, with every lethal outcome at 0.
+    """
+    outcomes = {}
+    for damage, p in damage_distribution:
+        if p == 0:
+            continue
+        remaining = hp - damage
+        if remaining <= 0:
+            remaining = 0
+        outcomes[remaining] = outcomes.get(remaining, 0) + p
+    return list(outcomes.items())
+
+
+def _replace(values, index, value):
+    return values[:index] + (value,) + values[index + 1:]
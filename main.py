@@ -1,8 +1,13 @@
+import argparse
+import sys
 from model import *
 from simulation import *
 
 
-def main():
+def ipqi_vs_rot_troll():
+    """
+    Returns the encounter between Ipqi and the Rot-Troll.
+    """
     ipqi = Actor("Ipqi-Ishtar Ei-amen-nef-neb-oui",103,18, distance=60)
     ipqi_longbow = Attack("Longbow",
             [
@@ -45,18 +50,50 @@ def main():
             )
     rot_troll.attacks = [rot_troll_multi_attack]
 
-    encounter = Encounter([ipqi], [rot_troll])
-    result = encounter.monte_carlo_simulation(iterations=100)
-    print("Ipqi wins {} percent of the time".format(result*100))
-    
+    return Encounter([ipqi], [rot_troll])
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate Dungeons and Dragons encounters.")
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser("batch", help="run every encounter of some stat-block files")
+    batch.add_argument("files", nargs="+", help="stat-block JSON files, see statblock.py")
+    batch.add_argument("--output", help="append the results as JSON lines to this file instead of stdout")
+    batch.add_argument("--workers", type=int, default=None, help="number of worker processes (default one per core)")
+    batch.add_argument("--iterations", type=int, default=1000,
+            help="iterations per encounter, unless the encounter sets its own (default 1000)")
+    batch.add_argument("--seed", type=int, default=0, help="master seed (default 0)")
+    serve = subparsers.add_parser("serve", help="run the local simulation service, see service.py")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8765, help="port to listen on (default 8765)")
+    serve.add_argument("--workers", type=int, default=None, help="number of worker processes (default one per core)")
+    serve.add_argument("--chunk-size", type=int, default=1000,
+            help="iterations per chunk, the longest an interactive query waits behind (default 1000)")
+    args = parser.parse_args(argv)
 
-    
+    if args.command == "batch":
+        from statblock import run_batch
+        if args.output:
+            with open(args.output, "a") as output:
+                run_batch(args.files, output, args.workers, args.iterations, args.seed)
+        else:
+            run_batch(args.files, sys.stdout, args.workers, args.iterations, args.seed)
+        return 0
 
+    if args.command == "serve":
+        import asyncio
+        from service import run_server
+        try:
+            asyncio.run(run_server(args.host, args.port, args.workers, args.chunk_size))
+        except KeyboardInterrupt:
+            pass
+        return 0
 
-    
+    encounter = ipqi_vs_rot_troll()
+    result = encounter.monte_carlo_simulation(iterations=100)
+    print("Ipqi wins {} percent of the time".format(result.win_rate*100))
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
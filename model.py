@@ -1,6 +1,15 @@
 import random
 import math
-from copy import deepcopy
+from bisect import bisect_left, bisect_right, insort
+from operator import add
+from time import perf_counter
+import profiling
+from events import NULL_SINK
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DAMAGE_TYPES = [
     "acid",
@@ -21,6 +30,19 @@ DAMAGE_TYPES = [
     "thunder"
 ]
 
+_random = random.random
+
+# the number of times attacks were compiled, which tells multiattack plans
+# that an attack they hold may have been recompiled
+_compilations = 0
+
+# the DiceTilt the attacks roll their dice from, see DiceTilt; None rolls fair dice
+dice_tilt = None
+
+# whether actors record the damage of their attacks into their histograms; turned off
+# while a policy looks ahead, see policy.py
+recording = True
+
 ABILITY_SCORES = [
     "strength",
     "dexterity",
@@ -122,7 +144,12 @@ class DiceRoll:
         """
         Rolls the dice and returns the result.
         """
-        return sum(random.randint(1, die) for die in self.dice) + self.modifier
+        total = self.modifier
+        for die in self.dice:
+            total += int(_random()*die) + 1
+        if profiling.active is not None:
+            profiling.active.dice_rolled += len(self.dice)
+        return total
 
     def average(self):
         """
@@ -141,21 +168,362 @@ class DiceRoll:
         """
         return len(self.dice) + self.modifier
 
-    def probability_above(self, value, simulations=10000):
+    def distribution(self):
+        """
+        Returns the exact probability mass function of the roll as a dict of
+        value -> probability, in ascending order of value.
+        """
+        dist = _dice_distribution(self.dice, self.modifier)
+        return {dist.low + i: count/dist.total for i, count in enumerate(dist.counts)}
+
+    def probability_above(self, value):
         """
         Returns the probability of rolling a value or higher.
         """
-        if value > self.max():
+        dist = _dice_distribution(self.dice, self.modifier)
+        if value > dist.high:
             return 0
-        elif value <= self.min():
+        elif value <= dist.low:
             return 1
-        return sum(1 for _ in range(simulations) if self.roll() >= value)/simulations
+        return dist.tail[value - dist.low]/dist.total
 
-    def probability_below(self, value, simulations=10000):
+    def probability_below(self, value):
         """
         Returns the probability of rolling a value or lower.
         """
-        return 1 - self.probability_above(value+1, simulations)
+        return 1 - self.probability_above(value+1)
+
+    def percentile(self, percent):
+        """
+        Returns the smallest value that is rolled at or below with at least
+        the given probability.
+
+        Args:
+            percent (float): The percentile, between 0 and 100.
+        """
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be between 0 and 100.")
+        dist = _dice_distribution(self.dice, self.modifier)
+        # compare integer counts so that exact percentiles land on the right value
+        threshold = percent * dist.total / 100
+        cumulative = 0
+        for i, count in enumerate(dist.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return dist.low + i
+        return dist.high
+
+    def variance(self):
+        """
+        Returns the variance of the dice roll.
+        """
+        return sum((die*die - 1)/12 for die in self.dice)
+
+    def std_dev(self):
+        """
+        Returns the standard deviation of the dice roll.
+        """
+        return math.sqrt(self.variance())
+
+    def roll_many(self, n, rng=None):
+        """
+        Rolls the dice n times with bulk draws.
+
+        Args:
+            n (int): The number of rolls.
+            rng (numpy.random.Generator): The generator to draw from. If None,
+                one is seeded from the random module.
+
+        Returns:
+            The rolls, as a NumPy array if NumPy is installed, otherwise a list.
+        """
+        if np is not None and rng is None:
+            rng = default_generator()
+        if profiling.active is not None:
+            profiling.active.dice_rolled += len(self.dice)*n
+        rolls = _roll_groups_many(group_dice(self.dice), n, rng)
+        if np is not None:
+            return rolls + self.modifier
+        return [roll + self.modifier for roll in rolls]
+
+
+class _Distribution:
+    """
+    The exact distribution of a dice roll, stored as integer counts of the
+    ways to roll each total so that probabilities are exact ratios.
+
+    Attributes:
+        low (int): The minimum possible roll.
+        high (int): The maximum possible roll.
+        counts (list): counts[i] is the number of ways to roll low + i.
+        tail (list): tail[i] is the number of ways to roll low + i or higher.
+        total (int): The total number of equally likely outcomes.
+    """
+    def __init__(self, dice, modifier):
+        counts = [1]
+        for die in dice:
+            # convolve with a uniform die using a sliding window over prefix sums
+            prefix = [0]
+            for count in counts:
+                prefix.append(prefix[-1] + count)
+            size = len(counts) + die - 1
+            counts = [prefix[min(j + 1, len(counts))] - prefix[max(0, j - die + 1)]
+                    for j in range(size)]
+        self.low = len(dice) + modifier
+        self.high = self.low + len(counts) - 1
+        self.counts = counts
+        self.tail = counts[:]
+        for i in range(len(counts) - 2, -1, -1):
+            self.tail[i] += self.tail[i + 1]
+        self.total = self.tail[0]
+
+
+def group_dice(dice):
+    """
+    Groups a list of dice into a tuple of (sides, count) pairs.
+    """
+    counts = {}
+    for die in dice:
+        counts[die] = counts.get(die, 0) + 1
+    return tuple(sorted(counts.items()))
+
+
+def _roll_groups(groups):
+    """
+    Rolls grouped dice, as returned by group_dice, and returns the total.
+    """
+    total = 0
+    for sides, count in groups:
+        for _ in range(count):
+            total += int(_random()*sides) + 1
+    return total
+
+
+class DiceTilt:
+    """
+    Exponentially tilted dice for importance sampling. While a DiceTilt is
+    set as model.dice_tilt, every die of an attack rolls k with probability
+    proportional to exp(theta*k) if the attacker is favoured, or exp(-theta*k)
+    otherwise, and the log of the likelihood ratio of the fair dice to the
+    tilted dice is accumulated, so that weighting a trial by
+    exp(log_weight) makes its expectation that of fair dice.
+
+    Higher rolls are always better for the attacker, saving throws included,
+    so one theta biases the whole fight towards the favoured side.
+    Initiative and the simulations of choose_target roll fair dice.
+
+    Attributes:
+        theta (float): The tilt of the dice of the favoured attackers.
+        favoured (set): The ids of the favoured attackers.
+        log_weight (float): The log likelihood ratio of the dice rolled since
+            the last reset.
+    """
+    __slots__ = ("theta", "favoured", "log_weight", "_tables")
+
+    def __init__(self, theta, favoured=()):
+        self.theta = theta
+        self.favoured = set(id(actor) for actor in favoured)
+        self.log_weight = 0
+        self._tables = {}
+
+    def __repr__(self):
+        return "DiceTilt(theta={}, log_weight={})".format(self.theta, self.log_weight)
+
+    def reset(self):
+        self.log_weight = 0
+
+    def _table(self, sides, theta):
+        """
+        Returns the cumulative tilted probabilities of the faces of a die,
+        the log likelihood ratio of rolling k plus tilt*k, and the tilt of
+        the die, theta/sides.
+        """
+        key = (sides, theta)
+        table = self._tables.get(key)
+        if table is None:
+            tilt = theta/sides
+            # shifted by the largest face so that large tilts do not overflow
+            weights = [math.exp(tilt*(face - sides)) for face in range(1, sides + 1)]
+            total = sum(weights)
+            cumulative = []
+            running = 0
+            for weight in weights[:-1]:
+                running += weight/total
+                cumulative.append(running)
+            table = (cumulative, math.log(total) + tilt*sides - math.log(sides), tilt)
+            self._tables[key] = table
+        return table
+
+    def roll_groups(self, groups, attacker):
+        """
+        Rolls grouped dice, as returned by group_dice, for an attacker and
+        returns the total.
+        """
+        theta = self.theta if id(attacker) in self.favoured else -self.theta
+        total = 0
+        for sides, count in groups:
+            cumulative, log_ratio, tilt = self._table(sides, theta)
+            rolled = 0
+            for _ in range(count):
+                rolled += bisect_right(cumulative, _random()) + 1
+            self.log_weight += count*log_ratio - tilt*rolled
+            total += rolled
+        return total
+
+
+def default_generator():
+    """
+    Returns a NumPy generator seeded from the random module, so that seeding
+    the random module also makes bulk draws reproducible.
+    """
+    return np.random.default_rng(random.getrandbits(64))
+
+
+def _roll_groups_many(groups, n, rng=None):
+    """
+    Rolls grouped dice n times and returns the totals. With NumPy the dice are
+    drawn with one Generator.integers call per group, otherwise with one
+    random.choices call per group.
+    """
+    if np is not None:
+        total = np.zeros(n, dtype=np.int64)
+        for sides, count in groups:
+            total += rng.integers(1, sides + 1, size=(count, n)).sum(axis=0)
+        return total
+    total = [0]*n
+    for sides, count in groups:
+        draws = random.choices(range(1, sides + 1), k=count*n)
+        if count > 1:
+            draws = list(map(sum, zip(*[iter(draws)]*count)))
+        total = list(map(add, total, draws))
+    return total
+
+
+_DISTRIBUTION_CACHE = {}
+
+def _dice_distribution(dice, modifier):
+    """
+    Returns the cached _Distribution for a multiset of dice and a modifier.
+    """
+    key = (tuple(sorted(dice)), modifier)
+    dist = _DISTRIBUTION_CACHE.get(key)
+    if dist is None:
+        dist = _Distribution(key[0], modifier)
+        _DISTRIBUTION_CACHE[key] = dist
+    return dist
+
+
+_TO_HIT_CACHE = {}
+
+def _to_hit_probabilities(attack_roll, ac, mode):
+    """
+    Returns the cached (critical, hit) probabilities of an attack roll against
+    an armor class, where mode is 1 for advantage, -1 for disadvantage and 0
+    for a straight roll.
+    """
+    key = (tuple(sorted(attack_roll.dice)), attack_roll.modifier, ac, mode)
+    cached = _TO_HIT_CACHE.get(key)
+    if cached is not None:
+        return cached
+    dist = _dice_distribution(attack_roll.dice, attack_roll.modifier)
+    critical = 0
+    hit = 0
+    below = 0
+    for i, count in enumerate(dist.counts):
+        value = dist.low + i
+        p_below = below/dist.total
+        p_at_or_below = (below + count)/dist.total
+        if mode > 0:
+            # the higher of two rolls
+            p = p_at_or_below**2 - p_below**2
+        elif mode < 0:
+            # the lower of two rolls
+            p = (1 - p_below)**2 - (1 - p_at_or_below)**2
+        else:
+            p = count/dist.total
+        below += count
+        if value - attack_roll.modifier == 20:
+            critical += p
+        elif value >= ac:
+            hit += p
+    _TO_HIT_CACHE[key] = (critical, hit)
+    return critical, hit
+
+
+class DamageDistribution:
+    """
+    The exact distribution of the damage an attack deals to a target.
+
+    Attributes:
+        values (list): The possible damage totals, in ascending order.
+        probabilities (list): The probability of each damage total.
+    """
+    def __init__(self, pmf):
+        self.values = sorted(pmf)
+        self.probabilities = [pmf[value] for value in self.values]
+        # prefix sums let expected() cap lethal damage with a single bisection
+        self._cumulative = [0]
+        self._cumulative_damage = [0]
+        for value, p in zip(self.values, self.probabilities):
+            self._cumulative.append(self._cumulative[-1] + p)
+            self._cumulative_damage.append(self._cumulative_damage[-1] + value*p)
+
+    def mean(self):
+        """
+        Returns the uncapped expected damage.
+        """
+        return self._cumulative_damage[-1]
+
+    def probability_lethal(self, hp):
+        """
+        Returns the probability of dealing at least hp damage.
+        """
+        return 1 - self._cumulative[bisect_left(self.values, hp)]
+
+    def expected(self, hp, lethal_value=None):
+        """
+        Returns the expected damage against a target with the given hp.
+
+        Args:
+            hp (int): The current hp of the target.
+            lethal_value (float): The value counted for a lethal hit. If None,
+                lethal damage is capped at hp.
+        """
+        index = bisect_left(self.values, hp)
+        if lethal_value is None:
+            lethal_value = hp
+        return self._cumulative_damage[index] + (1 - self._cumulative[index])*lethal_value
+
+
+def _convolve(first, second):
+    """
+    Returns the distribution of the sum of two independent distributions,
+    each given as a dict of value -> probability.
+    """
+    output = {}
+    for a, p in first.items():
+        for b, q in second.items():
+            output[a + b] = output.get(a + b, 0) + p*q
+    return output
+
+
+class RangeStep:
+    """
+    A step function for attack ranges: full effectiveness up to the range,
+    none beyond it. Unlike a lambda it can be pickled into worker processes.
+
+    Attributes:
+        attack_range (int): The range of the attack.
+    """
+    def __init__(self, attack_range):
+        self.attack_range = attack_range
+
+    def __call__(self, distance):
+        return 1 if distance <= self.attack_range else 0
+
+    def __repr__(self):
+        return "RangeStep(" + str(self.attack_range) + ")"
+
 
 class Attack:
     """
@@ -173,6 +541,9 @@ class Attack:
         attack_range (function): A function that returns the effectiveness of the attack based on the distance between the encounter and the target.
         advantage (int): positive for advantage, negative for disadvantage, 0 for no advantage.
         additional_effects (list): A list of functions that are called when the attack hits.
+
+    An attack is compiled into an AttackPlan the first time it is used; call
+    compile() again after changing it, which the multiattacks using it notice.
     """
 
     def __init__(self, name, damage_profile, actor, attack_roll=None,
@@ -193,7 +564,7 @@ class Attack:
         self.save_dc = save_dc
         if isinstance(attack_range, int):
             # if attack_range is passed as an integer, turn it into a step function
-            self.attack_range = lambda x: 1 if x <= attack_range else 0
+            self.attack_range = RangeStep(attack_range)
         elif callable(attack_range):
             self.attack_range = attack_range
         else:
@@ -202,8 +573,9 @@ class Attack:
         self.save_ability = save_ability
         self.additional_effects = additional_effects
         self.advantage_status = advantage
+        self._damage_cache = {}
+        self._plan = None
 
-        
 
     def __str__(self):
         return self.name + ": " + str(self.damage_profile)
@@ -212,84 +584,456 @@ class Attack:
         return self.name + ": " + str(self.damage_profile)
 
 
-    def attack(self, target, log=True, advantage=False, disadvantage=False):
+    def compile(self):
+        """
+        Compiles the attack into an AttackPlan, replacing any earlier plan.
+        """
+        global _compilations
+        _compilations += 1
+        self._plan = AttackPlan(self)
+        self._damage_cache = {}
+        return self._plan
+
+    def plan(self):
+        """
+        Returns the compiled AttackPlan of the attack.
+        """
+        if self._plan is None:
+            return self.compile()
+        return self._plan
+
+    def attack(self, target, sink=NULL_SINK, advantage=False, disadvantage=False, attacker=None):
         """
         Performs the attack.
 
         Args:
             target (Character): The target of the attack.
-            log (bool): Whether or not to print the attack.
+            sink: The sink that receives the events of the attack.
+            attacker (Actor): The actor making the attack, if not self.actor.
+
+        Returns:
+            float: The damage taken by the target.
+        """
+        if attacker is None:
+            attacker = self.actor
+        return self.plan().execute(target, attacker, sink, advantage, disadvantage)
+
+    def attack_many(self, target, n, attacker=None, rng=None):
         """
-        log_string = self.actor.name + " attacks " + target.name + " with " + self.name + ":\n"
+        Performs the attack n times against the target's current state, with
+        bulk draws, without changing the target.
 
-        effective_distance = max(0, target.distance - self.actor.mobility)
-        if log:
-            log_string += "Effective distance: " + str(effective_distance) + "\n"
+        Args:
+            target (Actor): The target of the attack.
+            n (int): The number of attacks.
+            attacker (Actor): The actor making the attack, if not self.actor.
+            rng (numpy.random.Generator): The generator to draw from. If None,
+                one is seeded from the random module.
+
+        Returns:
+            The damage of each attack after resistances and vulnerabilities,
+            as a NumPy array if NumPy is installed, otherwise a list.
+        """
+        if attacker is None:
+            attacker = self.actor
+        plan = self.plan()
+        if profiling.active is not None:
+            profiling.active.attacks += n
+        effective_distance = max(0, target.distance - attacker.mobility)
         range_multiplier = self.attack_range(effective_distance)
-        damage_multiplier = range_multiplier
+        profile = plan.target_profile(target)
+        if np is None:
+            return self._attack_many_lists(plan, target, n, range_multiplier, profile)
+        if rng is None:
+            rng = default_generator()
+
+        if range_multiplier == 0:
+            return np.zeros(n)
+        damage_multiplier = np.full(n, float(range_multiplier))
+        critical = np.zeros(n, dtype=bool)
+        if plan.attack_groups is not None:
+            natural = _roll_groups_many(plan.attack_groups, n, rng)
+            if plan.mode > 0:
+                natural = np.maximum(natural, _roll_groups_many(plan.attack_groups, n, rng))
+            elif plan.mode < 0:
+                natural = np.minimum(natural, _roll_groups_many(plan.attack_groups, n, rng))
+            critical = natural == 20
+            hit = critical | (natural + plan.attack_modifier >= target.ac)
+            damage_multiplier[~hit] = 0
+        elif plan.save_dc is not None:
+            save = target.saves[plan.save_ability]
+            saved = plan.save_dc >= save.roll_many(n, rng)
+            damage_multiplier[saved] *= 0.5
+
+        total = np.zeros(n)
+        for index, groups in enumerate(plan.damage_groups):
+            unmodified_damage = _roll_groups_many(groups, n, rng) + plan.damage_modifiers[index]
+            if critical.any():
+                unmodified_damage += np.where(critical, _roll_groups_many(groups, n, rng), 0)
+            damage = unmodified_damage*damage_multiplier
+            damage[damage < 0] = 0
+            if profile[index] == 1:
+                damage = np.floor(damage/2)
+            elif profile[index] == 2:
+                damage = np.floor(damage*2)
+            total += damage
+        return total
+
+    def _attack_many_lists(self, plan, target, n, range_multiplier, profile):
+        if range_multiplier == 0:
+            return [0]*n
+        damage_multipliers = [range_multiplier]*n
+        critical = [False]*n
+        if plan.attack_groups is not None:
+            natural = _roll_groups_many(plan.attack_groups, n)
+            if plan.mode > 0:
+                natural = list(map(max, natural, _roll_groups_many(plan.attack_groups, n)))
+            elif plan.mode < 0:
+                natural = list(map(min, natural, _roll_groups_many(plan.attack_groups, n)))
+            critical = [roll == 20 for roll in natural]
+            damage_multipliers = [range_multiplier if roll == 20 or roll + plan.attack_modifier >= target.ac else 0
+                    for roll in natural]
+        elif plan.save_dc is not None:
+            saves = target.saves[plan.save_ability].roll_many(n)
+            damage_multipliers = [range_multiplier*0.5 if plan.save_dc >= save else range_multiplier
+                    for save in saves]
+
+        total = [0]*n
+        for index, groups in enumerate(plan.damage_groups):
+            unmodified_damage = _roll_groups_many(groups, n)
+            if any(critical):
+                extra = _roll_groups_many(groups, n)
+                unmodified_damage = [damage + extra[i] if critical[i] else damage
+                        for i, damage in enumerate(unmodified_damage)]
+            modifier = plan.damage_modifiers[index]
+            for i in range(n):
+                damage = (unmodified_damage[i] + modifier)*damage_multipliers[i]
+                if damage > 0:
+                    if profile[index] == 1:
+                        damage = math.floor(damage/2)
+                    elif profile[index] == 2:
+                        damage = math.floor(damage*2)
+                    total[i] += damage
+        return total
+
+    def average_damage(self, target, simulations=100, maximise_lethal_damage=True, attacker=None):
+        """
+        Returns the average damage of the attack, estimated by simulating it
+        against the target and restoring the target's state after every
+        simulation. See expected_damage for the exact value.
+        """
+        global dice_tilt
+        snapshot = target.snapshot()
+        if profiling.active is not None:
+            profiling.active.average_damage_simulations += simulations
+        damage_total = 0
+        # the simulated attacks do not happen, so they roll fair dice and do
+        # not count towards the weight of an importance sampled trial
+        tilt = dice_tilt
+        dice_tilt = None
+        try:
+            for _ in range(simulations):
+                target.reset(snapshot)
+                damage = self.attack(target, attacker=attacker)
+                if target.hp_current == 0 and maximise_lethal_damage:
+                    damage_total += sum(damage_dice.max() for damage_type, damage_dice in self.damage_profile)
+                else:
+                    damage_total += damage
+        finally:
+            dice_tilt = tilt
+        target.reset(snapshot)
+
+        return damage_total/simulations
+
+    def to_hit_probabilities(self, ac, advantage=False, disadvantage=False):
+        """
+        Returns the probabilities of a critical hit and of a normal hit.
+
+        Args:
+            ac (int): The armor class of the target.
+
+        Returns:
+            tuple: (critical hit probability, normal hit probability)
+        """
+        if self.attack_roll is None:
+            raise ValueError(self.name + " does not make an attack roll.")
+        return _to_hit_probabilities(self.attack_roll, ac, self._roll_mode(advantage, disadvantage))
+
+    def damage_distribution(self, target, advantage=False, disadvantage=False, range_multiplier=None,
+            attacker=None):
+        """
+        Returns the exact DamageDistribution of the attack against the target
+        at its current distance, including the chance to miss or be saved against.
+
+        Args:
+            range_multiplier (float): The effectiveness of the attack at the
+                target's distance. If None, it is worked out from attack_range.
+            attacker (Actor): The actor making the attack, if not self.actor.
+        """
+        if range_multiplier is None:
+            if attacker is None:
+                attacker = self.actor
+            effective_distance = max(0, target.distance - attacker.mobility)
+            range_multiplier = self.attack_range(effective_distance)
+        mode = self._roll_mode(advantage, disadvantage)
+        save_roll = None
+        if self.attack_roll is None and self.save_dc is not None:
+            save = target.saves[self.save_ability]
+            save_roll = (tuple(sorted(save.dice)), save.modifier)
+        key = (range_multiplier, mode, target.ac, save_roll, self.plan().target_profile(target))
+        distribution = self._damage_cache.get(key)
+        if distribution is not None:
+            return distribution
+
+        if range_multiplier == 0:
+            outcomes = []
+        elif self.attack_roll is not None:
+            critical, hit = _to_hit_probabilities(self.attack_roll, target.ac, mode)
+            outcomes = [(critical, range_multiplier, True), (hit, range_multiplier, False)]
+        elif self.save_dc is not None:
+            p_save = target.saves[self.save_ability].probability_below(self.save_dc)
+            outcomes = [(p_save, range_multiplier*0.5, False), (1 - p_save, range_multiplier, False)]
+        else:
+            outcomes = [(1, range_multiplier, False)]
+
+        pmf = {0: 1 - sum(p for p, _, _ in outcomes)}
+        for p, multiplier, critical in outcomes:
+            if p == 0:
+                continue
+            total = {0: p}
+            for damage_type, damage_dice in self.damage_profile:
+                dice = damage_dice.dice*2 if critical else damage_dice.dice
+                component = {}
+                for value, q in DiceRoll(dice, damage_dice.modifier).distribution().items():
+                    damage = target.damage_taken(value*multiplier, damage_type) if value*multiplier > 0 else 0
+                    component[damage] = component.get(damage, 0) + q
+                total = _convolve(total, component)
+            for value, q in total.items():
+                pmf[value] = pmf.get(value, 0) + q
+
+        distribution = DamageDistribution(pmf)
+        self._damage_cache[key] = distribution
+        return distribution
+
+    def expected_damage(self, target, maximise_lethal_damage=True, advantage=False, disadvantage=False,
+            attacker=None):
+        """
+        Returns the exact expected damage of the attack against the target.
+
+        Args:
+            target (Actor): The target of the attack.
+            maximise_lethal_damage (bool): If True a lethal hit is valued at the
+                maximum damage of the attack, otherwise at the target's hp.
+        """
+        if not target.alive:
+            return 0
+        distribution = self.damage_distribution(target, advantage, disadvantage, attacker=attacker)
+        lethal_value = None
+        if maximise_lethal_damage:
+            lethal_value = self.plan().lethal_value
+        return distribution.expected(target.hp_current, lethal_value)
+
+    def _roll_mode(self, advantage, disadvantage):
         if self.advantage_status > 0:
             advantage = True
         elif self.advantage_status < 0:
             disadvantage = True
-        critical_hit = False
-        damage = 0
+        if advantage and not disadvantage:
+            return 1
+        elif disadvantage and not advantage:
+            return -1
+        return 0
+
+class AttackPlan:
+    """
+    A flat, precomputed form of an Attack, executed on every swing instead of
+    walking the attack's object model.
+
+    Attributes:
+        attack (Attack): The compiled attack.
+        attack_groups (tuple): The attack roll dice as (sides, count) pairs, or None.
+        attack_modifier (int): The modifier of the attack roll.
+        mode (int): 1 for advantage, -1 for disadvantage, 0 for a straight roll.
+        range_limit (int): The range of a step attack_range, or None if the
+            attack's range function must be called.
+        damage_types (tuple): The index in DAMAGE_TYPES of each damage component.
+        damage_groups (tuple): The grouped dice of each damage component.
+        critical_groups (tuple): The grouped dice of each component on a critical hit.
+        damage_modifiers (tuple): The modifier of each damage component.
+        lethal_value (int): The maximum damage of the attack, the value of a lethal hit in targeting.
+    """
+    __slots__ = ("attack", "attack_groups", "attack_modifier", "mode", "save_dc",
+            "save_ability", "range_limit", "attack_range", "damage_types",
+            "damage_groups", "critical_groups", "damage_modifiers", "lethal_value",
+            "attack_dice", "damage_dice", "critical_dice", "_target_profiles")
+
+    def __init__(self, attack):
+        self.attack = attack
+        if attack.attack_roll is not None:
+            self.attack_groups = group_dice(attack.attack_roll.dice)
+            self.attack_modifier = attack.attack_roll.modifier
+        else:
+            self.attack_groups = None
+            self.attack_modifier = 0
+        self.mode = attack._roll_mode(False, False)
+        self.save_dc = attack.save_dc
+        self.save_ability = attack.save_ability
+        if isinstance(attack.attack_range, RangeStep):
+            self.range_limit = attack.attack_range.attack_range
+        else:
+            self.range_limit = None
+        self.attack_range = attack.attack_range
+        self.damage_types = tuple(DAMAGE_TYPES.index(damage_type) for damage_type, _ in attack.damage_profile)
+        self.damage_groups = tuple(group_dice(damage_dice.dice) for _, damage_dice in attack.damage_profile)
+        self.critical_groups = tuple(group_dice(damage_dice.dice*2) for _, damage_dice in attack.damage_profile)
+        self.damage_modifiers = tuple(damage_dice.modifier for _, damage_dice in attack.damage_profile)
+        self.lethal_value = sum(damage_dice.max() for _, damage_dice in attack.damage_profile)
+        # dice per swing, for profiling
+        self.attack_dice = len(attack.attack_roll.dice) if attack.attack_roll is not None else 0
+        self.damage_dice = sum(len(damage_dice.dice) for _, damage_dice in attack.damage_profile)
+        self.critical_dice = 2*self.damage_dice
+        self._target_profiles = {}
+
+    def target_profile(self, target):
+        """
+        Returns, for each damage component, how the target takes it: 1 if it
+        is resistant, 2 if it is vulnerable and 0 otherwise.
+
+        Profiles are cached per resistance and vulnerability list, which are
+        part of an actor's shared definition.
+        """
+        key = (id(target.resistances), id(target.vulnerabilities))
+        entry = self._target_profiles.get(key)
+        if entry is None:
+            profile = []
+            for index in self.damage_types:
+                damage_type = DAMAGE_TYPES[index]
+                if damage_type in target.resistances:
+                    profile.append(1)
+                elif damage_type in target.vulnerabilities:
+                    profile.append(2)
+                else:
+                    profile.append(0)
+            # keep the lists alive so that their ids are not reused
+            entry = (tuple(profile), target.resistances, target.vulnerabilities)
+            self._target_profiles[key] = entry
+        return entry[0]
+
+    def execute(self, target, attacker, sink=NULL_SINK, advantage=False, disadvantage=False):
+        """
+        Performs the attack against the target.
+
+        Returns:
+            float: The damage taken by the target.
+        """
+        attack = self.attack
+        profile = profiling.active
+        if profile is not None:
+            profile.attacks += 1
+        effective_distance = target.distance - attacker.mobility
+        if effective_distance < 0:
+            effective_distance = 0
+        if self.range_limit is not None:
+            range_multiplier = 1 if effective_distance <= self.range_limit else 0
+        else:
+            range_multiplier = self.attack_range(effective_distance)
         if range_multiplier == 0:
-            log_string += "Out of range.\n"
-        elif self.attack_roll is not None:
-            roll = self.attack_roll.roll()
-            if advantage and not disadvantage:
-                roll = max(roll, self.attack_roll.roll())
-            elif disadvantage and not advantage:
-                roll = min(roll, self.attack_roll.roll())
+            if sink.enabled:
+                sink.emit({"event": "out_of_range", "actor": attacker.name,
+                    "target": target.name, "attack": attack.name})
+            return 0
 
-            if roll - self.attack_roll.modifier == 20:
+        mode = self.mode
+        if advantage or disadvantage:
+            mode = attack._roll_mode(advantage, disadvantage)
+        roll_groups = _roll_groups
+        tilt = dice_tilt
+        if tilt is not None:
+            roll_groups = lambda groups: tilt.roll_groups(groups, attacker)
+        damage_multiplier = range_multiplier
+        critical_hit = False
+        if self.attack_groups is not None:
+            natural = roll_groups(self.attack_groups)
+            if mode > 0:
+                natural = max(natural, roll_groups(self.attack_groups))
+            elif mode < 0:
+                natural = min(natural, roll_groups(self.attack_groups))
+            roll = natural + self.attack_modifier
+
+            if natural == 20:
                 critical_hit = True
-                log_string += " Rolls " + str(roll) + " : Critical Hit\n"
+                result = "critical"
             elif roll >= target.ac:
-                log_string += " Rolls " + str(roll) + " >= " + str(target.ac) + ": Hit\n"
+                result = "hit"
             else:
-                log_string += " Rolls " + str(roll) + " < " + str(target.ac) + ": Miss"
                 damage_multiplier = 0
+                result = "miss"
+            if sink.enabled:
+                sink.emit({"event": "attack_roll", "actor": attacker.name, "target": target.name,
+                    "attack": attack.name, "roll": roll, "result": result})
         elif self.save_dc is not None:
-            target_save = target.saves[self.save_ability].roll()
+            save = target.saves[self.save_ability]
+            if tilt is None:
+                target_save = save.roll()
+            else:
+                target_save = roll_groups(group_dice(save.dice)) + save.modifier
             if self.save_dc >= target_save:
-                log_string += " Rolls " + str(target_save) + " >= " + str(self.save_dc) + ": Save\n"
                 damage_multiplier = damage_multiplier * 0.5
+                result = "save"
             else:
-                log_string += " Rolls " + str(target_save) + " < " + str(self.save_dc) + ": Fails\n"
-
-
-        for damage_type, damage_dice in self.damage_profile:
-            unmodified_damage = damage_dice.roll()
-            if critical_hit:
-                unmodified_damage = unmodified_damage + damage_dice.roll() - damage_dice.modifier
-            damage = unmodified_damage * damage_multiplier
+                result = "fail"
+            if sink.enabled:
+                sink.emit({"event": "save_roll", "actor": attacker.name, "target": target.name,
+                    "attack": attack.name, "roll": target_save, "dc": self.save_dc, "result": result})
+
+        target_profile = self.target_profile(target)
+        groups = self.critical_groups if critical_hit else self.damage_groups
+        hp_before = target.hp_current
+        for index in range(len(groups)):
+            damage = (roll_groups(groups[index]) + self.damage_modifiers[index]) * damage_multiplier
             if damage > 0:
-                log_string += damage_type[0].upper() + damage_type[1:] + ": " + str(damage) + " | "
-                target.take_damage(damage, damage_type)
-        if log:
-            print(log_string)
+                if target_profile[index] == 1:
+                    damage = math.floor(damage/2)
+                elif target_profile[index] == 2:
+                    damage = math.floor(damage*2)
+                target.lose_hp(damage)
+                if sink.enabled:
+                    sink.emit({"event": "damage", "actor": attacker.name, "target": target.name,
+                        "attack": attack.name, "damage_type": DAMAGE_TYPES[self.damage_types[index]],
+                        "damage": damage, "hp": target.hp_current})
+        if sink.enabled and hp_before > 0 and not target.alive:
+            sink.emit({"event": "death", "actor": target.name})
+        if profile is not None:
+            if self.attack_groups is not None:
+                profile.dice_rolled += self.attack_dice*(1 if mode == 0 else 2)
+            profile.dice_rolled += self.critical_dice if critical_hit else self.damage_dice
+        damage = hp_before - target.hp_current
+        # plans are shared by copies of an actor, so damage is recorded by attacker
+        histograms = attacker.damage_histograms
+        if histograms is not None and recording:
+            histogram = histograms.get(self)
+            if histogram is not None:
+                histogram.add(damage)
         return damage
 
-    def average_damage(self, target, simulations=100, maximise_lethal_damage=True):
-        """
-        Returns the average damage of the attack.
-        """
-        damage_total = 0
-        for _ in range(simulations):
-            dummy = deepcopy(target)
-            dummy_original_hp = dummy.hp_current
-            damage = self.attack(dummy, log=False)
-            hp_delta = dummy_original_hp - dummy.hp_current
-            if dummy.hp_current == 0:
-                if  maximise_lethal_damage:
-                    damage_total += sum(damage_dice.max() for damage_type, damage_dice in self.damage_profile)
-                else:
-                    damage_total += damage
-            else:
-                damage_total += hp_delta
 
-        return damage_total/simulations
+class MultiattackPlan:
+    """
+    The compiled form of a Multiattack.
+
+    Attributes:
+        multiattack (Multiattack): The compiled multiattack.
+        plans (tuple): The AttackPlan of each of its attacks, in order.
+        compilations (int): The number of attack compilations when the
+            plans were last checked to be current.
+    """
+    __slots__ = ("multiattack", "plans", "compilations")
+
+    def __init__(self, multiattack):
+        self.multiattack = multiattack
+        self.plans = tuple(attack.plan() for attack in multiattack.attacks)
+        self.compilations = _compilations
+
 
 class Multiattack:
     """
@@ -304,12 +1048,80 @@ class Multiattack:
         self.name = name
         self.attacks = attacks
         self.uses = uses
+        self._plan = None
+
+    def compile(self):
+        """
+        Compiles the multiattack and its attacks, replacing any earlier plans.
+        """
+        for attack in self.attacks:
+            attack.compile()
+        self._plan = MultiattackPlan(self)
+        return self._plan
+
+    def plan(self):
+        """
+        Returns the compiled MultiattackPlan of the multiattack, rebuilt if
+        one of its attacks was recompiled since.
+        """
+        plan = self._plan
+        if plan is None:
+            plan = self._plan = MultiattackPlan(self)
+        elif plan.compilations != _compilations:
+            if any(attack_plan is not attack._plan for attack_plan, attack in zip(plan.plans, self.attacks)):
+                plan = self._plan = MultiattackPlan(self)
+            else:
+                plan.compilations = _compilations
+        return plan
             
 
+class ActorState:
+    """
+    The mutable state of an actor during one trial, kept apart from the
+    actor's definition so that trials can be reset in place.
+
+    Attributes:
+        hp_current (int): The current health of the actor
+        alive (bool): Whether the actor is alive or not
+        mobility (int): The effective "reach" of the actor
+        distance (int): The distance from the actor to the encounter
+        uses (list): The uses left of each of the actor's multiattacks
+    """
+    __slots__ = ("hp_current", "alive", "mobility", "distance", "uses")
+
+    def __init__(self, hp_current, alive, mobility, distance, uses):
+        self.hp_current = hp_current
+        self.alive = alive
+        self.mobility = mobility
+        self.distance = distance
+        self.uses = uses
+
+    def __repr__(self):
+        return "ActorState(hp_current={}, alive={}, mobility={}, distance={}, uses={})".format(
+                self.hp_current, self.alive, self.mobility, self.distance, self.uses)
+
+    def copy(self):
+        return ActorState(self.hp_current, self.alive, self.mobility, self.distance, self.uses[:])
+
+    def copy_from(self, other):
+        """
+        Overwrites this state with another one in place.
+        """
+        self.hp_current = other.hp_current
+        self.alive = other.alive
+        self.mobility = other.mobility
+        self.distance = other.distance
+        self.uses[:] = other.uses
+
+
 class Actor:
     """
     A class to represent an actor in the simulation
 
+    The definition of an actor is shared between its copies, while hp_current,
+    alive, mobility, distance and the uses of its multiattacks live in its
+    ActorState, so copying or resetting an actor never copies its attacks.
+
     Attributes:
         name (str): The name of the actor
         hp_max (int): The maximum health of the actor
@@ -323,6 +1135,13 @@ class Actor:
         distance (int): The distance from the actor to the encounter
         speed (int): The speed of the actor
         mobility (int): The effective "reach" of the actor, increasing range of attacks
+        saves (dict): A dict of ability -> DiceRoll for the actor's saving throws
+        targeting_simulations (int): If set, targets are chosen by simulating each
+            attack this many times instead of using its exact expected damage
+        policy: If set, decides the actor's turns instead of the default of
+            using its first multiattack with uses left, see policy.py
+        damage_histograms (dict): If set, AttackPlan -> Histogram recording
+            the damage of every swing of the actor that is in range, see stats.py
     """
 
     def __init__(self,
@@ -334,25 +1153,26 @@ class Actor:
             attacks=[], 
             initiative=0,
             distance=0,
-            speed=30):
+            speed=30,
+            saves=None,
+            targeting_simulations=None,
+            policy=None):
 
         self.name = name
         self.hp_max = hp_max
-        self.hp_current = hp_max
         self.ac = ac
         self.resistances = resistances
         self.vulnerabilities = vulnerabilities
-        self.attacks = attacks
-        self.alive = True
         self.initiative = initiative
-        self.distance = distance
         self.speed = speed
-        for attack in self.attacks:
-            if isinstance(attack, Attack):
-                attack = Multiattack(attack.name, [attack])
-            for attack in attack.attacks:
-                attack.actor = self
-        self.mobility = 0
+        if saves is None:
+            saves = {ability: DiceRoll([20], 0) for ability in ABILITY_SCORES}
+        self.saves = saves
+        self.targeting_simulations = targeting_simulations
+        self.policy = policy
+        self.damage_histograms = None
+        self.state = ActorState(hp_max, True, 0, distance, [])
+        self.attacks = attacks
 
     def __str__(self):
         return self.name + ": " + str(self.hp_current) + "/" + str(self.hp_max)
@@ -360,30 +1180,113 @@ class Actor:
     def __repr__(self):
         return self.name + ": " + str(self.hp_current) + "/" + str(self.hp_max)
 
+    @property
+    def attacks(self):
+        return self._attacks
+
+    @attacks.setter
+    def attacks(self, attacks):
+        attacks = [Multiattack(attack.name, [attack]) if isinstance(attack, Attack) else attack
+                for attack in attacks]
+        for multiattack in attacks:
+            for attack in multiattack.attacks:
+                attack.actor = self
+        self._attacks = attacks
+        self.state.uses = [multiattack.uses for multiattack in attacks]
+
+    @property
+    def hp_current(self):
+        return self.state.hp_current
+
+    @hp_current.setter
+    def hp_current(self, hp_current):
+        self.state.hp_current = hp_current
+
+    @property
+    def alive(self):
+        return self.state.alive
+
+    @alive.setter
+    def alive(self, alive):
+        self.state.alive = alive
+
+    @property
+    def mobility(self):
+        return self.state.mobility
+
+    @mobility.setter
+    def mobility(self, mobility):
+        self.state.mobility = mobility
+
+    @property
+    def distance(self):
+        return self.state.distance
+
+    @distance.setter
+    def distance(self, distance):
+        self.state.distance = distance
+
     def __deepcopy__(self, memo):
-        ##TODO: actually deepcopy the attacks
-        new_actor = Actor(self.name, self.hp_max, self.ac, self.resistances, self.vulnerabilities, self.attacks, self.initiative, self.distance)
-        new_actor.hp_current = self.hp_current
-        new_actor.alive = self.alive
-        new_actor.mobility = self.mobility
-        new_actor.distance = self.distance
-        return new_actor
-        
+        return self.copy()
+
     def copy(self):
-        return deepcopy(self)
+        """
+        Returns an actor that shares this actor's definition and attacks but
+        has its own copy of the current state.
+        """
+        new_actor = Actor.__new__(Actor)
+        new_actor.__dict__.update(self.__dict__)
+        new_actor.state = self.state.copy()
+        if profiling.active is not None:
+            profiling.active.actor_copies += 1
+        return new_actor
 
-    def take_damage(self, damage, damage_type):
+    def snapshot(self):
         """
-        Takes damage from an attack.
+        Returns a copy of the actor's current state.
+        """
+        return self.state.copy()
+
+    def reset(self, state=None):
+        """
+        Resets the actor in place, to a snapshot or to the start of an encounter.
+
+        Args:
+            state (ActorState): The state to reset to. If None, the actor is
+                reset to full hp, no mobility and all uses of its multiattacks.
+        """
+        if state is None:
+            state = ActorState(self.hp_max, True, 0, self.distance,
+                    [multiattack.uses for multiattack in self.attacks])
+        self.state.copy_from(state)
+        if profiling.active is not None:
+            profiling.active.actor_resets += 1
+
+    def damage_taken(self, damage, damage_type):
+        """
+        Returns the damage after resistances and vulnerabilities are applied.
         """
         if damage_type in self.resistances:
-            damage = Math.floor(damage/2)
+            return math.floor(damage/2)
         elif damage_type in self.vulnerabilities:
-            damage = Math.floor(damage*2)
-        self.hp_current -= damage
-        if self.hp_current < 0:
-            self.hp_current = 0
-            self.alive = False
+            return math.floor(damage*2)
+        return damage
+
+    def take_damage(self, damage, damage_type):
+        """
+        Takes damage from an attack.
+        """
+        self.lose_hp(self.damage_taken(damage, damage_type))
+
+    def lose_hp(self, amount):
+        """
+        Loses hp after resistances and vulnerabilities have been applied.
+        """
+        state = self.state
+        state.hp_current -= amount
+        if state.hp_current <= 0:
+            state.hp_current = 0
+            state.alive = False
 
     def roll_initiative(self):
         """
@@ -391,21 +1294,35 @@ class Actor:
         """
         return DiceRoll([20], self.initiative).roll()
 
-    def choose_target(self, targets, attack):
+    def choose_target(self, targets, attack, simulations=None):
         """
         Choose a target for the actor to attack.
 
         Args:
-            targets (list): A list of targets to choose from.
+            targets (list): A list of targets to choose from, or a TargetIndex of them.
+            attack (Attack): The attack to choose a target for.
+            simulations (int): If set, estimate the damage against each target
+                by simulation instead of computing it exactly.
 
         Returns:
             Character: The chosen target.
         """
+        if isinstance(targets, TargetIndex):
+            if simulations is None:
+                return targets.best(self, attack)
+            targets = targets.targets
 
         best_target = None
         best_damage = 0
         for target in targets:
-            expected_damage = attack.average_damage(target)
+            if not target.alive:
+                continue
+            if profiling.active is not None:
+                profiling.active.target_evaluations += 1
+            if simulations is None:
+                expected_damage = attack.expected_damage(target, attacker=self)
+            else:
+                expected_damage = attack.average_damage(target, simulations, attacker=self)
             if expected_damage > best_damage:
                 best_target = target
                 best_damage = expected_damage
@@ -413,55 +1330,89 @@ class Actor:
         return best_target
 
 
-    def perform_multiattack(self, multiattack, targets, log=True):
+    def perform_multiattack(self, multiattack, targets, sink=NULL_SINK, focus=None):
         """
         Perform a multiattack.
 
         Args:
             multiattack (Multiattack): The multiattack to perform.
             targets (list): The targets to attack.
+            sink: The sink that receives the events of the multiattack.
+            focus (Character): If set, every attack that can damage it goes
+                to this target while it is alive.
         """
         if isinstance(multiattack, Attack):
             multiattack = Multiattack("", [multiattack])
 
-        if multiattack.uses <= 0:
+        # uses are tracked in the actor's state for its own multiattacks
+        index = None
+        for i, own_multiattack in enumerate(self.attacks):
+            if own_multiattack is multiattack:
+                index = i
+        if index is not None and self.state.uses[index] <= 0:
             raise Exception("Multiattack has no uses left")
 
         can_attack = False
-        for attack in multiattack.attacks:
-            target = self.choose_target(targets, attack)
+        profile = profiling.active
+        target_index = targets if isinstance(targets, TargetIndex) else None
+        for plan in multiattack.plan().plans:
+            if focus is not None and focus.alive and plan.attack.expected_damage(focus, attacker=self) > 0:
+                can_attack = True
+                plan.execute(focus, self, sink)
+                if target_index is not None:
+                    target_index.touch(focus)
+                continue
+            if profile is None:
+                target = self.choose_target(targets, plan.attack, self.targeting_simulations)
+                if target is not None:
+                    can_attack = True
+                    plan.execute(target, self, sink)
+                    if target_index is not None:
+                        target_index.touch(target)
+                continue
+
+            start = perf_counter()
+            target = self.choose_target(targets, plan.attack, self.targeting_simulations)
+            profile.targeting_time += perf_counter() - start
             if target is not None:
                 can_attack = True
-                attack.attack(target,log)
-        if can_attack:
-            multiattack.uses -= 1
-        
+                start = perf_counter()
+                plan.execute(target, self, sink)
+                profile.attack_time += perf_counter() - start
+                if target_index is not None:
+                    target_index.touch(target)
+        if can_attack and index is not None:
+            self.state.uses[index] -= 1
+
         return can_attack
 
-    def perform_turn(self, targets, log=True):
+    def perform_turn(self, targets, sink=NULL_SINK):
         """
         Perform a turn for the actor.
 
         Args:
             targets (list): The targets to attack.
+            sink: The sink that receives the events of the turn.
         """
         if self.alive:
             self.move(self.speed)
+            if sink.enabled:
+                sink.emit({"event": "move", "actor": self.name, "mobility": self.mobility, "dash": False})
             attacked = False
-            for multiattack in self.attacks:
-                if multiattack.uses > 0:
-                    print(self.name + " is performing " + multiattack.name)
-                    attacked = self.perform_multiattack(multiattack, targets)
-                    break
+            if self.policy is None:
+                for multiattack, uses in zip(self.attacks, self.state.uses):
+                    if uses > 0:
+                        attacked = self.perform_multiattack(multiattack, targets, sink)
+                        break
+            else:
+                index, focus = self.policy.decide(self, targets)
+                if index is not None:
+                    attacked = self.perform_multiattack(self.attacks[index], targets, sink, focus)
 
             if not attacked:
-                if log:
-                    print("{} has no targets, dashing".format(self.name))
                 self.move(self.speed)
-        else:
-            if log:
-                print(self.name + " is dead.")
-            return
+                if sink.enabled:
+                    sink.emit({"event": "move", "actor": self.name, "mobility": self.mobility, "dash": True})
 
     def move(self, distance):
         """
@@ -473,6 +1424,449 @@ class Actor:
         self.mobility += distance
 
 
+class HordeMember:
+    """
+    One member of a Horde, as seen by the actors that target it. Its hp is
+    an entry of the horde's hp vector and everything else is the horde's.
+    """
+    __slots__ = ("horde", "index")
+
+    def __init__(self, horde, index):
+        self.horde = horde
+        self.index = index
+
+    def __repr__(self):
+        return self.name + ": " + str(self.hp_current) + "/" + str(self.hp_max)
+
+    @property
+    def name(self):
+        return "{} {}".format(self.horde.name, self.index + 1)
+
+    @property
+    def hp_current(self):
+        return self.horde.hp[self.index]
+
+    @hp_current.setter
+    def hp_current(self, hp_current):
+        self.horde.hp[self.index] = hp_current
+
+    @property
+    def alive(self):
+        return self.horde.hp[self.index] > 0
+
+    @property
+    def hp_max(self):
+        return self.horde.actor.hp_max
+
+    @property
+    def ac(self):
+        return self.horde.actor.ac
+
+    @property
+    def resistances(self):
+        return self.horde.actor.resistances
+
+    @property
+    def vulnerabilities(self):
+        return self.horde.actor.vulnerabilities
+
+    @property
+    def saves(self):
+        return self.horde.actor.saves
+
+    @property
+    def distance(self):
+        return self.horde.distance
+
+    def damage_taken(self, damage, damage_type):
+        return self.horde.actor.damage_taken(damage, damage_type)
+
+    def take_damage(self, damage, damage_type):
+        self.lose_hp(self.damage_taken(damage, damage_type))
+
+    def lose_hp(self, amount):
+        hp = self.horde.hp
+        hp[self.index] -= amount
+        if hp[self.index] <= 0:
+            hp[self.index] = 0
+
+    def snapshot(self):
+        return self.horde.hp[self.index]
+
+    def reset(self, state=None):
+        if state is None:
+            state = self.horde.actor.hp_max
+        self.horde.hp[self.index] = state
+
+
+class Horde:
+    """
+    A group of identical actors sharing one definition, with their hp kept
+    in a single vector.
+
+    A horde rolls initiative once and takes one turn for all its members:
+    they move together, use the same multiattack and, for each of its
+    attacks, attack the same target with one bulk draw of damage until it
+    dies, after which the remaining members choose a new target. A limited
+    multiattack spends one use for the whole horde. Opponents target the
+    members individually, through the members list.
+
+    Attributes:
+        actor (Actor): The definition of every member.
+        name (str): The name of the horde, and the prefix of its members' names.
+        count (int): The number of members.
+        hp (list): The current hp of each member.
+        members (list): A HordeMember for each member.
+        mobility (int): The mobility of every member.
+        distance (int): The distance of every member.
+        uses (list): The uses left of each multiattack.
+        damage_histograms (dict): If set, AttackPlan -> Histogram recording
+            the damage of every attack of the horde that is in range.
+    """
+    targeting_simulations = None
+
+    def __init__(self, actor, count, name=None):
+        """
+        Initializes the horde.
+
+        Args:
+            actor (Actor): The definition of every member.
+            count (int): The number of members.
+            name (str): The name of the horde. If None, the actor's name.
+        """
+        self.actor = actor
+        self.name = actor.name if name is None else name
+        self.count = count
+        self.hp = [actor.hp_current]*count
+        self.members = [HordeMember(self, index) for index in range(count)]
+        self.mobility = actor.mobility
+        self.distance = actor.distance
+        self.uses = list(actor.state.uses)
+        self.damage_histograms = None
+        self._rng = None
+
+    def __str__(self):
+        return "{} ({}/{} alive)".format(self.name, self.living(), self.count)
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def attacks(self):
+        return self.actor.attacks
+
+    @property
+    def speed(self):
+        return self.actor.speed
+
+    @property
+    def initiative(self):
+        return self.actor.initiative
+
+    @property
+    def hp_max(self):
+        return self.actor.hp_max*self.count
+
+    @property
+    def hp_current(self):
+        return sum(self.hp)
+
+    @property
+    def alive(self):
+        for hp in self.hp:
+            if hp > 0:
+                return True
+        return False
+
+    def living(self):
+        """
+        Returns the number of members alive.
+        """
+        return sum(1 for hp in self.hp if hp > 0)
+
+    def copy(self):
+        """
+        Returns a horde sharing this horde's definition with its own copy of
+        the current state.
+        """
+        horde = Horde(self.actor, self.count, self.name)
+        horde.reset(self.snapshot())
+        if profiling.active is not None:
+            profiling.active.actor_copies += 1
+        return horde
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def snapshot(self):
+        """
+        Returns a copy of the horde's current state.
+        """
+        return (tuple(self.hp), self.mobility, self.distance, tuple(self.uses))
+
+    def reset(self, state=None):
+        """
+        Resets the horde in place, to a snapshot or to the start of an encounter.
+        """
+        if state is None:
+            state = ((self.actor.hp_max,)*self.count, 0, self.distance,
+                    tuple(multiattack.uses for multiattack in self.attacks))
+        hp, self.mobility, self.distance, uses = state
+        self.hp[:] = hp
+        self.uses[:] = uses
+        # drawn from the random module at first use, so that seeded runs repeat
+        self._rng = None
+        if profiling.active is not None:
+            profiling.active.actor_resets += 1
+
+    def roll_initiative(self):
+        """
+        Return the initiative of the horde.
+        """
+        return DiceRoll([20], self.actor.initiative).roll()
+
+    choose_target = Actor.choose_target
+
+    def move(self, distance):
+        """
+        Move every member of the horde.
+        """
+        self.mobility += distance
+
+    def perform_turn(self, targets, sink=NULL_SINK):
+        """
+        Perform a turn for every living member of the horde.
+
+        Args:
+            targets (list): The targets to attack.
+            sink: The sink that receives the events of the turn.
+        """
+        living = self.living()
+        if living == 0:
+            return
+        self.move(self.speed)
+        if sink.enabled:
+            sink.emit({"event": "move", "actor": self.name, "mobility": self.mobility, "dash": False})
+        attacked = False
+        for index, uses in enumerate(self.uses):
+            if uses > 0:
+                attacked = self._perform_multiattack(self.attacks[index], living, targets, sink)
+                if attacked:
+                    self.uses[index] -= 1
+                break
+
+        if not attacked:
+            self.move(self.speed)
+            if sink.enabled:
+                sink.emit({"event": "move", "actor": self.name, "mobility": self.mobility, "dash": True})
+
+    def _perform_multiattack(self, multiattack, living, targets, sink):
+        target_index = targets if isinstance(targets, TargetIndex) else None
+        if np is not None and self._rng is None:
+            self._rng = default_generator()
+        can_attack = False
+        for plan in multiattack.plan().plans:
+            remaining = living
+            while remaining > 0:
+                target = self.choose_target(targets, plan.attack)
+                if target is None:
+                    break
+                can_attack = True
+                damages = plan.attack.attack_many(target, remaining, attacker=self, rng=self._rng)
+                remaining -= self._apply(plan, target, damages, sink)
+                if target_index is not None:
+                    target_index.touch(target)
+        return can_attack
+
+    def _apply(self, plan, target, damages, sink):
+        """
+        Applies bulk drawn damage to a target one attack at a time, stopping
+        when it dies.
+
+        Returns:
+            int: The number of attacks used.
+        """
+        hp_before = target.hp_current
+        if np is not None:
+            cumulative = np.cumsum(damages)
+            used = min(int(np.searchsorted(cumulative, hp_before, side="left")) + 1, len(damages))
+            total = cumulative[used - 1].item()
+        else:
+            used = 0
+            total = 0
+            for damage in damages:
+                used += 1
+                total += damage
+                if total >= hp_before:
+                    break
+        if total > 0:
+            target.lose_hp(total)
+        histogram = None
+        if self.damage_histograms is not None and recording:
+            histogram = self.damage_histograms.get(plan)
+        if histogram is not None:
+            for damage in damages[:used - 1]:
+                histogram.add(damage)
+            histogram.add(hp_before - target.hp_current - (total - damages[used - 1]))
+        if sink.enabled:
+            sink.emit({"event": "horde_attack", "actor": self.name, "target": target.name,
+                "attack": plan.attack.name, "attacks": used, "damage": hp_before - target.hp_current,
+                "hp": target.hp_current})
+            if not target.alive:
+                sink.emit({"event": "death", "actor": target.name})
+        return used
+
+
+def expand_hordes(actors):
+    """
+    Returns a list of actors with every Horde replaced by its members.
+    """
+    expanded = []
+    for actor in actors:
+        if isinstance(actor, Horde):
+            expanded.extend(actor.members)
+        else:
+            expanded.append(actor)
+    return expanded
+
+
+class TargetIndex:
+    """
+    An index of targets grouped into classes of targets that every attack
+    damages alike: the same distance, armor class, resistances,
+    vulnerabilities and saves. Within a class the exact expected damage of
+    an attack only depends on hp, and unless the attack can deal more than
+    its lethal value, which only vulnerabilities allow, it never increases
+    with hp, so choosing a target scores each class once, at its lowest hp,
+    instead of every target. Otherwise every distinct hp of the class is scored.
+
+    The choice is the same as that of scanning the targets in order: the
+    first target with the highest expected damage. The index must be told
+    about every change to the hp of a target with touch, or rebuilt with
+    refresh.
+
+    Attributes:
+        targets (list): The indexed targets, in order.
+    """
+
+    def __init__(self, targets):
+        self.targets = list(targets)
+        self._positions = {id(target): position for position, target in enumerate(self.targets)}
+        self._saves_keys = {}
+        self.refresh()
+
+    def __iter__(self):
+        return iter(self.targets)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def refresh(self):
+        """
+        Rebuilds the index from the current state of the targets.
+        """
+        # class key -> (sorted distinct hps, hp -> sorted positions)
+        self._classes = {}
+        self._keys = []
+        self._hps = []
+        for position, target in enumerate(self.targets):
+            # actors built separately have equal but distinct saves
+            entry = self._saves_keys.get(id(target.saves))
+            if entry is None:
+                saves_key = tuple((ability, tuple(sorted(save.dice)), save.modifier)
+                        for ability, save in sorted(target.saves.items()))
+                # keep the saves alive so that their id is not reused
+                entry = (saves_key, target.saves)
+                self._saves_keys[id(target.saves)] = entry
+            saves_key = entry[0]
+            key = (target.distance, target.ac, id(target.resistances), id(target.vulnerabilities), saves_key)
+            if key not in self._classes:
+                self._classes[key] = ([], {})
+            self._keys.append(key)
+            self._hps.append(None)
+            self._add(position, target)
+
+    def _add(self, position, target):
+        if not target.alive:
+            return
+        hps, members = self._classes[self._keys[position]]
+        hp = target.hp_current
+        if hp not in members:
+            members[hp] = []
+            insort(hps, hp)
+        insort(members[hp], position)
+        self._hps[position] = hp
+
+    def _remove(self, position):
+        hp = self._hps[position]
+        if hp is None:
+            return
+        hps, members = self._classes[self._keys[position]]
+        members[hp].remove(position)
+        if not members[hp]:
+            del members[hp]
+            hps.pop(bisect_left(hps, hp))
+        self._hps[position] = None
+
+    def touch(self, target):
+        """
+        Updates the index after the hp of a target changed.
+        """
+        position = self._positions[id(target)]
+        if self._hps[position] == target.hp_current and target.alive:
+            return
+        self._remove(position)
+        self._add(position, target)
+
+    def best(self, attacker, attack):
+        """
+        Returns the target against which the attack has the highest exact
+        expected damage, or None if it cannot damage any target.
+        """
+        lethal_value = attack.plan().lethal_value
+        profile = profiling.active
+        best_position = None
+        best_damage = 0
+        for hps, members in self._classes.values():
+            if not hps:
+                continue
+            if profile is not None:
+                profile.target_evaluations += 1
+            representative = self.targets[members[hps[0]][0]]
+            distribution = attack.damage_distribution(representative, attacker=attacker)
+            if distribution.values[-1] <= lethal_value:
+                expected_damage = distribution.expected(hps[0], lethal_value)
+                if expected_damage <= 0 or expected_damage < best_damage:
+                    continue
+                # the first target of the class with the same expected damage,
+                # which may have more hp where the distribution has gaps
+                position = members[hps[0]][0]
+                for i in range(1, len(hps)):
+                    if distribution.expected(hps[i], lethal_value) != expected_damage:
+                        break
+                    position = min(position, members[hps[i]][0])
+            else:
+                # damage above the lethal value, from vulnerabilities, makes
+                # more hp worth more damage, so every hp of the class is scored
+                expected_damage = 0
+                position = None
+                for hp in hps:
+                    damage = distribution.expected(hp, lethal_value)
+                    if damage > expected_damage:
+                        expected_damage = damage
+                        position = members[hp][0]
+                    elif damage == expected_damage and position is not None:
+                        position = min(position, members[hp][0])
+                if expected_damage <= 0 or expected_damage < best_damage:
+                    continue
+            if expected_damage > best_damage or position < best_position:
+                best_position = position
+                best_damage = expected_damage
+        if best_position is None:
+            return None
+        return self.targets[best_position]
+
+
 
 
 
@@ -0,0 +1,207 @@
+"""
+Turn policies, which decide what an actor does on its turn.
+
+An actor without a policy uses its first multiattack with uses left and
+chooses a target for every attack with choose_target. A policy replaces
+that choice:
+
+    troll = Actor("Troll", 84, 15, policy=LookaheadPolicy(rounds=2, evaluations=64))
+
+A policy's decide(actor, targets) is called after the actor moved and
+returns (index, focus): the index of the multiattack to use, or None to
+dash, and a target that its attacks go to while it is alive, or None to
+choose targets attack by attack.
+"""
+import math
+import random
+from time import perf_counter
+import model
+import profiling
+from events import NULL_SINK
+from model import HordeMember
+
+# the number of lookaheads in progress; actors in a lookahead play greedily
+_depth = 0
+
+
+class GreedyPolicy:
+    """
+    The default turn: the first multiattack with uses left and greedy targets.
+    """
+
+    def __repr__(self):
+        return "GreedyPolicy()"
+
+    def decide(self, actor, targets):
+        for index, uses in enumerate(actor.state.uses):
+            if uses > 0:
+                return index, None
+        return None, None
+
+
+class LookaheadPolicy:
+    """
+    Compares every option of the turn, using each multiattack with uses left
+    on greedy targets or focused on each living target, or dashing, by
+    simulating the next rounds after each and scoring their outcome.
+
+    The rollouts are played by the actor against its targets, which attack
+    it in return, with every actor playing greedily after the first turn.
+    A rollout scores the fraction of hp the targets lost plus one per target
+    killed, less the fraction of hp the actor lost and one if it died.
+
+    The options are evaluated one rollout at a time in turn, so a choice can
+    be made whenever the budget runs out. The rollouts of one pass over the
+    options all roll the same random numbers, so that every option is
+    compared with the default turn on the same luck, and an option is only
+    chosen over the default if its mean score difference exceeds margin
+    standard errors; of those, the one with the best mean difference wins.
+    Rollouts are noisy, and this keeps a small budget from trading the
+    default turn for an option that was merely lucky. The random module is
+    restored afterwards, so looking ahead only takes one draw from the
+    simulation's random stream.
+    Every decision is bounded by the budget, so a Monte Carlo simulation of
+    actors with this policy costs at most evaluations rollouts per turn.
+
+    Rollouts roll fair dice, even under importance sampling, and do not
+    record outcome statistics.
+
+    Attributes:
+        rounds (int): The number of rounds simulated by a rollout.
+        evaluations (int): The maximum number of rollouts per decision.
+        time_budget (float): The maximum number of seconds per decision, or
+            None. A time budget makes seeded simulations irreproducible.
+        margin (float): The number of standard errors by which an option
+            must beat the default turn.
+    """
+
+    def __init__(self, rounds=2, evaluations=64, time_budget=None, margin=1):
+        self.rounds = rounds
+        self.evaluations = evaluations
+        self.time_budget = time_budget
+        self.margin = margin
+
+    def __repr__(self):
+        return "LookaheadPolicy(rounds={}, evaluations={}, time_budget={}, margin={})".format(
+                self.rounds, self.evaluations, self.time_budget, self.margin)
+
+    def options(self, actor, targets):
+        """
+        Returns the options of the actor's turn as (index, focus) pairs, the
+        default turn first.
+        """
+        default = GreedyPolicy().decide(actor, targets)
+        options = [default]
+        living = [target for target in targets if target.alive]
+        for index, uses in enumerate(actor.state.uses):
+            if uses <= 0:
+                continue
+            for focus in [None] + living:
+                if (index, focus) != default:
+                    options.append((index, focus))
+        if (None, None) not in options:
+            options.append((None, None))
+        return options
+
+    def decide(self, actor, targets):
+        """
+        Returns the option of the actor's turn that beat the default turn by
+        the most within the budget, or the default turn.
+        """
+        global _depth
+        if _depth:
+            return GreedyPolicy().decide(actor, targets)
+        options = self.options(actor, targets)
+        if len(options) == 1 or self.evaluations <= 0:
+            return options[0]
+
+        targets = list(targets)
+        opponents = []
+        for target in targets:
+            opponent = target.horde if isinstance(target, HordeMember) else target
+            if not any(opponent is other for other in opponents):
+                opponents.append(opponent)
+        snapshots = [(participant, participant.snapshot()) for participant in [actor] + opponents]
+        # sums of the differences of each option's scores from the default's, and of their squares
+        totals = [0]*len(options)
+        squares = [0]*len(options)
+        counts = [0]*len(options)
+        deadline = None if self.time_budget is None else perf_counter() + self.time_budget
+        seeds = random.Random(random.getrandbits(64))
+        random_state = random.getstate()
+
+        tilt = model.dice_tilt
+        recording = model.recording
+        profile = profiling.active
+        model.dice_tilt = None
+        model.recording = False
+        profiling.active = None
+        _depth += 1
+        try:
+            evaluations = 0
+            while evaluations < self.evaluations:
+                option = evaluations % len(options)
+                if option == 0:
+                    seed = seeds.getrandbits(64)
+                random.seed(seed)
+                score = self._rollout(actor, targets, opponents, options[option])
+                if option == 0:
+                    default_score = score
+                difference = score - default_score
+                totals[option] += difference
+                squares[option] += difference*difference
+                counts[option] += 1
+                evaluations += 1
+                for participant, snapshot in snapshots:
+                    participant.reset(snapshot)
+                if deadline is not None and perf_counter() >= deadline:
+                    break
+        finally:
+            random.setstate(random_state)
+            _depth -= 1
+            model.dice_tilt = tilt
+            model.recording = recording
+            profiling.active = profile
+
+        best = 0
+        best_difference = 0
+        for option in range(1, len(options)):
+            count = counts[option]
+            if count < 2:
+                continue
+            mean = totals[option]/count
+            variance = max(squares[option]/count - mean*mean, 0)/(count - 1)
+            if mean - self.margin*math.sqrt(variance) > 0 and mean > best_difference:
+                best = option
+                best_difference = mean
+        return options[best]
+
+    def _rollout(self, actor, targets, opponents, option):
+        """
+        Plays an option and the following rounds, and returns their score.
+        """
+        hp_before = [target.hp_current for target in targets]
+        actor_hp = actor.hp_current
+        index, focus = option
+        attacked = False
+        if index is not None:
+            attacked = actor.perform_multiattack(actor.attacks[index], targets, NULL_SINK, focus)
+        if not attacked:
+            actor.move(actor.speed)
+        for round_number in range(self.rounds):
+            for opponent in opponents:
+                opponent.perform_turn([actor], NULL_SINK)
+            if not actor.alive or not any(target.alive for target in targets):
+                break
+            if round_number + 1 < self.rounds:
+                actor.perform_turn(targets, NULL_SINK)
+
+        score = 0
+        for target, hp in zip(targets, hp_before):
+            score += (hp - max(target.hp_current, 0))/max(target.hp_max, 1)
+            if hp > 0 and not target.alive:
+                score += 1
+        score -= (actor_hp - max(actor.hp_current, 0))/max(actor.hp_max, 1)
+        if not actor.alive:
+            score -= 1
+        return score
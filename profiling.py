@@ -0,0 +1,83 @@
+"""
+Optional counters and phase timers for the simulator's hot paths.
+
+The simulator only records into the Profile in `active`, and checks that it
+is not None before doing so, so profiling costs one comparison per hot path
+when it is off:
+
+    with profiled() as profile:
+        encounter.run()
+    print(profile.as_dict())
+"""
+from contextlib import contextmanager
+
+active = None
+
+
+class Profile:
+    """
+    Counters and timers recorded while simulating.
+
+    Attributes:
+        dice_rolled (int): Number of individual dice rolled.
+        attacks (int): Number of attacks performed.
+        target_evaluations (int): Number of targets scored by choose_target.
+        average_damage_simulations (int): Number of attacks simulated by average_damage.
+        actor_copies (int): Number of actors copied.
+        actor_resets (int): Number of actors reset to a snapshot.
+        trials (int): Number of encounters run.
+        rounds (int): Number of rounds run.
+        initiative_time (float): Seconds spent rolling and sorting initiative.
+        targeting_time (float): Seconds spent choosing targets.
+        attack_time (float): Seconds spent resolving attacks.
+        win_check_time (float): Seconds spent checking whether a side has won.
+    """
+    __slots__ = ("dice_rolled", "attacks", "target_evaluations", "average_damage_simulations",
+            "actor_copies", "actor_resets", "trials", "rounds",
+            "initiative_time", "targeting_time", "attack_time", "win_check_time")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def __repr__(self):
+        return "Profile(" + ", ".join("{}={}".format(name, value) for name, value in self.as_dict().items()) + ")"
+
+    def __eq__(self, other):
+        if isinstance(other, Profile):
+            return self.as_dict() == other.as_dict()
+        return NotImplemented
+
+    def as_dict(self):
+        """
+        Returns the counters and timers as a dict.
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def merge(self, other):
+        """
+        Returns a new profile adding up this profile and another.
+        """
+        profile = Profile()
+        for name in self.__slots__:
+            setattr(profile, name, getattr(self, name) + getattr(other, name))
+        return profile
+
+
+@contextmanager
+def profiled(profile=None):
+    """
+    Records into a profile for the duration of a with block.
+
+    Args:
+        profile (Profile): The profile to record into. If None, a new one is made.
+    """
+    global active
+    if profile is None:
+        profile = Profile()
+    previous = active
+    active = profile
+    try:
+        yield profile
+    finally:
+        active = previous
@@ -0,0 +1,366 @@
+"""
+A local simulation service: an asyncio server that queues Monte Carlo
+simulations of encounters and runs them on a pool of warm worker processes.
+
+Clients connect over TCP and send one JSON request per line. Encounters are
+written as in stat-block files (see statblock.py), with an optional library
+of actors:
+
+    {"id": "a", "encounter": {"players": [...], "monsters": [...]}, "actors": {...},
+     "iterations": 10000, "seed": 1, "priority": "interactive"}
+    {"id": "a", "cancel": true}
+
+and receive JSON lines tagged with the id of their request, which must not be
+in use by another of their requests in flight:
+
+    {"id": "a", "event": "queued", "job": "<fingerprint>"}
+    {"id": "a", "event": "progress", "iterations": 2000, "total": 10000, "wins": 1234, "win_rate": 0.617}
+    {"id": "a", "event": "result", "iterations": 10000, "wins": 6170, "win_rate": 0.617, "low": ..., "high": ...}
+    {"id": "a", "event": "cancelled"}
+    {"id": "a", "event": "error", "message": "..."}
+
+Jobs are split into chunks that the workers take from a priority queue, so an
+interactive query only waits for the chunks already running, and identical
+requests in flight share one job. Each worker keeps the encounters it has
+built, with their compiled attacks, between chunks.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from cache import fingerprint
+from simulation import SimulationResult, _run_shard, shard_seed, shard_sizes
+from statblock import load_encounter
+
+PRIORITIES = {"interactive": 0, "normal": 5, "batch": 10}
+
+# encounters built by the current worker process, by job key
+_ENCOUNTERS = {}
+_MAX_ENCOUNTERS = 64
+
+
+def _warm_up():
+    """
+    Returns once the worker process is up, with the simulator imported.
+    """
+    return os.getpid()
+
+
+def _run_chunk(key, description, library, iterations, seed):
+    """
+    Runs one chunk of a job in a worker process that keeps the encounters of
+    recent jobs between chunks.
+
+    Returns:
+        SimulationResult: The result of the chunk.
+    """
+    encounter = _ENCOUNTERS.get(key)
+    if encounter is None:
+        if len(_ENCOUNTERS) >= _MAX_ENCOUNTERS:
+            del _ENCOUNTERS[next(iter(_ENCOUNTERS))]
+        encounter = load_encounter(description, library)
+        _ENCOUNTERS[key] = encounter
+    return _run_shard(encounter, iterations, seed)[0]
+
+
+def _priority(priority):
+    if isinstance(priority, str):
+        if priority not in PRIORITIES:
+            raise ValueError("Unknown priority: " + priority)
+        return PRIORITIES[priority]
+    return int(priority)
+
+
+class Job:
+    """
+    A simulation queued on the service, shared by every listener that asked
+    for it.
+
+    Attributes:
+        key (str): The fingerprint of the encounter, seed and iterations.
+        description (dict): The encounter, as in a stat-block file.
+        library (dict): Actor name -> stat block.
+        iterations (int): Number of iterations.
+        seed (int): Master seed of the chunks.
+        priority (int): Lower runs first.
+        chunks (list): The number of iterations of each chunk.
+        result (SimulationResult): The merged result of the chunks done so far.
+        listeners (list): Functions called with every event of the job.
+    """
+
+    def __init__(self, key, description, library, iterations, seed, priority, chunk_size):
+        self.key = key
+        self.description = description
+        self.library = library
+        self.iterations = iterations
+        self.seed = seed
+        self.priority = priority
+        self.chunks = shard_sizes(iterations, max(1, -(-iterations//chunk_size)))
+        self.next_chunk = 0
+        self.result = SimulationResult()
+        self.listeners = []
+        self.done = False
+        self.entry = None
+
+    def __repr__(self):
+        return "Job(key={}, iterations={}, priority={})".format(self.key[:12], self.iterations, self.priority)
+
+    def emit(self, event):
+        for listener in list(self.listeners):
+            listener(event)
+
+
+class SimulationService:
+    """
+    Runs jobs on a pool of warm worker processes, taking one chunk at a time
+    from the most urgent job. Jobs of equal priority take turns.
+
+    Attributes:
+        workers (int): Number of worker processes and of chunks run at once.
+        chunk_size (int): The maximum number of iterations of a chunk.
+        jobs (dict): The jobs in flight, by key.
+    """
+
+    def __init__(self, workers=None, chunk_size=1000):
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.jobs = {}
+        self._queue = None
+        self._executor = None
+        self._dispatchers = []
+        self._sequence = itertools.count()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        """
+        Starts the worker processes and waits until they are all up.
+        """
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        await asyncio.gather(*[loop.run_in_executor(self._executor, _warm_up) for _ in range(self.workers)])
+        self._dispatchers = [asyncio.ensure_future(self._dispatch()) for _ in range(self.workers)]
+
+    async def close(self):
+        """
+        Cancels every job and stops the worker processes.
+        """
+        for dispatcher in self._dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        for job in list(self.jobs.values()):
+            self._finish(job, {"event": "cancelled"})
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def submit(self, description, listener, library=None, iterations=1000, seed=None, priority="normal"):
+        """
+        Queues a simulation, or joins the identical job already in flight.
+        A more urgent request raises the priority of the job it joins.
+
+        Args:
+            description (dict): The encounter, as in a stat-block file.
+            listener: A function called with every event of the job.
+            library (dict): Actor name -> stat block, for actors given by name.
+            iterations (int): Number of iterations.
+            seed (int): Master seed. Requests without a seed share any
+                unseeded job of the same encounter.
+            priority: A name in PRIORITIES or an integer, lower first.
+
+        Returns:
+            Job: The job the listener was added to.
+
+        Raises:
+            ValueError: If the priority, the number of iterations or the
+                encounter is invalid.
+            KeyError: If an actor is missing from the library.
+        """
+        if type(iterations) is not int or iterations < 0:
+            raise ValueError("iterations must be a non-negative integer, not {}".format(json.dumps(iterations)))
+        priority = _priority(priority)
+        if library is None:
+            library = {}
+        encounter = load_encounter(description, library)
+        key = "{}:{}".format(fingerprint(encounter, seed), iterations)
+        job = self.jobs.get(key)
+        if job is None:
+            job = Job(key, description, library, iterations, random.getrandbits(64) if seed is None else seed,
+                    priority, self.chunk_size)
+            self.jobs[key] = job
+            self._enqueue(job)
+        elif priority < job.priority:
+            job.priority = priority
+            if job.entry is not None:
+                self._enqueue(job)
+        job.listeners.append(listener)
+        listener({"event": "queued", "job": key})
+        return job
+
+    def cancel(self, job, listener):
+        """
+        Removes a listener from a job, and stops the job if it was the last.
+        """
+        if listener not in job.listeners:
+            return
+        job.listeners.remove(listener)
+        listener({"event": "cancelled"})
+        if not job.listeners and not job.done:
+            job.done = True
+            del self.jobs[job.key]
+
+    async def simulate(self, description, library=None, iterations=1000, seed=None, priority="normal",
+            progress=None):
+        """
+        Runs a simulation on the service and returns its result.
+
+        Args:
+            progress: A function called with every progress event, if given.
+
+        Returns:
+            SimulationResult: The result, or None if the job was cancelled.
+
+        Raises:
+            RuntimeError: If the simulation failed.
+        """
+        finished = asyncio.get_running_loop().create_future()
+
+        def listener(event):
+            if event["event"] == "progress" and progress is not None:
+                progress(event)
+            elif event["event"] in ("result", "cancelled", "error") and not finished.done():
+                finished.set_result(event)
+
+        job = self.submit(description, listener, library, iterations, seed, priority)
+        try:
+            event = await asyncio.shield(finished)
+        except asyncio.CancelledError:
+            self.cancel(job, listener)
+            raise
+        if event["event"] == "error":
+            raise RuntimeError(event["message"])
+        if event["event"] == "cancelled":
+            return None
+        return SimulationResult(event["wins"], event["iterations"])
+
+    def _enqueue(self, job):
+        job.entry = next(self._sequence)
+        self._queue.put_nowait((job.priority, job.entry, job))
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, entry, job = await self._queue.get()
+            if job.done or entry != job.entry:
+                continue
+            index = job.next_chunk
+            job.next_chunk += 1
+            job.entry = None
+            if job.next_chunk < len(job.chunks):
+                # requeued behind the jobs of the same priority, which take turns
+                self._enqueue(job)
+            try:
+                result = await loop.run_in_executor(self._executor, _run_chunk, job.key, job.description,
+                        job.library, job.chunks[index], shard_seed(job.seed, index))
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                if not job.done:
+                    self._finish(job, {"event": "error", "message": "{}: {}".format(type(error).__name__, error)})
+                continue
+            if job.done:
+                continue
+            job.result = job.result.merge(result)
+            job.emit({"event": "progress", "iterations": job.result.iterations, "total": job.iterations,
+                    "wins": job.result.wins, "win_rate": job.result.win_rate})
+            if job.result.iterations == job.iterations:
+                low, high = job.result.confidence_interval()
+                self._finish(job, {"event": "result", "iterations": job.result.iterations,
+                        "wins": job.result.wins, "win_rate": job.result.win_rate, "low": low, "high": high})
+
+    def _finish(self, job, event):
+        job.done = True
+        self.jobs.pop(job.key, None)
+        job.emit(event)
+        job.listeners = []
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        """
+        Returns a started asyncio server accepting JSON line requests.
+        """
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader, writer):
+        requests = {}
+
+        def send(message):
+            if not writer.is_closing():
+                writer.write((json.dumps(message) + "\n").encode())
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    send({"id": None, "event": "error", "message": "Invalid JSON: {}".format(error)})
+                    continue
+                if not isinstance(request, dict):
+                    send({"id": None, "event": "error", "message": "Invalid request: not a JSON object"})
+                    continue
+                request_id = request.get("id")
+                if request_id is not None and type(request_id) not in (str, int):
+                    send({"id": None, "event": "error", "message": "Invalid request: id must be a string or an integer"})
+                    continue
+                if request.get("cancel"):
+                    if request_id in requests:
+                        self.cancel(*requests.pop(request_id))
+                    continue
+                if request_id in requests:
+                    send({"id": request_id, "event": "error",
+                            "message": "Invalid request: id {} is already in use".format(json.dumps(request_id))})
+                    continue
+
+                def listener(event, request_id=request_id):
+                    if event["event"] in ("result", "cancelled", "error"):
+                        requests.pop(request_id, None)
+                    send(dict(event, id=request_id))
+
+                try:
+                    job = self.submit(request["encounter"], listener, request.get("actors"),
+                            request.get("iterations", 1000), request.get("seed"),
+                            request.get("priority", "normal"))
+                except (KeyError, TypeError, ValueError) as error:
+                    send({"id": request_id, "event": "error",
+                            "message": "Invalid request: {}: {}".format(type(error).__name__, error)})
+                    continue
+                requests[request_id] = (job, listener)
+                await writer.drain()
+        finally:
+            # the jobs of a client that went away are only kept for other listeners
+            for job, listener in list(requests.values()):
+                self.cancel(job, listener)
+            writer.close()
+
+
+async def run_server(host="127.0.0.1", port=8765, workers=None, chunk_size=1000):
+    """
+    Runs the service until it is interrupted.
+    """
+    async with SimulationService(workers, chunk_size) as service:
+        server = await service.serve(host, port)
+        async with server:
+            await server.serve_forever()
@@ -1,33 +1,493 @@
+import hashlib
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from statistics import NormalDist
+from time import perf_counter
+import model
+import profiling
+from events import NULL_SINK, RingBufferSink
+from stats import OutcomeStats
 from model import *
 from tqdm import tqdm
 
+# sides with at least this many actors are targeted through a TargetIndex
+TARGET_INDEX_SIZE = 8
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    """
+    Returns the Wilson score interval of a binomial proportion.
+
+    Args:
+        successes (int): Number of successes.
+        trials (int): Number of trials.
+        confidence (float): The confidence level of the interval.
+
+    Returns:
+        tuple: (low, high)
+    """
+    if trials == 0:
+        return (0, 1)
+    z = NormalDist().inv_cdf(1 - (1 - confidence)/2)
+    p = successes/trials
+    denominator = 1 + z*z/trials
+    center = (p + z*z/(2*trials))/denominator
+    half_width = z*math.sqrt(p*(1 - p)/trials + z*z/(4*trials*trials))/denominator
+    return (max(0, center - half_width), min(1, center + half_width))
+
+
+class SimulationResult:
+    """
+    The result of a Monte Carlo simulation. Results of shards of the same
+    simulation can be merged.
+
+    Attributes:
+        wins (int): Number of iterations won by the players.
+        iterations (int): Number of iterations run.
+        confidence (float): The default confidence level of its intervals.
+        profile (Profile): The counters and timers of the simulation, if it was profiled.
+        stats (OutcomeStats): The outcome statistics of the simulation, if they were collected.
+    """
+
+    def __init__(self, wins=0, iterations=0, confidence=0.95, profile=None, stats=None):
+        self.wins = wins
+        self.iterations = iterations
+        self.confidence = confidence
+        self.profile = profile
+        self.stats = stats
+
+    def __str__(self):
+        return "{}/{} wins ({:.2%})".format(self.wins, self.iterations, self.win_rate)
+
+    def __repr__(self):
+        return "SimulationResult(wins={}, iterations={})".format(self.wins, self.iterations)
+
+    def __eq__(self, other):
+        if isinstance(other, SimulationResult):
+            return self.wins == other.wins and self.iterations == other.iterations
+        return NotImplemented
+
+    @property
+    def win_rate(self):
+        """
+        The fraction of iterations won by the players.
+        """
+        if self.iterations == 0:
+            return 0
+        return self.wins/self.iterations
+
+    def confidence_interval(self, confidence=None):
+        """
+        Returns the Wilson interval of the win rate as (low, high).
+        """
+        if confidence is None:
+            confidence = self.confidence
+        return wilson_interval(self.wins, self.iterations, confidence)
+
+    def half_width(self, confidence=None):
+        """
+        Returns half the width of the Wilson interval of the win rate.
+        """
+        low, high = self.confidence_interval(confidence)
+        return (high - low)/2
+
+    def merge(self, other):
+        """
+        Returns a new result combining this result with another.
+
+        Raises:
+            ValueError: If only one of the results has outcome statistics and
+                neither is empty, since the merged statistics would only
+                describe some of the trials.
+        """
+        if (self.stats is None) != (other.stats is None) and self.iterations and other.iterations:
+            raise ValueError("Cannot merge a result with outcome statistics and one without.")
+        if self.profile is None or other.profile is None:
+            profile = self.profile or other.profile
+        else:
+            profile = self.profile.merge(other.profile)
+        if self.stats is None or other.stats is None:
+            stats = self.stats or other.stats
+        else:
+            stats = self.stats.merge(other.stats)
+        return SimulationResult(self.wins + other.wins, self.iterations + other.iterations, self.confidence,
+                profile, stats)
+
+
+def shard_seed(seed, index):
+    """
+    Derives the seed of a shard's random substream from a master seed.
+
+    Args:
+        seed (int): The master seed.
+        index (int): The index of the shard.
+    """
+    digest = hashlib.sha256("{}:{}".format(seed, index).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def shard_sizes(iterations, shards):
+    """
+    Splits a number of iterations into shards whose sizes differ by at most one.
+    """
+    return [iterations//shards + (1 if index < iterations % shards else 0)
+            for index in range(shards)]
+
+
+def _run_shard(encounter, iterations, seed=None, progress=False, trace_every=0, offset=0, profile=False,
+        stats=False):
+    """
+    Runs iterations of an encounter in the current process, seeding the
+    random module first if a seed is given.
+
+    Every trace_every-th trial, counting from offset, is recorded. If profile
+    is True, the shard's counters and timers are attached to its result, and
+    if stats is True its OutcomeStats.
+
+    Returns:
+        tuple: The SimulationResult and a list of the recorded events.
+    """
+    if seed is not None:
+        random.seed(seed)
+    if profile:
+        with profiling.profiled() as shard_profile:
+            result, traces = _run_shard(encounter, iterations, None, progress, trace_every, offset,
+                    stats=stats)
+        result.profile = shard_profile
+        return result, traces
+    wins = 0
+    traces = RingBufferSink(capacity=None)
+    dummy_encounter = encounter.copy()
+    actors = dummy_encounter.players + dummy_encounter.monsters
+    snapshots = [actor.snapshot() for actor in actors]
+    shard_stats = None
+    if stats:
+        shard_stats = OutcomeStats(dummy_encounter)
+        shard_stats.attach(dummy_encounter)
+    trials = range(offset, offset + iterations)
+    if progress:
+        trials = tqdm(trials)
+    try:
+        for trial in trials:
+            for actor, snapshot in zip(actors, snapshots):
+                actor.reset(snapshot)
+            dummy_encounter.sink = NULL_SINK
+            if trace_every and trial % trace_every == 0:
+                traces.emit({"event": "trial", "trial": trial})
+                dummy_encounter.sink = traces
+            outcome = dummy_encounter.run()
+            if outcome:
+                wins += 1
+            if shard_stats is not None:
+                shard_stats.record(dummy_encounter, outcome)
+    finally:
+        if shard_stats is not None:
+            # the attacks are shared with the encounter that was copied
+            shard_stats.detach(dummy_encounter)
+    return SimulationResult(wins, iterations, stats=shard_stats), traces.events()
+
+
+class ComparisonResult:
+    """
+    The result of simulating two variants of an encounter on common random
+    numbers, trial by trial. Results of shards of the same comparison can be
+    merged.
+
+    Attributes:
+        iterations (int): Number of paired trials.
+        wins (int): Number of trials won by the players of the first variant.
+        other_wins (int): Number of trials won by the players of the second variant.
+        only_wins (int): Number of trials won in the first variant only.
+        only_other_wins (int): Number of trials won in the second variant only.
+        confidence (float): The default confidence level of its intervals.
+    """
+
+    def __init__(self, iterations=0, wins=0, other_wins=0, only_wins=0, only_other_wins=0, confidence=0.95):
+        self.iterations = iterations
+        self.wins = wins
+        self.other_wins = other_wins
+        self.only_wins = only_wins
+        self.only_other_wins = only_other_wins
+        self.confidence = confidence
+
+    def __str__(self):
+        low, high = self.confidence_interval()
+        return "{:.2%} vs {:.2%} over {} paired trials, difference {:+.2%} ({:+.2%} to {:+.2%})".format(
+                self.win_rate, self.other_win_rate, self.iterations, self.difference, low, high)
+
+    def __repr__(self):
+        return "ComparisonResult(iterations={}, wins={}, other_wins={})".format(
+                self.iterations, self.wins, self.other_wins)
+
+    def __eq__(self, other):
+        if isinstance(other, ComparisonResult):
+            return (self.iterations, self.wins, self.other_wins, self.only_wins, self.only_other_wins) == (
+                    other.iterations, other.wins, other.other_wins, other.only_wins, other.only_other_wins)
+        return NotImplemented
+
+    @property
+    def win_rate(self):
+        """
+        The win rate of the first variant.
+        """
+        return self.wins/self.iterations if self.iterations else 0
+
+    @property
+    def other_win_rate(self):
+        """
+        The win rate of the second variant.
+        """
+        return self.other_wins/self.iterations if self.iterations else 0
+
+    @property
+    def difference(self):
+        """
+        The win rate of the first variant minus that of the second.
+        """
+        return self.win_rate - self.other_win_rate
+
+    def confidence_interval(self, confidence=None):
+        """
+        Returns the normal interval of the paired difference in win rate as
+        (low, high). Only the trials with different outcomes contribute to
+        its width.
+        """
+        if confidence is None:
+            confidence = self.confidence
+        n = self.iterations
+        if n < 2:
+            return (-1, 1)
+        difference = self.difference
+        variance = ((self.only_wins + self.only_other_wins)/n - difference*difference)*n/(n - 1)
+        z = NormalDist().inv_cdf(1 - (1 - confidence)/2)
+        half_width = z*math.sqrt(max(variance, 0)/n)
+        return (max(-1, difference - half_width), min(1, difference + half_width))
+
+    def half_width(self, confidence=None):
+        """
+        Returns half the width of the interval of the paired difference.
+        """
+        low, high = self.confidence_interval(confidence)
+        return (high - low)/2
+
+    def merge(self, other):
+        """
+        Returns a new result combining this result with another.
+        """
+        return ComparisonResult(self.iterations + other.iterations, self.wins + other.wins,
+                self.other_wins + other.other_wins, self.only_wins + other.only_wins,
+                self.only_other_wins + other.only_other_wins, self.confidence)
+
+
+def _run_paired_shard(encounter, other, seed, start, iterations):
+    """
+    Runs trials start to start + iterations of both encounters in the current
+    process, reseeding the random module with the same seed before each
+    variant of a trial.
+
+    Returns:
+        ComparisonResult: The paired outcomes.
+    """
+    result = ComparisonResult()
+    runs = []
+    for variant in (encounter, other):
+        dummy_encounter = variant.copy()
+        actors = dummy_encounter.players + dummy_encounter.monsters
+        runs.append((dummy_encounter, actors, [actor.snapshot() for actor in actors]))
+    for trial in range(start, start + iterations):
+        trial_seed = shard_seed(seed, trial)
+        outcomes = []
+        for dummy_encounter, actors, snapshots in runs:
+            random.seed(trial_seed)
+            for actor, snapshot in zip(actors, snapshots):
+                actor.reset(snapshot)
+            outcomes.append(dummy_encounter.run())
+        result = result.merge(ComparisonResult(1, int(outcomes[0]), int(outcomes[1]),
+                int(outcomes[0] and not outcomes[1]), int(outcomes[1] and not outcomes[0])))
+    return result
+
+
+class RareEventResult:
+    """
+    The result of an importance sampled simulation of an event. Results of
+    shards of the same simulation can be merged.
+
+    Attributes:
+        iterations (int): Number of trials run.
+        hits (int): Number of trials in which the event happened.
+        weight_sum (float): The sum of the likelihood ratios of those trials.
+        weight_square_sum (float): The sum of their squares.
+        confidence (float): The default confidence level of its intervals.
+    """
+
+    def __init__(self, iterations=0, hits=0, weight_sum=0, weight_square_sum=0, confidence=0.95):
+        self.iterations = iterations
+        self.hits = hits
+        self.weight_sum = weight_sum
+        self.weight_square_sum = weight_square_sum
+        self.confidence = confidence
+
+    def __str__(self):
+        return "{:.3g} ± {:.2g} over {} trials ({} hits)".format(
+                self.probability, self.standard_error(), self.iterations, self.hits)
+
+    def __repr__(self):
+        return "RareEventResult(iterations={}, hits={}, probability={})".format(
+                self.iterations, self.hits, self.probability)
+
+    def __eq__(self, other):
+        if isinstance(other, RareEventResult):
+            return (self.iterations, self.hits, self.weight_sum, self.weight_square_sum) == (
+                    other.iterations, other.hits, other.weight_sum, other.weight_square_sum)
+        return NotImplemented
+
+    @property
+    def probability(self):
+        """
+        The unbiased estimate of the probability of the event.
+        """
+        if self.iterations == 0:
+            return 0
+        return self.weight_sum/self.iterations
+
+    def variance(self):
+        """
+        Returns the estimated variance of the probability estimate.
+        """
+        n = self.iterations
+        if n < 2:
+            return float("inf")
+        probability = self.probability
+        return max(self.weight_square_sum/n - probability*probability, 0)/(n - 1)
+
+    def standard_error(self):
+        return math.sqrt(self.variance())
+
+    def confidence_interval(self, confidence=None):
+        """
+        Returns the normal interval of the probability as (low, high).
+        """
+        if confidence is None:
+            confidence = self.confidence
+        if self.iterations < 2:
+            return (0, 1)
+        z = NormalDist().inv_cdf(1 - (1 - confidence)/2)
+        half_width = z*self.standard_error()
+        return (max(0, self.probability - half_width), min(1, self.probability + half_width))
+
+    def effective_sample_size(self):
+        """
+        Returns the number of plain trials that the weighted hits are worth,
+        (sum of weights)^2/(sum of squared weights). A small value next to
+        the number of hits means the tilt is too strong.
+        """
+        if self.weight_square_sum == 0:
+            return 0
+        return self.weight_sum*self.weight_sum/self.weight_square_sum
+
+    def merge(self, other):
+        """
+        Returns a new result combining this result with another.
+        """
+        return RareEventResult(self.iterations + other.iterations, self.hits + other.hits,
+                self.weight_sum + other.weight_sum, self.weight_square_sum + other.weight_square_sum,
+                self.confidence)
+
+
+def players_lose(encounter, players_win):
+    """
+    The default event of Encounter.rare_event_simulation: the players lose.
+    """
+    return not players_win
+
+
+def _run_tilted_shard(encounter, theta, side, event, seed, start, iterations):
+    """
+    Runs trials start to start + iterations of an encounter in the current
+    process with dice tilted towards a side, seeding each trial from seed and
+    its number.
+
+    Returns:
+        RareEventResult: The weighted hits.
+    """
+    dummy_encounter = encounter.copy()
+    actors = dummy_encounter.players + dummy_encounter.monsters
+    snapshots = [actor.snapshot() for actor in actors]
+    tilt = model.DiceTilt(theta, getattr(dummy_encounter, side))
+    hits = 0
+    weight_sum = 0
+    weight_square_sum = 0
+    model.dice_tilt = tilt
+    try:
+        for trial in range(start, start + iterations):
+            random.seed(shard_seed(seed, trial))
+            for actor, snapshot in zip(actors, snapshots):
+                actor.reset(snapshot)
+            tilt.reset()
+            players_win = dummy_encounter.run()
+            if event(dummy_encounter, players_win):
+                weight = math.exp(tilt.log_weight)
+                hits += 1
+                weight_sum += weight
+                weight_square_sum += weight*weight
+    finally:
+        model.dice_tilt = None
+    return RareEventResult(iterations, hits, weight_sum, weight_square_sum)
+
 
 class Encounter:
     """
     Class for an encounter between a group of players and a group of monsters.
 
     Attributes:
-        players (list): List of players in the encounter.
-        monsters (list): List of monsters in the encounter.
+        players (list): List of players in the encounter, which may include Hordes.
+        monsters (list): List of monsters in the encounter, which may include Hordes.
+        sink: The sink that receives the events of the encounter, see events.py.
+        rounds (int): The number of rounds the last run lasted.
 
     Methods:
         __init__(self, players, monsters): Initializes the encounter.
         run(self): Runs the encounter.
     """
 
-    def __init__(self, players, monsters):
+    def __init__(self, players, monsters, sink=NULL_SINK):
         """
         Initializes the encounter.
 
         Args:
             players (list): List of players in the encounter.
             monsters (list): List of monsters in the encounter.
+            sink: The sink that receives the events of the encounter.
         """
         self.players = players
         self.monsters = monsters
+        self.sink = sink
         self.initiative_order = []
+        self.rounds = 0
+        self._targets_cache = {}
+
+    def copy(self):
+        """
+        Returns an encounter between copies of the actors, which share their
+        definitions with the originals but have their own state.
+        """
+        return Encounter([player.copy() for player in self.players],
+                [monster.copy() for monster in self.monsters], self.sink)
 
     def run(self):
+        """
+        Runs the encounter, emitting its events to the encounter's sink.
+
+        Returns:
+            bool: True if the players win.
+        """
+        sink = self.sink
+        profile = profiling.active
+        if profile is not None:
+            profile.trials += 1
+            start = perf_counter()
+        self.initiative_order = []
         for player in self.players:
             initiative = player.roll_initiative()
             self.initiative_order.append((initiative, player))
@@ -36,22 +496,26 @@ class Encounter:
             self.initiative_order.append((initiative, monster))
 
         self.initiative_order.sort(key=lambda x: x[0], reverse=True)
+        if profile is not None:
+            profile.initiative_time += perf_counter() - start
+        if sink.enabled:
+            for initiative, entity in self.initiative_order:
+                sink.emit({"event": "initiative", "actor": entity.name, "initiative": initiative})
+
+        player_targets = self._targets(self.players)
+        monster_targets = self._targets(self.monsters)
+        player_ids = set(id(player) for player in self.players)
+        turns = [(entity, monster_targets if id(entity) in player_ids else player_targets)
+                for initiative, entity in self.initiative_order]
 
         round_number = 1
         while True:
-            print("----- ROUND {} -----".format(round_number))
-
-            for actor in self.players + self.monsters:
-                print("{} is at distance {} with mobility {}".format(actor.name, actor.distance, actor.mobility))
-
-
-            for initiative, entity in self.initiative_order:
-                print("-- {}'s turn: --".format(entity.name))
-                if entity in self.players:
-                    entity.perform_turn(self.monsters)
-                else:
-                    entity.perform_turn(self.players)
+            for entity, targets in turns:
+                entity.perform_turn(targets, sink)
 
+            if profile is not None:
+                profile.rounds += 1
+                start = perf_counter()
             player_alive = False
             for player in self.players:
                 player_alive = player_alive or player.alive
@@ -59,42 +523,361 @@ class Encounter:
             monster_alive = False
             for monster in self.monsters:
                 monster_alive = monster_alive or monster.alive
+            if profile is not None:
+                profile.win_check_time += perf_counter() - start
+
+            if sink.enabled:
+                sink.emit({"event": "round_end", "round": round_number,
+                    "hp": {actor.name: actor.hp_current for actor in self.players + self.monsters}})
 
-            if not player_alive:
-                print("Players lose")
-                for actor in self.players + self.monsters:
-                    print("{}'s HP: {}".format(actor.name, actor.hp_current))
-                return False
-            elif not monster_alive:
-                print("Monsters lose")
-                for actor in self.players + self.monsters:
-                    print("{}'s HP: {}".format(actor.name, actor.hp_current))
-                return True
+            if not player_alive or not monster_alive:
+                self.rounds = round_number
+                if sink.enabled:
+                    sink.emit({"event": "end", "round": round_number, "players_win": player_alive})
+                return player_alive
 
             round_number += 1
 
-    def monte_carlo_simulation(self, iterations=100):
+    def _targets(self, actors):
+        """
+        Returns the targets of one side for a run: the actors, with hordes
+        replaced by their members, or for large sides a TargetIndex of them.
+        Both are kept between runs, and the index is refreshed from the
+        actors' current state.
+        """
+        entry = self._targets_cache.get(id(actors))
+        if entry is None or entry[0] != actors:
+            targets = expand_hordes(actors)
+            index = TargetIndex(targets) if len(targets) >= TARGET_INDEX_SIZE else None
+            # the copy of the list detects changes to it and keeps its id from being reused
+            entry = (list(actors), targets, index, actors)
+            self._targets_cache[id(actors)] = entry
+        targets, index = entry[1], entry[2]
+        if index is None:
+            return targets
+        index.refresh()
+        return index
+
+    def monte_carlo_simulation(self, iterations=100, workers=1, seed=None, trace_sink=None, trace_every=0,
+            target_half_width=None, confidence=0.95, batch_size=200, progress=True, profile=False, stats=False,
+            checkpoint=None, checkpoint_every=60):
         """
         Runs a Monte Carlo simulation of the encounter.
 
+        With more than one worker the iterations are split into one shard per
+        worker and run on a process pool. Each shard seeds its own random
+        substream from the master seed, so for a given seed and number of
+        workers the result is always the same.
+
+        If target_half_width is given, iterations is a maximum budget instead:
+        the simulation runs in batches and stops as soon as the Wilson interval
+        of the win rate is no wider than target_half_width on either side.
+
+        If checkpoint is given, the simulation also runs in batches, and its
+        counters and statistics are saved to the checkpoint file every
+        checkpoint_every seconds and at the end. If the file exists, the
+        simulation resumes from it with its batch size, see checkpoint.py.
+
         Args:
             iterations (int): Number of iterations to run.
+            workers (int): Number of worker processes, or None for one per core.
+            seed (int): Master seed. If None, the run is not reproducible.
+            trace_sink: A sink that receives the events of sampled trials.
+            trace_every (int): Record every trace_every-th trial to trace_sink.
+            target_half_width (float): The precision to stop at.
+            confidence (float): The confidence level of the interval.
+            batch_size (int): Number of iterations between precision checks.
+            progress (bool): Whether to show a progress bar.
+            profile (bool): Whether to count and time the hot paths, see
+                profiling.py. The Profile is returned in the result.
+            stats (bool): Whether to collect the OutcomeStats of the trials,
+                see stats.py. They are returned in the result.
+            checkpoint (str): The path of the checkpoint file.
+            checkpoint_every (float): Seconds between checkpoints.
 
         Returns:
-            int: Number of wins.
+            SimulationResult: The merged result of all shards.
+
+        Raises:
+            ValueError: If the checkpoint file is of another encounter or seed.
         """
-        wins = 0
+        if workers is None:
+            workers = os.cpu_count()
+        if trace_sink is None:
+            trace_every = 0
+        if target_half_width is None and checkpoint is None:
+            result = self._simulate(iterations, workers, seed, trace_sink, trace_every, progress=progress,
+                    profile=profile, stats=stats)
+            result.confidence = confidence
+            return result
 
-        for _ in tqdm(range(iterations)):
-            dummy_players = [player.copy() for player in self.players]
-            dummy_monsters = [monster.copy() for monster in self.monsters]
-            encounter = Encounter(dummy_players, dummy_monsters)
-            outcome = encounter.run()
-            if outcome:
-                wins += 1
-        return wins/iterations
-        
+        state = None
+        if checkpoint is not None:
+            from checkpoint import Checkpoint
+            if os.path.exists(checkpoint):
+                state = Checkpoint.load(checkpoint)
+                state.check(self, seed, stats)
+                state.result.confidence = confidence
+            else:
+                if seed is None:
+                    seed = random.getrandbits(64)
+                state = Checkpoint.start(self, seed, batch_size, SimulationResult(confidence=confidence,
+                        stats=OutcomeStats(self) if stats else None))
+            saved = perf_counter()
+
+        result = SimulationResult(confidence=confidence) if state is None else state.result
+        batches = self.iter_monte_carlo(iterations, workers, seed, trace_sink, trace_every, confidence,
+                batch_size, profile, stats, resume=state)
+        try:
+            with tqdm(total=iterations, initial=result.iterations, disable=not progress) as bar:
+                for batch_result in batches:
+                    bar.update(batch_result.iterations - result.iterations)
+                    result = batch_result
+                    if state is not None:
+                        state.batches += 1
+                        state.result = result
+                        if perf_counter() - saved >= checkpoint_every:
+                            state.save(checkpoint)
+                            saved = perf_counter()
+                    if target_half_width is not None and result.half_width() <= target_half_width:
+                        break
+        finally:
+            batches.close()
+            if state is not None:
+                state.save(checkpoint)
+        return result
+
+    def iter_monte_carlo(self, iterations=100, workers=1, seed=None, trace_sink=None, trace_every=0,
+            confidence=0.95, batch_size=200, profile=False, stats=False, resume=None):
+        """
+        Runs a Monte Carlo simulation of the encounter in batches, yielding
+        the running result after every batch. Stopping the iteration stops
+        the simulation.
 
+        Every batch seeds its shards from the master seed and the batch
+        number, so for a given seed, number of workers and batch size the
+        running results are always the same.
 
+        Args:
+            iterations (int): Total number of iterations to run.
+            workers (int): Number of worker processes, or None for one per core.
+            seed (int): Master seed. If None, the run is not reproducible.
+            trace_sink: A sink that receives the events of sampled trials.
+            trace_every (int): Record every trace_every-th trial to trace_sink.
+            confidence (float): The confidence level of the interval.
+            batch_size (int): Number of iterations per batch.
+            profile (bool): Whether to count and time the hot paths.
+            stats (bool): Whether to collect the OutcomeStats of the trials.
+            resume (Checkpoint): A checkpoint to continue from, whose seed
+                and batch size replace the master seed and batch_size, see
+                checkpoint.py.
+
+        Yields:
+            SimulationResult: The merged result of the batches run so far.
+        """
+        if workers is None:
+            workers = os.cpu_count()
+        if trace_sink is None:
+            trace_every = 0
+        result = SimulationResult(confidence=confidence)
+        batch = 0
+        if resume is not None:
+            seed = resume.seed
+            batch_size = resume.batch_size
+            result = resume.result
+            batch = resume.batches
+        if seed is None:
+            seed = random.getrandbits(64)
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while result.iterations < iterations:
+                size = min(batch_size, iterations - result.iterations)
+                result = result.merge(self._simulate(size, workers, shard_seed(seed, "batch" + str(batch)),
+                        trace_sink, trace_every, offset=result.iterations, executor=executor,
+                        profile=profile, stats=stats))
+                batch += 1
+                yield result
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _simulate(self, iterations, workers, seed, trace_sink, trace_every, offset=0, progress=False,
+            executor=None, profile=False, stats=False):
+        """
+        Runs a fixed number of iterations, sharded across workers.
+        """
+        workers = max(1, min(workers, iterations))
+        if workers == 1:
+            shards = [_run_shard(self, iterations, None if seed is None else shard_seed(seed, 0),
+                    progress, trace_every, offset, profile, stats)]
+        else:
+            if seed is None:
+                seed = random.getrandbits(64)
+            sizes = shard_sizes(iterations, workers)
+            shards = [None]*workers
+            own_executor = executor is None
+            if own_executor:
+                executor = ProcessPoolExecutor(max_workers=workers)
+            try:
+                futures = {executor.submit(_run_shard, self, size, shard_seed(seed, index),
+                        trace_every=trace_every, offset=offset + sum(sizes[:index]), profile=profile,
+                        stats=stats): index
+                        for index, size in enumerate(sizes)}
+                completed = as_completed(futures)
+                if progress:
+                    completed = tqdm(completed, total=workers)
+                for future in completed:
+                    shards[futures[future]] = future.result()
+            finally:
+                if own_executor:
+                    executor.shutdown()
+
+        result = SimulationResult()
+        for shard_result, traces in shards:
+            result = result.merge(shard_result)
+            for event in traces:
+                trace_sink.emit(event)
+        return result
+
+    def compare(self, other, iterations=1000, workers=1, seed=None, confidence=0.95, progress=True):
+        """
+        Compares the win rate of this encounter with that of a variant, using
+        common random numbers: both are run on the same random stream in
+        every trial, so the same rolls fall on the same dice as long as the
+        variants roll alike, and the difference in win rate is estimated with
+        far less noise than from two independent simulations.
+
+        Every trial seeds its stream from the master seed and its number, so
+        for a given seed the result does not depend on the number of workers.
+
+        Args:
+            other (Encounter): The variant to compare with.
+            iterations (int): Number of paired trials.
+            workers (int): Number of worker processes, or None for one per core.
+            seed (int): Master seed. If None, the run is not reproducible.
+            confidence (float): The confidence level of the interval.
+            progress (bool): Whether to show a progress bar.
+
+        Returns:
+            ComparisonResult: The paired outcomes.
+        """
+        if workers is None:
+            workers = os.cpu_count()
+        if seed is None:
+            seed = random.getrandbits(64)
+        workers = max(1, min(workers, iterations))
+        sizes = shard_sizes(iterations, workers)
+        starts = [sum(sizes[:index]) for index in range(workers)]
+        result = ComparisonResult(confidence=confidence)
+        if workers == 1:
+            result = result.merge(_run_paired_shard(self, other, seed, 0, iterations))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_run_paired_shard, self, other, seed, start, size)
+                        for start, size in zip(starts, sizes)]
+                for future in tqdm(as_completed(futures), total=workers, disable=not progress):
+                    result = result.merge(future.result())
+        return result
+
+    def rare_event_simulation(self, theta, iterations=10000, workers=1, seed=None, side="monsters", event=None,
+            confidence=0.95, progress=True):
+        """
+        Estimates the probability of a rare event, by default that the
+        players lose, by importance sampling: the dice of one side's attacks
+        are tilted up by theta and those of the other side down (see
+        model.DiceTilt), which makes the event common, and every trial in
+        which it happens is weighted by its likelihood ratio, which keeps the
+        estimate unbiased.
 
+        A good theta makes the event happen in a sizeable fraction of the
+        trials without the weights varying wildly; try a few values on a
+        small budget and keep the one with the smallest standard error.
+        theta=0 is a plain Monte Carlo simulation.
 
+        Every trial seeds its stream from the master seed and its number, so
+        for a given seed the result does not depend on the number of workers.
+
+        Args:
+            theta (float): The tilt of the favoured side's dice.
+            iterations (int): Number of trials.
+            workers (int): Number of worker processes, or None for one per core.
+            seed (int): Master seed. If None, the run is not reproducible.
+            side (str): The side the event favours, "players" or "monsters".
+            event: A function of the encounter at the end of a trial and
+                whether the players won, returning whether the event
+                happened. It must be picklable to use several workers.
+            confidence (float): The confidence level of the interval.
+            progress (bool): Whether to show a progress bar.
+
+        Returns:
+            RareEventResult: The weighted hits.
+
+        Raises:
+            ValueError: If side is unknown or the encounter has a Horde,
+                whose bulk dice cannot be tilted.
+        """
+        if side not in ("players", "monsters"):
+            raise ValueError("side must be \"players\" or \"monsters\".")
+        if any(isinstance(actor, Horde) for actor in self.players + self.monsters):
+            raise ValueError("Hordes draw their dice in bulk and cannot be importance sampled.")
+        if event is None:
+            event = players_lose
+        if workers is None:
+            workers = os.cpu_count()
+        if seed is None:
+            seed = random.getrandbits(64)
+        workers = max(1, min(workers, iterations))
+        sizes = shard_sizes(iterations, workers)
+        starts = [sum(sizes[:index]) for index in range(workers)]
+        result = RareEventResult(confidence=confidence)
+        if workers == 1:
+            result = result.merge(_run_tilted_shard(self, theta, side, event, seed, 0, iterations))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_run_tilted_shard, self, theta, side, event, seed, start, size)
+                        for start, size in zip(starts, sizes)]
+                for future in tqdm(as_completed(futures), total=workers, disable=not progress):
+                    result = result.merge(future.result())
+        return result
+
+    def run_batch(self, trials, seed=None, batch_size=100000):
+        """
+        Simulates the encounter with the vectorized NumPy engine, which runs
+        all trials at once instead of one after another. Requires NumPy.
+
+        Args:
+            trials (int): Number of trials to run.
+            seed (int): Seed for the NumPy random generator.
+            batch_size (int): Maximum number of trials held in memory at once.
+
+        Returns:
+            SimulationResult: The number of trials won by the players.
+
+        Raises:
+            ValueError: If the encounter has a Horde or an actor with a turn policy.
+        """
+        from batch import BatchEncounter
+        return BatchEncounter(self).run(trials, seed, batch_size)
+
+    def solve_exact(self, epsilon=1e-12, max_rounds=100):
+        """
+        Computes the outcome distribution of the encounter exactly instead of
+        sampling it, by propagating probability mass over the states of the
+        actors turn by turn. The number of states grows with the hp and the
+        number of actors, so this is meant for duels and small skirmishes,
+        which take from a fraction of a second to a few seconds, see ExactSolver.
+
+        Args:
+            epsilon (float): States whose probability falls below epsilon are
+                dropped and counted as unresolved. 0 keeps every state.
+            max_rounds (int): The number of rounds to solve.
+
+        Returns:
+            ExactSolution: The win and loss probabilities and the distribution
+                of the number of rounds.
+
+        Raises:
+            ValueError: If an actor cannot be solved exactly, see ExactSolver.
+        """
+        from exact import ExactSolver
+        return ExactSolver(self).solve(epsilon, max_rounds)
@@ -0,0 +1,245 @@
+"""
+A JSON stat-block format for actors and encounters, and a batch runner.
+
+A stat-block file holds a library of actors and a list of encounters:
+
+    {
+        "actors": {
+            "Goblin": {
+                "hp": 7, "ac": 15, "distance": 30,
+                "attacks": {"Scimitar": {"damage": [["slashing", "1d6+2"]], "attack_bonus": 4, "range": 5}},
+                "multiattacks": [{"name": "Scimitar", "attacks": ["Scimitar"]}]
+            },
+            ...
+        },
+        "encounters": [
+            {"name": "Ambush", "players": ["Fighter", "Wizard"],
+             "monsters": [{"actor": "Goblin", "count": 4}], "iterations": 1000}
+        ]
+    }
+
+Dice are written as "2d6+4" or "1d8+3d6+5". An attack has damage, a range,
+and an attack_bonus or a save_dc and save_ability. Actors in an encounter
+are names from the library, {"actor": name, "count": n} for n numbered
+copies, or inline actor definitions. Actors without multiattacks get one
+per attack.
+"""
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from model import *
+from simulation import Encounter, shard_seed
+
+_DICE_TERM = re.compile(r"\s*([+-])?\s*(?:(\d*)d(\d+)|(\d+))\s*")
+
+
+def parse_dice(text):
+    """
+    Parses dice notation such as "2d6+4" or "1d8+3d6-1" into a DiceRoll.
+
+    Raises:
+        ValueError: If the text is not dice notation.
+    """
+    dice = []
+    modifier = 0
+    position = 0
+    text = str(text)
+    while position < len(text):
+        match = _DICE_TERM.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError("Invalid dice: " + text)
+        sign, count, sides, constant = match.groups()
+        if position > 0 and sign is None:
+            raise ValueError("Invalid dice: " + text)
+        if constant is not None:
+            modifier += -int(constant) if sign == "-" else int(constant)
+        elif sign == "-":
+            raise ValueError("Dice cannot be subtracted: " + text)
+        else:
+            dice += [int(sides)]*int(count or 1)
+        position = match.end()
+    return DiceRoll(dice, modifier)
+
+
+def load_attack(name, data, actor):
+    """
+    Builds an Attack from its stat block.
+    """
+    attack_roll = data.get("attack_bonus")
+    if "attack_roll" in data:
+        attack_roll = parse_dice(data["attack_roll"])
+    return Attack(name, [(damage_type, parse_dice(dice)) for damage_type, dice in data["damage"]], actor,
+            attack_roll = attack_roll,
+            save_dc = data.get("save_dc"),
+            save_ability = data.get("save_ability"),
+            attack_range = data.get("range", 0),
+            advantage = data.get("advantage", 0))
+
+
+def load_actor(name, data):
+    """
+    Builds an Actor, with its attacks and multiattacks, from its stat block.
+    """
+    saves = None
+    if "saves" in data:
+        saves = {ability: DiceRoll([20], 0) for ability in ABILITY_SCORES}
+        saves.update({ability: parse_dice(dice) for ability, dice in data["saves"].items()})
+    actor = Actor(name, data["hp"], data["ac"],
+            resistances = data.get("resistances", []),
+            vulnerabilities = data.get("vulnerabilities", []),
+            initiative = data.get("initiative", 0),
+            distance = data.get("distance", 0),
+            speed = data.get("speed", 30),
+            saves = saves,
+            targeting_simulations = data.get("targeting_simulations"))
+    attacks = {attack_name: load_attack(attack_name, attack_data, actor)
+            for attack_name, attack_data in data.get("attacks", {}).items()}
+    if "multiattacks" in data:
+        actor.attacks = [Multiattack(multiattack["name"], [attacks[attack_name] for attack_name in multiattack["attacks"]],
+                float("inf") if multiattack.get("uses") is None else multiattack["uses"])
+                for multiattack in data["multiattacks"]]
+    else:
+        actor.attacks = list(attacks.values())
+    return actor
+
+
+def _load_side(entries, library):
+    actors = []
+    for entry in entries:
+        if isinstance(entry, str):
+            actors.append(load_actor(entry, library[entry]))
+        elif "actor" in entry:
+            count = entry.get("count", 1)
+            for index in range(count):
+                name = entry["actor"] if count == 1 else "{} {}".format(entry["actor"], index + 1)
+                actors.append(load_actor(name, library[entry["actor"]]))
+        else:
+            actors.append(load_actor(entry["name"], entry))
+    return actors
+
+
+def load_encounter(data, library=None):
+    """
+    Builds an Encounter from its description in a stat-block file.
+
+    Args:
+        data (dict): The encounter.
+        library (dict): Actor name -> stat block, for actors given by name.
+    """
+    if library is None:
+        library = {}
+    return Encounter(_load_side(data["players"], library), _load_side(data["monsters"], library))
+
+
+class StatBlockFile:
+    """
+    A parsed stat-block file. Encounters are built on demand from the
+    parsed JSON, which is much cheaper than parsing the file again.
+
+    Attributes:
+        path (str): The path of the file.
+        actors (dict): Actor name -> stat block.
+        encounters (list): The encounter descriptions, in file order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path) as file:
+            data = json.load(file)
+        self.actors = data.get("actors", {})
+        self.encounters = data.get("encounters", [])
+        self._index = {}
+        for index, encounter in enumerate(self.encounters):
+            self._index[encounter.get("name", str(index))] = index
+
+    def names(self):
+        """
+        Returns the names of the encounters, in file order.
+        """
+        return list(self._index)
+
+    def description(self, name):
+        return self.encounters[self._index[name]]
+
+    def encounter(self, name):
+        """
+        Builds the encounter with the given name.
+        """
+        return load_encounter(self.description(name), self.actors)
+
+
+def load(path):
+    """
+    Returns a dict of name -> Encounter of every encounter in a stat-block file.
+    """
+    stat_blocks = StatBlockFile(path)
+    return {name: stat_blocks.encounter(name) for name in stat_blocks.names()}
+
+
+# stat-block files parsed by the current worker process, by path
+_FILES = {}
+
+
+def _file(path):
+    stat_blocks = _FILES.get(path)
+    if stat_blocks is None:
+        stat_blocks = StatBlockFile(path)
+        _FILES[path] = stat_blocks
+    return stat_blocks
+
+
+def _run_job(path, name, iterations, seed):
+    """
+    Runs one encounter of a stat-block file, in a worker process that keeps
+    the parsed file between jobs.
+
+    Returns:
+        dict: The JSONL record of the encounter.
+    """
+    start = time.perf_counter()
+    result = _file(path).encounter(name).monte_carlo_simulation(iterations, seed=seed, progress=False)
+    low, high = result.confidence_interval()
+    return {"file": path, "encounter": name, "wins": result.wins, "iterations": result.iterations,
+            "win_rate": result.win_rate, "low": low, "high": high, "seed": seed,
+            "seconds": time.perf_counter() - start}
+
+
+def run_batch(paths, output=sys.stdout, workers=None, iterations=1000, seed=0):
+    """
+    Runs every encounter of some stat-block files on a pool of worker
+    processes, writing one JSON line per encounter to output as soon as it
+    finishes. Each worker parses each file at most once.
+
+    An encounter's own "iterations" and "seed" override the defaults; by
+    default an encounter is seeded from seed and its file and name, so its
+    result does not depend on the order in which the encounters finish.
+
+    Args:
+        paths (list): The stat-block files.
+        output: A text file to write the results to.
+        workers (int): Number of worker processes, or None for one per core.
+        iterations (int): The default number of iterations per encounter.
+        seed (int): The master seed.
+
+    Returns:
+        int: The number of encounters run.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    jobs = []
+    for path in paths:
+        stat_blocks = StatBlockFile(path)
+        for name in stat_blocks.names():
+            description = stat_blocks.description(name)
+            jobs.append((path, name, description.get("iterations", iterations),
+                    description.get("seed", shard_seed(seed, path + ":" + name))))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_job, *job) for job in jobs]
+        for future in as_completed(futures):
+            output.write(json.dumps(future.result()) + "\n")
+            output.flush()
+    return len(jobs)
@@ -0,0 +1,227 @@
+"""
+Outcome statistics collected while running Monte Carlo simulations.
+
+Everything is kept in fixed-size histograms, so memory does not grow with
+the number of trials, and statistics of shards of the same simulation can be
+merged:
+
+    result = encounter.monte_carlo_simulation(iterations=10**6, stats=True)
+    print(result.stats.rounds.mean(), result.stats.deaths)
+"""
+from array import array
+
+
+class Histogram:
+    """
+    A histogram of values over a fixed range of integer bins. Values are
+    binned by their integer part and values outside the range are counted in
+    the first or last bin, while the total and sum stay exact.
+
+    Attributes:
+        low (int): The value of the first bin.
+        high (int): The value of the last bin.
+        counts (array): The count of each bin.
+        total (int): The number of values added.
+        sum (float): The sum of the values added.
+    """
+    __slots__ = ("low", "high", "counts", "total", "sum")
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.counts = array("q", [0])*(high - low + 1)
+        self.total = 0
+        self.sum = 0
+
+    def __repr__(self):
+        return "Histogram(low={}, high={}, total={})".format(self.low, self.high, self.total)
+
+    def __eq__(self, other):
+        if isinstance(other, Histogram):
+            return (self.low == other.low and self.high == other.high and self.counts == other.counts
+                    and self.sum == other.sum)
+        return NotImplemented
+
+    def add(self, value):
+        """
+        Adds a value to the histogram.
+        """
+        index = int(value) - self.low
+        if index < 0:
+            index = 0
+        elif index > self.high - self.low:
+            index = self.high - self.low
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+
+    def merge(self, other):
+        """
+        Returns a new histogram adding up this histogram and another over the same range.
+        """
+        if self.low != other.low or self.high != other.high:
+            raise ValueError("Cannot merge histograms over different ranges.")
+        histogram = Histogram(self.low, self.high)
+        histogram.counts = array("q", map(sum, zip(self.counts, other.counts)))
+        histogram.total = self.total + other.total
+        histogram.sum = self.sum + other.sum
+        return histogram
+
+    def mean(self):
+        """
+        Returns the exact mean of the values added.
+        """
+        if self.total == 0:
+            return 0
+        return self.sum/self.total
+
+    def percentile(self, percent):
+        """
+        Returns the smallest bin that at least the given percentage of the
+        values fall in or below.
+
+        Args:
+            percent (float): The percentile, between 0 and 100.
+        """
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be between 0 and 100.")
+        threshold = percent*self.total/100
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= threshold:
+                return self.low + index
+        return self.high
+
+    def as_dict(self):
+        """
+        Returns the non-empty bins as a dict of value -> count.
+        """
+        return {self.low + index: count for index, count in enumerate(self.counts) if count}
+
+
+class OutcomeStats:
+    """
+    Statistics of the trials of an encounter.
+
+    Attributes:
+        trials (int): Number of trials recorded.
+        wins (int): Number of trials won by the players.
+        rounds (Histogram): Number of rounds of each trial.
+        hp (dict): Actor name -> Histogram of the actor's hp at the end of each trial.
+        deaths (dict): Actor name -> number of trials in which the actor died.
+        damage (dict): "<actor>: <attack>" -> Histogram of the hp taken by
+            every attack that was in range, over all targets.
+    """
+
+    def __init__(self, encounter=None, max_rounds=100):
+        """
+        Initializes empty statistics.
+
+        Args:
+            encounter (Encounter): The encounter whose actors and attacks
+                are tracked. If None, the statistics start without any.
+            max_rounds (int): The last bin of the rounds histogram.
+        """
+        self.trials = 0
+        self.wins = 0
+        self.rounds = Histogram(1, max_rounds)
+        self.hp = {}
+        self.deaths = {}
+        self.damage = {}
+        if encounter is None:
+            return
+        for actor in encounter.players + encounter.monsters:
+            self.hp[actor.name] = Histogram(0, int(actor.hp_max))
+            self.deaths[actor.name] = 0
+            for plan in _plans(actor):
+                key = _damage_key(actor, plan)
+                if key not in self.damage:
+                    self.damage[key] = Histogram(0, 2*_maximum_damage(plan))
+
+    def __repr__(self):
+        return "OutcomeStats(trials={}, wins={})".format(self.trials, self.wins)
+
+    @property
+    def win_rate(self):
+        """
+        The fraction of trials won by the players.
+        """
+        if self.trials == 0:
+            return 0
+        return self.wins/self.trials
+
+    def attach(self, encounter):
+        """
+        Makes the actors of the encounter record the damage of their attacks
+        into these statistics until detach is called. The histograms are set
+        on the actors rather than on the attack plans, which copies of an
+        actor share.
+        """
+        for actor in encounter.players + encounter.monsters:
+            actor.damage_histograms = {plan: self.damage[_damage_key(actor, plan)] for plan in _plans(actor)}
+
+    def detach(self, encounter):
+        """
+        Stops the actors of the encounter from recording their damage.
+        """
+        for actor in encounter.players + encounter.monsters:
+            actor.damage_histograms = None
+
+    def record(self, encounter, players_win):
+        """
+        Records the outcome of a trial that was just run.
+
+        Args:
+            encounter (Encounter): The encounter, in its state at the end of the trial.
+            players_win (bool): Whether the players won.
+        """
+        self.trials += 1
+        if players_win:
+            self.wins += 1
+        self.rounds.add(encounter.rounds)
+        for actor in encounter.players + encounter.monsters:
+            self.hp[actor.name].add(actor.hp_current)
+            if not actor.alive:
+                self.deaths[actor.name] += 1
+
+    def merge(self, other):
+        """
+        Returns new statistics adding up these statistics and others.
+        """
+        stats = OutcomeStats(max_rounds=self.rounds.high)
+        stats.trials = self.trials + other.trials
+        stats.wins = self.wins + other.wins
+        stats.rounds = self.rounds.merge(other.rounds)
+        stats.hp = _merge_histograms(self.hp, other.hp)
+        stats.damage = _merge_histograms(self.damage, other.damage)
+        stats.deaths = dict(self.deaths)
+        for name, deaths in other.deaths.items():
+            stats.deaths[name] = stats.deaths.get(name, 0) + deaths
+        return stats
+
+
+def _plans(actor):
+    for multiattack in actor.attacks:
+        for plan in multiattack.plan().plans:
+            yield plan
+
+
+def _damage_key(actor, plan):
+    return "{}: {}".format(actor.name, plan.attack.name)
+
+
+def _maximum_damage(plan):
+    """
+    Returns the maximum damage of an attack on a critical hit, before
+    vulnerabilities.
+    """
+    return int(sum(sides*count for groups in plan.critical_groups for sides, count in groups)
+            + sum(plan.damage_modifiers))
+
+
+def _merge_histograms(first, second):
+    merged = dict(first)
+    for key, histogram in second.items():
+        merged[key] = merged[key].merge(histogram) if key in merged else histogram
+    return merged
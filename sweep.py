@@ -0,0 +1,217 @@
+"""
+Parameter sweeps over variants of an encounter.
+
+A sweep runs a Monte Carlo simulation for every combination of values of its
+axes and returns one row per combination:
+
+    sweep = Sweep(encounter, {"Rot-Troll.ac": range(14, 21), "Ipqi.attack_bonus": range(3, 10)})
+    for row in sweep.run(iterations=1000, workers=4, seed=1):
+        print(row)
+
+A parameter is named "<actor name>.<attribute>". Actor parameters are set on
+a copy of the actor, so variants share everything else with the base
+encounter, and "<actor name>.count" replaces the actor by that many copies
+of it, numbered if there are several. Attack parameters apply to every attack of the actor; the varied
+attacks are built once per value and shared by all the cells using that
+value, so their compiled plans and exact damage distributions are reused.
+"""
+import copy
+import csv
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from model import *
+from simulation import Encounter, shard_seed, shard_sizes
+from tqdm import tqdm
+
+ACTOR_PARAMETERS = ("hp_max", "ac", "initiative", "speed", "distance", "targeting_simulations")
+ATTACK_PARAMETERS = ("attack_bonus", "save_dc")
+COUNT_PARAMETER = "count"
+
+
+class Sweep:
+    """
+    A sweep of an encounter over parameter axes.
+
+    Attributes:
+        encounter (Encounter): The base encounter, which is never changed.
+        axes (dict): Parameter name -> list of values. The last axis varies fastest.
+    """
+
+    def __init__(self, encounter, axes):
+        """
+        Initializes the sweep.
+
+        Args:
+            encounter (Encounter): The base encounter.
+            axes (dict): Parameter name -> iterable of values.
+
+        Raises:
+            ValueError: If a parameter names an unknown actor or attribute.
+        """
+        self.encounter = encounter
+        self.axes = {parameter: list(values) for parameter, values in axes.items()}
+        actors = {actor.name: actor for actor in encounter.players + encounter.monsters}
+        self._parameters = {}
+        for parameter in self.axes:
+            name, _, attribute = parameter.rpartition(".")
+            if name not in actors:
+                raise ValueError("Unknown actor in parameter: " + parameter)
+            if attribute not in ACTOR_PARAMETERS + ATTACK_PARAMETERS + (COUNT_PARAMETER,):
+                raise ValueError("Unknown attribute in parameter: " + parameter)
+            self._parameters[parameter] = (name, attribute)
+        self._attacks = {}
+        self._multiattacks = {}
+
+    def cells(self):
+        """
+        Returns every combination of values as a list of dicts of parameter -> value.
+        """
+        return [dict(zip(self.axes, values)) for values in product(*self.axes.values())]
+
+    def variant(self, cell):
+        """
+        Returns the encounter with the values of a cell applied.
+
+        Args:
+            cell (dict): Parameter name -> value.
+        """
+        overrides = {}
+        for parameter, value in cell.items():
+            name, attribute = self._parameters[parameter]
+            overrides.setdefault(name, {})[attribute] = value
+        return Encounter(self._variant_actors(self.encounter.players, overrides),
+                self._variant_actors(self.encounter.monsters, overrides), self.encounter.sink)
+
+    def _variant_actors(self, actors, overrides):
+        variants = []
+        for actor in actors:
+            actor_overrides = dict(overrides.get(actor.name, {}))
+            count = actor_overrides.pop(COUNT_PARAMETER, 1)
+            variant = self._variant_actor(actor, actor_overrides)
+            if count == 1:
+                variants.append(variant)
+                continue
+            for index in range(count):
+                numbered = variant.copy()
+                numbered.name = "{} {}".format(actor.name, index + 1)
+                variants.append(numbered)
+        return variants
+
+    def _variant_actor(self, actor, overrides):
+        variant = actor.copy()
+        if not overrides:
+            return variant
+        attack_overrides = []
+        for attribute, value in overrides.items():
+            if attribute in ATTACK_PARAMETERS:
+                attack_overrides.append((attribute, value))
+            else:
+                setattr(variant, attribute, value)
+                if attribute == "hp_max":
+                    variant.hp_current = value
+        if attack_overrides:
+            attack_overrides = tuple(sorted(attack_overrides))
+            variant.attacks = [self._variant_multiattack(multiattack, attack_overrides)
+                    for multiattack in actor.attacks]
+        return variant
+
+    def _variant_multiattack(self, multiattack, overrides):
+        key = (id(multiattack), overrides)
+        entry = self._multiattacks.get(key)
+        if entry is None:
+            variant = Multiattack(multiattack.name,
+                    [self._variant_attack(attack, overrides) for attack in multiattack.attacks],
+                    multiattack.uses)
+            # keep the original alive so that its id is not reused
+            entry = (variant, multiattack)
+            self._multiattacks[key] = entry
+        return entry[0]
+
+    def _variant_attack(self, attack, overrides):
+        key = (id(attack), overrides)
+        entry = self._attacks.get(key)
+        if entry is None:
+            variant = copy.copy(attack)
+            for attribute, value in overrides:
+                if attribute == "attack_bonus" and attack.attack_roll is not None:
+                    variant.attack_roll = DiceRoll(attack.attack_roll.dice, value)
+                elif attribute == "save_dc" and attack.save_dc is not None:
+                    variant.save_dc = value
+            variant._plan = None
+            variant._damage_cache = {}
+            entry = (variant, attack)
+            self._attacks[key] = entry
+        return entry[0]
+
+    def run(self, iterations=100, workers=1, seed=None, target_half_width=None, confidence=0.95,
+            progress=True):
+        """
+        Simulates every cell of the sweep.
+
+        Cells are split into contiguous chunks, one per worker, so that cells
+        sharing attack variants run in the same process. Every cell seeds its
+        own substream from the master seed, so for a given seed the rows do
+        not depend on the number of workers.
+
+        Args:
+            iterations (int): Number of iterations per cell, or the maximum
+                if target_half_width is given.
+            workers (int): Number of worker processes.
+            seed (int): Master seed. If None, the run is not reproducible.
+            target_half_width (float): The precision to stop each cell at,
+                see Encounter.monte_carlo_simulation.
+            confidence (float): The confidence level of the intervals.
+            progress (bool): Whether to show a progress bar.
+
+        Returns:
+            list: One dict per cell, holding the value of every parameter and
+                wins, iterations, win_rate, low and high.
+        """
+        if seed is None:
+            seed = random.getrandbits(64)
+        cells = self.cells()
+        workers = max(1, min(workers, len(cells)))
+        options = (iterations, seed, target_half_width, confidence)
+        if workers == 1:
+            return _run_cells(self, range(len(cells)), *options, progress=progress)
+
+        chunks = []
+        start = 0
+        for size in shard_sizes(len(cells), workers):
+            chunks.append(range(start, start + size))
+            start += size
+        rows = [None]*len(cells)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_run_cells, self, chunk, *options): chunk for chunk in chunks}
+            for future in tqdm(as_completed(futures), total=workers, disable=not progress):
+                for index, row in zip(futures[future], future.result()):
+                    rows[index] = row
+        return rows
+
+
+def _run_cells(sweep, indices, iterations, seed, target_half_width, confidence, progress=False):
+    """
+    Simulates the cells of a sweep with the given indices in the current process.
+    """
+    cells = sweep.cells()
+    rows = []
+    for index in tqdm(indices, disable=not progress):
+        cell = cells[index]
+        result = sweep.variant(cell).monte_carlo_simulation(iterations, seed=shard_seed(seed, index),
+                target_half_width=target_half_width, confidence=confidence, progress=False)
+        low, high = result.confidence_interval()
+        row = dict(cell)
+        row.update({"wins": result.wins, "iterations": result.iterations, "win_rate": result.win_rate,
+                "low": low, "high": high})
+        rows.append(row)
+    return rows
+
+
+def write_csv(rows, path):
+    """
+    Writes the rows of a sweep to a CSV file.
+    """
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
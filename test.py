@@ -1,5 +1,47 @@
+import math
+import os
+import tempfile
 import unittest
-from model import DiceRoll
+from unittest import mock
+import model
+from model import DiceRoll, Attack, Actor, ActorState, Multiattack, TargetIndex, Horde, DiceTilt
+from simulation import Encounter, SimulationResult, ComparisonResult, RareEventResult, shard_sizes, wilson_interval
+from events import RingBufferSink, JsonlSink, read_jsonl, replay
+import profiling
+from sweep import Sweep
+import exact
+from exact import initiative_orders
+from stats import Histogram
+from cache import ResultCache, fingerprint
+import io
+import json
+import statblock
+import random
+import simulation
+import asyncio
+from service import SimulationService
+import checkpoint
+from day import AdventuringDay, _allocate
+from policy import GreedyPolicy, LookaheadPolicy
+from calibrate import Calibrator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def make_duel():
+    archer = Actor("Archer",40,15, distance=60)
+    longbow = Attack("Longbow", [("piercing", DiceRoll([8],3))], archer,
+            attack_roll = 5, attack_range = 150)
+    archer.attacks = [Multiattack("Longbow Multiattack", [longbow, longbow])]
+
+    troll = Actor("Troll",32,15, speed=30)
+    claws = Attack("Claws", [("slashing", DiceRoll([6,6],4))], troll,
+            attack_roll = 7, attack_range = 5)
+    troll.attacks = [Multiattack("Claws", [claws, claws])]
+    return Encounter([archer], [troll])
 
 class TestDiceRoll(unittest.TestCase):
     def setUp(self):
@@ -48,11 +90,1270 @@ class TestDiceRoll(unittest.TestCase):
         self.assertEqual(simplified_dice_roll.probability_below(1),0)
         self.assertEqual(simplified_dice_roll.probability_below(11),1)
 
+    def test_dice_roll_distribution(self):
+        distribution = DiceRoll([6,6],0).distribution()
+        self.assertEqual(list(distribution), list(range(2,13)))
+        self.assertAlmostEqual(sum(distribution.values()),1)
+        self.assertAlmostEqual(distribution[7],6/36)
+        self.assertEqual(DiceRoll([],3).distribution(),{3: 1.0})
+
+    def test_dice_roll_exact_probabilities(self):
+        self.assertEqual(DiceRoll([6,6],0).probability_above(12),1/36)
+        self.assertAlmostEqual(DiceRoll([6,6],0).probability_below(7),21/36)
+        self.assertEqual(DiceRoll([6,4],1).probability_above(7),
+                DiceRoll([4,6],1).probability_above(7))
+
+    def test_dice_roll_percentile(self):
+        self.assertEqual(DiceRoll([6,6],0).percentile(50),7)
+        self.assertEqual(DiceRoll([6,6],0).percentile(0),2)
+        self.assertEqual(DiceRoll([6,6],0).percentile(100),12)
+        self.assertEqual(DiceRoll([20],0).percentile(5),1)
+        self.assertRaises(ValueError, DiceRoll([20],0).percentile, 101)
+
+    def test_dice_roll_variance(self):
+        self.assertAlmostEqual(DiceRoll([6],0).variance(),35/12)
+        self.assertAlmostEqual(DiceRoll([6,4],1).variance(),35/12 + 15/12)
+        monte_carlo = [self.dice_roll.roll() for i in range(10000)]
+        mean = sum(monte_carlo)/len(monte_carlo)
+        sample_variance = sum((x - mean)**2 for x in monte_carlo)/len(monte_carlo)
+        self.assertLess(abs(sample_variance - self.dice_roll.variance()),0.25)
+
+    @unittest.skipUnless(numpy, "requires numpy")
+    def test_roll_many(self):
+        rolls = self.dice_roll.roll_many(20000, numpy.random.default_rng(1))
+        self.assertEqual(len(rolls),20000)
+        self.assertEqual(rolls.min(),self.dice_roll.min())
+        self.assertEqual(rolls.max(),self.dice_roll.max())
+        self.assertLess(abs(rolls.mean() - self.dice_roll.average()),0.1)
+
+    def test_roll_many_without_numpy(self):
+        with mock.patch.object(model, "np", None):
+            rolls = self.dice_roll.roll_many(20000)
+        self.assertIsInstance(rolls,list)
+        self.assertEqual(min(rolls),self.dice_roll.min())
+        self.assertEqual(max(rolls),self.dice_roll.max())
+        self.assertLess(abs(sum(rolls)/len(rolls) - self.dice_roll.average()),0.1)
+
 class TestAttack(unittest.TestCase):
     def setUp(self):
+        self.attacker = Actor("Attacker",10,10)
+        self.target = Actor("Target",1000,10)
+        self.attack = Attack("Sword",
+                [("slashing", DiceRoll([6],2))],
+                self.attacker,
+                attack_roll = 5, attack_range = 5)
 
     def test_attack_max(self):
-        
+        for _ in range(200):
+            hp_before = self.target.hp_current
+            self.attack.attack(self.target)
+            # a critical hit doubles the dice but not the modifier
+            self.assertLessEqual(hp_before - self.target.hp_current, 14)
+
+    def test_to_hit_probabilities(self):
+        critical, hit = self.attack.to_hit_probabilities(16)
+        self.assertAlmostEqual(critical,1/20)
+        self.assertAlmostEqual(hit,9/20)
+        advantage = Attack("Bow", [("piercing", DiceRoll([8],0))], self.attacker,
+                attack_roll = 5, advantage = 1)
+        critical, hit = advantage.to_hit_probabilities(16)
+        self.assertAlmostEqual(critical,39/400)
+        self.assertAlmostEqual(critical + hit,1 - (10/20)**2)
+
+    def test_expected_damage_matches_simulation(self):
+        target = Actor("Troll",30,16,resistances=["necrotic"],vulnerabilities=["slashing"])
+        attack = Attack("Claws",
+                [("slashing", DiceRoll([6,6],4)), ("necrotic", DiceRoll([10],0))],
+                self.attacker,
+                attack_roll = 8, attack_range = 5, advantage = 1)
+        for hp in [30, 5]:
+            target.hp_current = hp
+            expected = attack.expected_damage(target)
+            average = attack.average_damage(target, simulations=20000)
+            self.assertLess(abs(expected - average), 0.5)
+
+    def test_expected_damage_save(self):
+        spell = Attack("Blight", [("necrotic", DiceRoll([8,8],0))], self.attacker,
+                save_dc = 10, save_ability = "constitution", attack_range = 30)
+        # the save succeeds on a roll of 10 or lower, halving the damage
+        self.assertAlmostEqual(spell.expected_damage(self.target),9*0.5*0.5 + 9*0.5)
+
+    def test_expected_damage_out_of_range(self):
+        self.target.distance = 60
+        self.assertEqual(self.attack.expected_damage(self.target),0)
+        self.assertIsNone(self.attacker.choose_target([self.target], self.attack))
+
+    def test_attack_plan(self):
+        attack = Attack("Bite",
+                [("piercing", DiceRoll([6],4)), ("necrotic", DiceRoll([10,10,6],0))],
+                self.attacker,
+                attack_roll = 8, attack_range = 5, advantage = -1)
+        plan = attack.plan()
+        self.assertIs(attack.plan(),plan)
+        self.assertEqual(plan.attack_groups,((20,1),))
+        self.assertEqual(plan.mode,-1)
+        self.assertEqual(plan.range_limit,5)
+        self.assertEqual(plan.damage_groups,(((6,1),), ((6,1),(10,2))))
+        self.assertEqual(plan.critical_groups,(((6,2),), ((6,2),(10,4))))
+        self.assertEqual(plan.damage_modifiers,(4,0))
+        self.assertEqual(plan.lethal_value,36)
+        target = Actor("Troll",10,10, resistances=["necrotic"], vulnerabilities=["piercing"])
+        self.assertEqual(plan.target_profile(target),(2,1))
+        attack.attack_roll = DiceRoll([20],2)
+        self.assertEqual(attack.compile().attack_modifier,2)
+        self.assertIsNot(attack.plan(),plan)
+
+    def test_multiattack_plan_follows_recompiled_attack(self):
+        claws = Attack("Claws", [("slashing", DiceRoll([6,6],4))], self.attacker,
+                attack_roll = 7, attack_range = 5)
+        multiattack = Multiattack("Claws", [claws, claws])
+        plan = multiattack.plan()
+        self.assertIs(multiattack.plan(),plan)
+        claws.attack_roll.modifier = 100
+        claws.compile()
+        self.assertIs(multiattack.plan().plans[0],claws.plan())
+        self.assertEqual(multiattack.plan().plans[1].attack_modifier,100)
+
+    def test_attack_matches_expected_damage(self):
+        target = Actor("Troll",10**9,16, resistances=["necrotic"])
+        attack = Attack("Bite",
+                [("piercing", DiceRoll([6],4)), ("necrotic", DiceRoll([10,10],0))],
+                self.attacker,
+                attack_roll = 8, attack_range = 5, advantage = 1)
+        total = sum(attack.attack(target) for _ in range(20000))
+        self.assertLess(abs(total/20000 - attack.damage_distribution(target).mean()),0.25)
+
+    def test_attack_many(self):
+        target = Actor("Troll",10,16, resistances=["necrotic"])
+        attack = Attack("Bite",
+                [("piercing", DiceRoll([6],4)), ("necrotic", DiceRoll([10,10],0))],
+                self.attacker,
+                attack_roll = 8, attack_range = 5, advantage = 1)
+        spell = Attack("Blight", [("necrotic", DiceRoll([8,8],0))], self.attacker,
+                save_dc = 12, save_ability = "constitution", attack_range = 30)
+        patches = [mock.patch.object(model, "np", None)]
+        if numpy:
+            patches.append(mock.patch.object(model, "np", numpy))
+        for patch in patches:
+            with patch:
+                for each in [attack, spell]:
+                    damage = each.attack_many(target, 20000)
+                    self.assertEqual(len(damage),20000)
+                    mean = each.damage_distribution(target).mean()
+                    self.assertLess(abs(sum(damage)/20000 - mean),0.3)
+        self.assertEqual(target.hp_current,10)
+        target.distance = 60
+        self.assertEqual(sum(attack.attack_many(target, 10)),0)
+
+    def test_choose_target_skips_dead(self):
+        dead = Actor("Dead",10,5)
+        dead.take_damage(10, "slashing")
+        self.assertFalse(dead.alive)
+        self.assertIs(self.attacker.choose_target([dead, self.target], self.attack), self.target)
+        self.assertIs(self.attacker.choose_target([dead, self.target], self.attack, simulations=10),
+                self.target)
+
+
+class TestActor(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+        self.archer = self.encounter.players[0]
+        self.troll = self.encounter.monsters[0]
+
+    def test_copy_shares_definition(self):
+        copy = self.archer.copy()
+        self.assertIs(copy.attacks,self.archer.attacks)
+        copy.take_damage(10, "piercing")
+        copy.move(30)
+        self.assertEqual(self.archer.hp_current,40)
+        self.assertEqual(self.archer.mobility,0)
+        self.assertEqual(copy.hp_current,30)
+
+    def test_reset(self):
+        snapshot = self.troll.snapshot()
+        self.troll.take_damage(100, "fire")
+        self.troll.move(30)
+        self.assertFalse(self.troll.alive)
+        self.troll.reset(snapshot)
+        self.assertTrue(self.troll.alive)
+        self.assertEqual(self.troll.hp_current,32)
+        self.assertEqual(self.troll.mobility,0)
+        self.troll.take_damage(5, "fire")
+        self.troll.reset()
+        self.assertEqual(self.troll.hp_current,self.troll.hp_max)
+
+    def test_bare_attacks_are_wrapped(self):
+        claws = self.troll.attacks[0].attacks[0]
+        actor = Actor("Brute",10,10, attacks=[claws])
+        self.assertIsInstance(actor.attacks[0],Multiattack)
+        self.assertIs(claws.actor,actor)
+
+    def test_limited_uses_tracked_per_state(self):
+        self.archer.attacks = [Multiattack("Volley", self.archer.attacks[0].attacks, uses=1)]
+        self.archer.distance = 0
+        copy = self.archer.copy()
+        snapshot = copy.snapshot()
+        copy.perform_turn([self.troll.copy()])
+        self.assertEqual(copy.state.uses,[0])
+        self.assertEqual(self.archer.state.uses,[1])
+        self.assertEqual(self.archer.attacks[0].uses,1)
+        copy.reset(snapshot)
+        self.assertEqual(copy.state.uses,[1])
+
+    def test_average_damage_restores_target(self):
+        attack = self.troll.attacks[0].attacks[0]
+        self.archer.distance = 0
+        attack.average_damage(self.archer, simulations=50)
+        self.assertEqual(self.archer.hp_current,40)
+        self.assertTrue(self.archer.alive)
+
+    def test_state_copy(self):
+        state = ActorState(10, True, 5, 0, [1])
+        copy = state.copy()
+        copy.uses[0] = 0
+        self.assertEqual(state.uses,[1])
+        state.copy_from(copy)
+        self.assertEqual(state.uses,[0])
+
+
+class TestEncounter(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+
+    def test_monte_carlo_simulation(self):
+        result = self.encounter.monte_carlo_simulation(iterations=20)
+        self.assertEqual(result.iterations,20)
+        self.assertTrue(0 <= result.wins <= 20)
+
+    def test_monte_carlo_seed_reproducible(self):
+        first = self.encounter.monte_carlo_simulation(iterations=30, seed=7)
+        second = self.encounter.monte_carlo_simulation(iterations=30, seed=7)
+        self.assertEqual(first,second)
+
+    def test_monte_carlo_workers_reproducible(self):
+        first = self.encounter.monte_carlo_simulation(iterations=30, workers=2, seed=7)
+        second = self.encounter.monte_carlo_simulation(iterations=30, workers=2, seed=7)
+        self.assertEqual(first,second)
+        self.assertEqual(first.iterations,30)
+
+    def test_shard_sizes(self):
+        self.assertEqual(shard_sizes(10,3),[4,3,3])
+        self.assertEqual(sum(shard_sizes(1001,32)),1001)
+
+    def test_result_merge(self):
+        merged = SimulationResult(3,10).merge(SimulationResult(5,10))
+        self.assertEqual(merged,SimulationResult(8,20))
+        self.assertEqual(merged.win_rate,0.4)
+
+    def test_wilson_interval(self):
+        low, high = wilson_interval(5,10)
+        self.assertAlmostEqual(low,0.2366,places=4)
+        self.assertAlmostEqual(high,0.7634,places=4)
+        low, high = wilson_interval(0,10)
+        self.assertAlmostEqual(low,0)
+        self.assertAlmostEqual(high,0.2775,places=4)
+        self.assertEqual(wilson_interval(0,0),(0,1))
+
+    def test_adaptive_stopping(self):
+        result = self.encounter.monte_carlo_simulation(iterations=5000, seed=1,
+                target_half_width=0.05, batch_size=100)
+        self.assertLess(result.iterations,5000)
+        self.assertEqual(result.iterations % 100,0)
+        self.assertLessEqual(result.half_width(),0.05)
+        low, high = result.confidence_interval()
+        self.assertTrue(low <= result.win_rate <= high)
+
+    def test_adaptive_stops_early_when_lopsided(self):
+        self.encounter.monsters[0].hp_current = 1
+        lopsided = self.encounter.monte_carlo_simulation(iterations=5000, seed=1,
+                target_half_width=0.05, batch_size=50)
+        self.assertLess(lopsided.iterations,200)
+
+    def test_adaptive_budget(self):
+        result = self.encounter.monte_carlo_simulation(iterations=150, seed=1,
+                target_half_width=0.001, batch_size=100)
+        self.assertEqual(result.iterations,150)
+        self.assertGreater(result.half_width(),0.001)
+
+    def test_adaptive_reproducible(self):
+        first = self.encounter.monte_carlo_simulation(iterations=400, workers=2, seed=3,
+                target_half_width=0.06, batch_size=100)
+        second = self.encounter.monte_carlo_simulation(iterations=400, workers=2, seed=3,
+                target_half_width=0.06, batch_size=100)
+        self.assertEqual(first,second)
+
+
+class TestEvents(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+
+    def test_run_emits_events(self):
+        sink = RingBufferSink(capacity=None)
+        encounter = Encounter([actor.copy() for actor in self.encounter.players],
+                [actor.copy() for actor in self.encounter.monsters], sink)
+        players_win = encounter.run()
+        events = sink.events()
+        kinds = [event["event"] for event in events]
+        self.assertEqual(kinds[:2],["initiative","initiative"])
+        self.assertIn("attack_roll", kinds)
+        self.assertIn("death", kinds)
+        self.assertEqual(events[-1],{"event": "end", "round": encounter.rounds, "players_win": players_win})
+        self.assertEqual(kinds.count("round_end"),encounter.rounds)
+        lines = []
+        replay(events, lines.append)
+        self.assertEqual(len(lines),len(events))
+
+    def test_run_silent_by_default(self):
+        encounter = Encounter([actor.copy() for actor in self.encounter.players],
+                [actor.copy() for actor in self.encounter.monsters])
+        encounter.run()
+        self.assertFalse(encounter.sink.enabled)
+
+    def test_ring_buffer_capacity(self):
+        sink = RingBufferSink(capacity=3)
+        for i in range(5):
+            sink.emit({"event": "trial", "trial": i})
+        self.assertEqual([event["trial"] for event in sink.events()],[2,3,4])
+
+    def test_monte_carlo_trace_sampling(self):
+        sink = RingBufferSink(capacity=None)
+        self.encounter.monte_carlo_simulation(iterations=10, seed=1, trace_sink=sink, trace_every=5)
+        trials = [event["trial"] for event in sink.events() if event["event"] == "trial"]
+        self.assertEqual(trials,[0,5])
+
+    def test_monte_carlo_trace_reproducible(self):
+        first = RingBufferSink(capacity=None)
+        second = RingBufferSink(capacity=None)
+        self.encounter.monte_carlo_simulation(iterations=6, workers=2, seed=1, trace_sink=first, trace_every=2)
+        self.encounter.monte_carlo_simulation(iterations=6, workers=2, seed=1, trace_sink=second, trace_every=2)
+        self.assertEqual(first.events(),second.events())
+        trials = [event["trial"] for event in first.events() if event["event"] == "trial"]
+        self.assertEqual(trials,[0,2,4])
+
+    def test_jsonl_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.jsonl")
+            with JsonlSink(path) as sink:
+                self.encounter.monte_carlo_simulation(iterations=2, seed=1, trace_sink=sink, trace_every=1)
+            events = list(read_jsonl(path))
+        self.assertEqual(events[0],{"event": "trial", "trial": 0})
+        self.assertEqual(sum(1 for event in events if event["event"] == "end"),2)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+
+    def test_off_by_default(self):
+        self.assertIsNone(profiling.active)
+        result = self.encounter.monte_carlo_simulation(iterations=5, seed=1, progress=False)
+        self.assertIsNone(result.profile)
+
+    def test_monte_carlo_profile(self):
+        result = self.encounter.monte_carlo_simulation(iterations=20, seed=1, progress=False, profile=True)
+        profile = result.profile
+        self.assertEqual(profile.trials,20)
+        self.assertEqual(profile.actor_resets,40)
+        self.assertEqual(profile.actor_copies,2)
+        self.assertGreaterEqual(profile.rounds,20)
+        self.assertGreater(profile.attacks,0)
+        self.assertGreater(profile.dice_rolled,profile.attacks)
+        self.assertGreater(profile.target_evaluations,0)
+        self.assertGreater(profile.targeting_time,0)
+        self.assertGreater(profile.attack_time,0)
+        self.assertIsNone(profiling.active)
+
+    def test_profile_reproducible_across_workers(self):
+        first = self.encounter.monte_carlo_simulation(iterations=20, workers=2, seed=1, progress=False,
+                profile=True)
+        second = self.encounter.monte_carlo_simulation(iterations=20, workers=2, seed=1, progress=False,
+                profile=True)
+        self.assertEqual(first.profile.trials,20)
+        self.assertEqual(first.profile.actor_copies,4)
+        self.assertEqual(first.profile.dice_rolled,second.profile.dice_rolled)
+
+    def test_profiled_context(self):
+        archer = self.encounter.players[0]
+        troll = self.encounter.monsters[0]
+        longbow = archer.attacks[0].attacks[0]
+        with profiling.profiled() as profile:
+            archer.choose_target([troll], longbow, simulations=10)
+            DiceRoll([6,6],0).roll()
+        self.assertEqual(profile.target_evaluations,1)
+        self.assertEqual(profile.average_damage_simulations,10)
+        self.assertEqual(profile.attacks,10)
+        self.assertIsNone(profiling.active)
+        merged = profile.merge(profile)
+        self.assertEqual(merged.attacks,20)
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+        self.sweep = Sweep(self.encounter, {"Troll.ac": [5, 30], "Archer.attack_bonus": [0, 10]})
+
+    def test_cells(self):
+        self.assertEqual(self.sweep.cells(), [
+                {"Troll.ac": 5, "Archer.attack_bonus": 0},
+                {"Troll.ac": 5, "Archer.attack_bonus": 10},
+                {"Troll.ac": 30, "Archer.attack_bonus": 0},
+                {"Troll.ac": 30, "Archer.attack_bonus": 10}])
+
+    def test_variant(self):
+        variant = self.sweep.variant({"Troll.ac": 30, "Archer.attack_bonus": 10})
+        archer, troll = variant.players[0], variant.monsters[0]
+        self.assertEqual(troll.ac,30)
+        self.assertEqual(archer.attacks[0].attacks[0].attack_roll.modifier,10)
+        self.assertIs(troll.attacks,self.encounter.monsters[0].attacks)
+        # the base encounter is untouched
+        self.assertEqual(self.encounter.monsters[0].ac,15)
+        self.assertEqual(self.encounter.players[0].attacks[0].attacks[0].attack_roll.modifier,5)
+        # attack variants are shared between cells
+        other = self.sweep.variant({"Troll.ac": 5, "Archer.attack_bonus": 10})
+        self.assertIs(other.players[0].attacks[0].attacks[0], archer.attacks[0].attacks[0])
+
+    def test_run(self):
+        rows = self.sweep.run(iterations=50, seed=1, progress=False)
+        self.assertEqual(len(rows),4)
+        self.assertEqual(rows[0]["Troll.ac"],5)
+        self.assertEqual(rows[0]["iterations"],50)
+        self.assertGreater(rows[0]["win_rate"],rows[2]["win_rate"])
+        self.assertLessEqual(rows[0]["low"],rows[0]["win_rate"])
+        parallel = self.sweep.run(iterations=50, workers=2, seed=1, progress=False)
+        self.assertEqual(rows,parallel)
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(ValueError):
+            Sweep(self.encounter, {"Dragon.ac": [10]})
+        with self.assertRaises(ValueError):
+            Sweep(self.encounter, {"Troll.colour": ["green"]})
+
+
+class TestExact(unittest.TestCase):
+    def make_one_shot(self):
+        fighter = Actor("Fighter",10,10)
+        fighter.attacks = [Attack("Smite", [("radiant", DiceRoll([1],9))], fighter, attack_range = 5)]
+        ogre = Actor("Ogre",10,10)
+        ogre.attacks = [Attack("Club", [("bludgeoning", DiceRoll([1],9))], ogre, attack_range = 5)]
+        return Encounter([fighter], [ogre])
+
+    def test_initiative_orders(self):
+        encounter = self.make_one_shot()
+        orders = dict(initiative_orders(encounter.players + encounter.monsters))
+        # ties go to the actor listed first
+        self.assertAlmostEqual(orders[(0, 1)],0.525)
+        self.assertAlmostEqual(orders[(1, 0)],0.475)
+        encounter.monsters[0].initiative = 20
+        orders = dict(initiative_orders(encounter.players + encounter.monsters))
+        self.assertEqual(list(orders),[(1, 0)])
+
+    def test_one_shot(self):
+        solution = self.make_one_shot().solve_exact(epsilon=0)
+        self.assertAlmostEqual(solution.win_probability,0.525)
+        self.assertAlmostEqual(solution.loss_probability,0.475)
+        self.assertEqual(solution.unresolved,0)
+        self.assertEqual(list(solution.rounds),[1])
+        self.assertEqual(solution.mean_rounds(),1)
+
+    def test_matches_simulation(self):
+        encounter = make_duel()
+        solution = encounter.solve_exact()
+        self.assertAlmostEqual(solution.win_probability + solution.loss_probability + solution.unresolved,1)
+        self.assertLess(solution.unresolved,1e-6)
+        self.assertAlmostEqual(sum(solution.rounds.values()),solution.win_probability + solution.loss_probability)
+        result = encounter.monte_carlo_simulation(iterations=2000, seed=1, progress=False)
+        low, high = result.confidence_interval(0.999)
+        self.assertLess(low,solution.win_probability)
+        self.assertLess(solution.win_probability,high)
+        # the encounter itself is left untouched
+        self.assertEqual(encounter.players[0].hp_current,40)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_convolution_matches_branching(self):
+        encounter = make_duel()
+        solution = encounter.solve_exact()
+        with mock.patch.object(exact, "np", None):
+            branched = encounter.solve_exact()
+        self.assertAlmostEqual(solution.win_probability,branched.win_probability)
+        self.assertAlmostEqual(solution.unresolved,branched.unresolved)
+        for rounds, p in branched.rounds.items():
+            self.assertAlmostEqual(solution.rounds[rounds],p)
+
+    def test_simulated_targeting(self):
+        encounter = make_duel()
+        encounter.players[0].targeting_simulations = 10
+        with self.assertRaises(ValueError):
+            encounter.solve_exact()
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+
+    def test_histogram(self):
+        histogram = Histogram(0, 10)
+        for value in [2, 2, 3.5, 12, -1]:
+            histogram.add(value)
+        self.assertEqual(histogram.as_dict(),{0: 1, 2: 2, 3: 1, 10: 1})
+        self.assertAlmostEqual(histogram.mean(),18.5/5)
+        self.assertEqual(histogram.percentile(50),2)
+        self.assertEqual(histogram.percentile(100),10)
+        merged = histogram.merge(histogram)
+        self.assertEqual(merged.total,10)
+        self.assertEqual(merged.as_dict()[2],4)
+        with self.assertRaises(ValueError):
+            histogram.merge(Histogram(0, 5))
+
+    def test_monte_carlo_stats(self):
+        result = self.encounter.monte_carlo_simulation(iterations=100, seed=1, progress=False, stats=True)
+        stats = result.stats
+        self.assertEqual(stats.trials,100)
+        self.assertEqual(stats.wins,result.wins)
+        self.assertEqual(stats.rounds.total,100)
+        self.assertEqual(stats.hp["Archer"].total,100)
+        self.assertEqual(stats.deaths["Troll"],result.wins)
+        self.assertEqual(stats.deaths["Archer"],100 - result.wins)
+        longbow = stats.damage["Archer: Longbow"]
+        self.assertGreater(longbow.total,0)
+        self.assertLessEqual(longbow.mean(),11)
+        # the attacks stop recording once the run is over
+        self.assertIsNone(self.encounter.players[0].damage_histograms)
+        self.assertIsNone(self.encounter.monte_carlo_simulation(iterations=5, progress=False).stats)
+
+    def test_copied_actors(self):
+        # the copies share their attack plans but record their own damage
+        variant = Sweep(self.encounter, {"Troll.count": [3]}).variant({"Troll.count": 3})
+        stats = variant.monte_carlo_simulation(iterations=50, seed=1, progress=False, stats=True).stats
+        totals = [stats.damage["Troll {}: Claws".format(number)].total for number in range(1, 4)]
+        for total in totals:
+            self.assertGreater(total,0)
+        self.assertLess(max(totals),sum(totals))
+
+    def test_stats_merged_across_workers(self):
+        result = self.encounter.monte_carlo_simulation(iterations=40, workers=2, seed=1, progress=False,
+                stats=True)
+        self.assertEqual(result.stats.trials,40)
+        self.assertEqual(result.stats.wins,result.wins)
+
+    def test_iter_monte_carlo(self):
+        results = list(self.encounter.iter_monte_carlo(iterations=250, seed=1, batch_size=100, stats=True))
+        self.assertEqual([result.iterations for result in results],[100, 200, 250])
+        self.assertEqual(results[-1].stats.trials,250)
+        adaptive = self.encounter.monte_carlo_simulation(iterations=250, seed=1, batch_size=100,
+                target_half_width=0, progress=False)
+        self.assertEqual(adaptive,results[-1])
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+        self.cache = ResultCache(":memory:", max_entries=2)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_fingerprint(self):
+        key = fingerprint(self.encounter, seed=1)
+        self.assertEqual(key,fingerprint(make_duel(), seed=1))
+        self.assertNotEqual(key,fingerprint(self.encounter, seed=2))
+        self.encounter.monsters[0].ac = 16
+        self.assertNotEqual(key,fingerprint(self.encounter, seed=1))
+
+    def test_fingerprint_range_function(self):
+        self.encounter.players[0].attacks[0].attacks[0].attack_range = lambda distance: 1
+        with self.assertRaises(ValueError):
+            fingerprint(self.encounter)
+
+    def test_simulate(self):
+        first = self.cache.simulate(self.encounter, iterations=50, seed=1)
+        self.assertEqual(first.iterations,50)
+        with mock.patch.object(Encounter, "monte_carlo_simulation") as simulation:
+            self.assertEqual(self.cache.simulate(self.encounter, iterations=20, seed=1),first)
+            simulation.assert_not_called()
+        with mock.patch.object(Encounter, "monte_carlo_simulation",
+                return_value=SimulationResult(10, 30)) as simulation:
+            topped_up = self.cache.simulate(self.encounter, iterations=80, seed=1)
+            self.assertEqual(simulation.call_args[0][0],30)
+        self.assertEqual(topped_up,SimulationResult(first.wins + 10, 80))
+        self.assertEqual(self.cache.get(fingerprint(self.encounter, 1)),topped_up)
+
+    def test_eviction(self):
+        self.cache.put("a", SimulationResult(1, 2))
+        self.cache.put("b", SimulationResult(1, 2))
+        self.cache.get("a")
+        self.cache.put("c", SimulationResult(1, 2))
+        self.assertEqual(len(self.cache),2)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+
+
+class TestStatBlock(unittest.TestCase):
+    def test_parse_dice(self):
+        self.assertEqual(statblock.parse_dice("2d6+4"),DiceRoll([6,6],4))
+        self.assertEqual(statblock.parse_dice("1d8 + 3d6 - 1"),DiceRoll([8,6,6,6],-1))
+        self.assertEqual(statblock.parse_dice("d20"),DiceRoll([20],0))
+        for text in ["2x6", "1d8 3", "5-1d6"]:
+            with self.assertRaises(ValueError):
+                statblock.parse_dice(text)
+
+    def test_example_matches_main(self):
+        from main import ipqi_vs_rot_troll
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "ipqi_vs_rot_troll.json")
+        encounter = statblock.load(path)["ipqi_vs_rot_troll"]
+        self.assertEqual(fingerprint(encounter),fingerprint(ipqi_vs_rot_troll()))
+
+    def test_run_batch(self):
+        data = {
+            "actors": {
+                "Goblin": {"hp": 7, "ac": 15, "distance": 30,
+                    "attacks": {"Scimitar": {"damage": [["slashing", "1d6+2"]], "attack_bonus": 4, "range": 5}}},
+            },
+            "encounters": [
+                {"name": "Ambush", "iterations": 20,
+                    "players": [{"name": "Fighter", "hp": 40, "ac": 18,
+                        "attacks": {"Greatsword": {"damage": [["slashing", "2d6+4"]], "attack_bonus": 7, "range": 5}}}],
+                    "monsters": [{"actor": "Goblin", "count": 3}]},
+                {"name": "Duel", "players": ["Goblin"], "monsters": ["Goblin"]},
+            ],
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "encounters.json")
+            with open(path, "w") as file:
+                json.dump(data, file)
+            ambush = statblock.StatBlockFile(path).encounter("Ambush")
+            self.assertEqual([monster.name for monster in ambush.monsters],["Goblin 1", "Goblin 2", "Goblin 3"])
+            self.assertEqual(ambush.players[0].attacks[0].name,"Greatsword")
+
+            output = io.StringIO()
+            self.assertEqual(statblock.run_batch([path], output, workers=2, iterations=10, seed=1),2)
+            records = {record["encounter"]: record for record in map(json.loads, output.getvalue().splitlines())}
+            self.assertEqual(records["Ambush"]["iterations"],20)
+            self.assertEqual(records["Duel"]["iterations"],10)
+            again = io.StringIO()
+            statblock.run_batch([path], again, workers=1, iterations=10, seed=1)
+            for record in map(json.loads, again.getvalue().splitlines()):
+                self.assertEqual(record["wins"],records[record["encounter"]]["wins"])
+
+
+class TestTargetIndex(unittest.TestCase):
+    def setUp(self):
+        self.fighter = Actor("Fighter",60,18)
+        self.greatsword = Attack("Greatsword", [("slashing", DiceRoll([6,6],4))], self.fighter,
+                attack_roll = 7, attack_range = 5)
+        self.fighter.attacks = [self.greatsword]
+        self.fighter.move(30)
+        self.horde = []
+        for index in range(12):
+            goblin = Actor("Goblin {}".format(index + 1),7 + index % 5,13 + index % 3,
+                    resistances = ["slashing"] if index % 4 == 0 else [], distance = 30)
+            self.horde.append(goblin)
+
+    def test_same_choice_as_scan(self):
+        rng = random.Random(3)
+        index = TargetIndex(self.horde)
+        for _ in range(200):
+            target = rng.choice(self.horde)
+            target.lose_hp(rng.randint(0, 4))
+            index.touch(target)
+            self.assertIs(self.fighter.choose_target(index, self.greatsword),
+                    self.fighter.choose_target(self.horde, self.greatsword))
+        self.assertIsNone(self.fighter.choose_target(index, self.greatsword))
+
+    def test_vulnerable_targets(self):
+        # doubled damage can exceed the lethal value, so a target with more
+        # hp can take more expected damage
+        sword = Attack("Longsword", [("slashing", DiceRoll([6,6],5))], self.fighter,
+                attack_roll = 5, attack_range = 5)
+        vulnerabilities = ["slashing"]
+        targets = [Actor("Weak",3,12,vulnerabilities = vulnerabilities,distance = 30),
+                Actor("Strong",24,12,vulnerabilities = vulnerabilities,distance = 30)]
+        index = TargetIndex(targets)
+        self.assertIs(self.fighter.choose_target(targets, sword),targets[1])
+        self.assertIs(self.fighter.choose_target(index, sword),targets[1])
+
+    def test_refresh(self):
+        index = TargetIndex(self.horde)
+        for goblin in self.horde[1:]:
+            goblin.lose_hp(100)
+        index.refresh()
+        self.assertIs(self.fighter.choose_target(index, self.greatsword),self.horde[0])
+
+    def test_encounter_unchanged(self):
+        encounter = Encounter([self.fighter], self.horde)
+        indexed = encounter.monte_carlo_simulation(iterations=50, seed=2, progress=False, stats=True)
+        with mock.patch.object(simulation, "TARGET_INDEX_SIZE", 100):
+            scanned = encounter.monte_carlo_simulation(iterations=50, seed=2, progress=False, stats=True)
+        self.assertEqual(indexed,scanned)
+        self.assertEqual(indexed.stats.rounds,scanned.stats.rounds)
+        self.assertEqual(indexed.stats.hp,scanned.stats.hp)
+
+
+class TestHorde(unittest.TestCase):
+    def setUp(self):
+        goblin = Actor("Goblin",7,15)
+        scimitar = Attack("Scimitar", [("slashing", DiceRoll([6],2))], goblin,
+                attack_roll = 4, attack_range = 5)
+        goblin.attacks = [scimitar]
+        self.horde = Horde(goblin, 30)
+        self.fighter = Actor("Fighter",60,18)
+        greatsword = Attack("Greatsword", [("slashing", DiceRoll([6,6],4))], self.fighter,
+                attack_roll = 7, attack_range = 5)
+        self.fighter.attacks = [Multiattack("Extra Attack", [greatsword, greatsword])]
+        self.encounter = Encounter([self.fighter], [self.horde])
+
+    def test_members(self):
+        member = self.horde.members[2]
+        self.assertEqual(member.name,"Goblin 3")
+        self.assertEqual(member.ac,15)
+        member.lose_hp(10)
+        self.assertFalse(member.alive)
+        self.assertEqual(self.horde.living(),29)
+        self.assertEqual(self.horde.hp_current,29*7)
+        self.assertTrue(self.horde.alive)
+
+    def test_snapshot_and_copy(self):
+        snapshot = self.horde.snapshot()
+        copy = self.horde.copy()
+        self.horde.members[0].lose_hp(3)
+        self.horde.move(30)
+        self.assertEqual(copy.hp[0],7)
+        self.horde.reset(snapshot)
+        self.assertEqual(self.horde.hp[0],7)
+        self.assertEqual(self.horde.mobility,0)
+
+    def test_turn_moves_to_next_target(self):
+        first = Actor("First",1,1)
+        second = Actor("Second",1000,1)
+        for use_numpy in ([True, False] if numpy is not None else [False]):
+            first.reset()
+            second.reset()
+            self.horde.reset()
+            sink = RingBufferSink()
+            with mock.patch.object(model, "np", model.np if use_numpy else None):
+                self.horde.perform_turn([first, second], sink)
+            self.assertFalse(first.alive)
+            attacks = [event for event in sink.events() if event["event"] == "horde_attack"]
+            self.assertEqual([event["target"] for event in attacks],["First", "Second"])
+            self.assertEqual(sum(event["attacks"] for event in attacks),30)
+            self.assertEqual(attacks[1]["damage"],1000 - second.hp_current)
+
+    def test_encounter(self):
+        result = self.encounter.monte_carlo_simulation(iterations=20, seed=1, progress=False, stats=True)
+        self.assertEqual(result.stats.trials,20)
+        self.assertEqual(result.stats.deaths["Goblin"],result.wins)
+        self.assertGreater(result.stats.damage["Goblin: Scimitar"].total,0)
+        again = self.encounter.monte_carlo_simulation(iterations=20, seed=1, progress=False)
+        self.assertEqual(result,again)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch_rejected(self):
+        with self.assertRaises(ValueError):
+            self.encounter.run_batch(10, seed=1)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch_rejects_policies(self):
+        with self.assertRaises(ValueError):
+            make_poking_duel(LookaheadPolicy()).run_batch(10, seed=1)
+        make_poking_duel(None).run_batch(10, seed=1)
+
+    def test_exact_rejected(self):
+        with self.assertRaises(ValueError):
+            self.encounter.solve_exact()
+
+    def test_fingerprint_rejected(self):
+        with self.assertRaises(ValueError):
+            fingerprint(self.encounter)
+
+    def test_day_rejected(self):
+        with self.assertRaises(ValueError):
+            AdventuringDay([self.fighter], [[self.horde]])
+        with self.assertRaises(ValueError):
+            AdventuringDay([self.horde], [[self.fighter]])
+
+
+class TestCompare(unittest.TestCase):
+    def test_same_encounter(self):
+        encounter = make_duel()
+        result = encounter.compare(encounter, iterations=200, seed=1, progress=False)
+        self.assertEqual(result.iterations,200)
+        self.assertEqual(result.wins,result.other_wins)
+        self.assertEqual(result.difference,0)
+        self.assertEqual(result.confidence_interval(),(0, 0))
+
+    def test_paired_difference(self):
+        encounter = make_duel()
+        variant = make_duel()
+        variant.players[0].ac = 20
+        result = variant.compare(encounter, iterations=1000, seed=1, progress=False)
+        low, high = result.confidence_interval()
+        self.assertGreater(low,0)
+        self.assertLess(low,result.difference)
+        self.assertGreater(high,result.difference)
+        self.assertEqual(result.wins - result.other_wins,result.only_wins - result.only_other_wins)
+        independent = math.sqrt(result.win_rate*(1 - result.win_rate)/1000
+                + result.other_win_rate*(1 - result.other_win_rate)/1000)*1.96
+        self.assertLess(result.half_width(),independent)
+
+    def test_workers(self):
+        encounter = make_duel()
+        variant = make_duel()
+        variant.monsters[0].ac = 17
+        single = encounter.compare(variant, iterations=40, workers=1, seed=3, progress=False)
+        sharded = encounter.compare(variant, iterations=40, workers=2, seed=3, progress=False)
+        self.assertEqual(single,sharded)
+
+    def test_merge(self):
+        first = ComparisonResult(10, 6, 4, 3, 1)
+        second = ComparisonResult(10, 5, 5, 0, 0)
+        self.assertEqual(first.merge(second),ComparisonResult(20, 11, 9, 3, 1))
+
+
+class TestRareEvent(unittest.TestCase):
+    def test_tilt_likelihood_ratio(self):
+        tilt = DiceTilt(1.5)
+        for sides in (4, 6, 20):
+            for theta in (1.5, -1.5):
+                cumulative, log_ratio, die_tilt = tilt._table(sides, theta)
+                probabilities = [b - a for a, b in zip([0] + cumulative, cumulative + [1])]
+                self.assertAlmostEqual(sum(probabilities),1)
+                self.assertEqual(probabilities[-1] > probabilities[0],theta > 0)
+                for face, probability in enumerate(probabilities, 1):
+                    self.assertAlmostEqual(math.exp(log_ratio - die_tilt*face),1/sides/probability)
+
+    def test_targeting_simulations_roll_fair_dice(self):
+        encounter = make_duel()
+        archer, troll = encounter.players[0], encounter.monsters[0]
+        tilt = DiceTilt(1, [archer])
+        with mock.patch.object(model, "dice_tilt", tilt):
+            archer.attacks[0].attacks[0].average_damage(troll, simulations=10)
+            self.assertIs(model.dice_tilt,tilt)
+        self.assertEqual(tilt.log_weight,0)
+
+    def test_untilted(self):
+        result = make_duel().rare_event_simulation(0, iterations=200, seed=1, progress=False)
+        self.assertEqual(result.weight_sum,result.hits)
+        self.assertEqual(result.probability,result.hits/200)
+        self.assertIsNone(model.dice_tilt)
+
+    def test_unbiased(self):
+        encounter = make_duel()
+        encounter.players[0].hp_max = encounter.players[0].hp_current = 100
+        encounter.players[0].ac = 20
+        exact = encounter.solve_exact().loss_probability
+        result = encounter.rare_event_simulation(1, iterations=4000, seed=1, progress=False)
+        low, high = result.confidence_interval(0.999)
+        self.assertLess(low,exact)
+        self.assertGreater(high,exact)
+        self.assertGreater(result.hits,10*exact*4000)
+        self.assertLess(result.standard_error(),math.sqrt(exact*(1 - exact)/4000))
+
+    def test_event_and_workers(self):
+        encounter = make_duel()
+        single = encounter.rare_event_simulation(0.5, iterations=40, seed=2, side="players", event=players_win,
+                progress=False)
+        sharded = encounter.rare_event_simulation(0.5, iterations=40, workers=2, seed=2, side="players",
+                event=players_win, progress=False)
+        self.assertEqual(single.hits,sharded.hits)
+        self.assertAlmostEqual(single.probability,sharded.probability)
+        merged = RareEventResult(10, 2, 0.5, 0.25).merge(RareEventResult(10, 1, 0.5, 0.25))
+        self.assertEqual(merged.probability,0.05)
+
+    def test_horde(self):
+        encounter = Encounter([Actor("Fighter",30,15)], [Horde(make_duel().monsters[0], 3)])
+        with self.assertRaises(ValueError):
+            encounter.rare_event_simulation(1, iterations=10, progress=False)
+
+
+def players_win(encounter, players_win):
+    return players_win
+
+
+SKIRMISH = {
+    "players": [{"name": "Fighter", "hp": 40, "ac": 18,
+        "attacks": {"Greatsword": {"damage": [["slashing", "2d6+4"]], "attack_bonus": 7, "range": 5}}}],
+    "monsters": [{"actor": "Goblin", "count": 3}],
+}
+GOBLINS = {"Goblin": {"hp": 7, "ac": 15, "distance": 30,
+    "attacks": {"Scimitar": {"damage": [["slashing", "1d6+2"]], "attack_bonus": 4, "range": 5}}}}
+
+
+class TestService(unittest.TestCase):
+    def run_service(self, coroutine, workers=2, chunk_size=100):
+        async def main():
+            async with SimulationService(workers, chunk_size) as service:
+                return await coroutine(service)
+        return asyncio.run(main())
+
+    def test_simulate(self):
+        async def simulate(service):
+            events = []
+            result = await service.simulate(SKIRMISH, GOBLINS, iterations=450, seed=1, progress=events.append)
+            return result, events
+        result, events = self.run_service(simulate)
+        self.assertEqual(result.iterations,450)
+        self.assertEqual([event["iterations"] for event in events][-1],450)
+        self.assertEqual(len(events),5)
+        single, _ = self.run_service(simulate, workers=1)
+        self.assertEqual(result,single)
+
+    def test_identical_requests_share_a_job(self):
+        async def simulate(service):
+            first = []
+            second = []
+            job = service.submit(SKIRMISH, first.append, GOBLINS, iterations=200, seed=1)
+            self.assertIs(service.submit(SKIRMISH, second.append, GOBLINS, iterations=200, seed=1),job)
+            self.assertIsNot(service.submit(SKIRMISH, [].append, GOBLINS, iterations=200, seed=2),job)
+            result = await service.simulate(SKIRMISH, GOBLINS, iterations=200, seed=1)
+            return result, first, second
+        result, first, second = self.run_service(simulate)
+        self.assertEqual(first,second)
+        self.assertEqual(first[-1]["event"],"result")
+        self.assertEqual(first[-1]["wins"],result.wins)
+
+    def test_priority_and_cancel(self):
+        async def simulate(service):
+            finished = []
+            batch = []
+            job = service.submit(SKIRMISH, batch.append, GOBLINS, iterations=2000, priority="batch")
+            interactive = await service.simulate(SKIRMISH, GOBLINS, iterations=200, seed=1, priority="interactive")
+            service.cancel(job, batch.append)
+            return interactive, batch, job
+        interactive, batch, job = self.run_service(simulate, workers=1)
+        self.assertEqual(interactive.iterations,200)
+        self.assertEqual(batch[-1],{"event": "cancelled"})
+        self.assertLess(job.next_chunk,len(job.chunks))
+
+    def test_server(self):
+        async def query(service):
+            server = await service.serve(port=0)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write((json.dumps({"id": "bad", "encounter": {"players": ["Orc"], "monsters": []}}) + "\n"
+                        + json.dumps({"id": 1, "encounter": SKIRMISH, "actors": GOBLINS, "iterations": 300,
+                        "seed": 1}) + "\n").encode())
+                events = []
+                while not events or events[-1]["event"] != "result":
+                    events.append(json.loads(await reader.readline()))
+                writer.close()
+                return events
+        events = self.run_service(query)
+        self.assertEqual(events[0]["id"],"bad")
+        self.assertEqual(events[0]["event"],"error")
+        self.assertEqual([event["event"] for event in events[1:]],["queued", "progress", "progress", "progress", "result"])
+        self.assertEqual(events[-1]["id"],1)
+
+    def test_server_rejects_invalid_requests(self):
+        async def query(service):
+            server = await service.serve(port=0)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                request = {"id": 1, "encounter": SKIRMISH, "actors": GOBLINS, "iterations": 100000, "seed": 1}
+                writer.write(("[1]\n" + json.dumps(request) + "\n" + json.dumps(dict(request, seed=2)) + "\n"
+                        + json.dumps({"id": 1, "cancel": True}) + "\n").encode())
+                events = []
+                while not events or events[-1]["event"] != "cancelled":
+                    events.append(json.loads(await reader.readline()))
+                writer.close()
+                return events
+        events = self.run_service(query, workers=1)
+        # the connection outlives a request that is not an object
+        self.assertEqual(events[0]["event"],"error")
+        self.assertIsNone(events[0]["id"])
+        self.assertEqual(events[1],dict(events[1], id=1, event="queued"))
+        errors = [event for event in events[2:] if event["event"] == "error"]
+        self.assertEqual(len(errors),1)
+        self.assertIn("already in use",errors[0]["message"])
+        self.assertEqual(events[-1],{"id": 1, "event": "cancelled"})
+
+    def test_server_rejects_invalid_ids_and_iterations(self):
+        async def query(service):
+            server = await service.serve(port=0)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                request = {"id": [1], "encounter": SKIRMISH, "actors": GOBLINS, "iterations": 100}
+                writer.write((json.dumps(request) + "\n" + json.dumps(dict(request, id=2, iterations=-5)) + "\n"
+                        + json.dumps(dict(request, id=3, seed=1)) + "\n").encode())
+                events = []
+                while not events or events[-1]["event"] != "result":
+                    events.append(json.loads(await reader.readline()))
+                writer.close()
+                return events
+        events = self.run_service(query, workers=1)
+        self.assertEqual((events[0]["id"], events[0]["event"]),(None, "error"))
+        self.assertEqual((events[1]["id"], events[1]["event"]),(2, "error"))
+        self.assertEqual((events[-1]["id"], events[-1]["iterations"]),(3, 100))
+        with self.assertRaises(ValueError):
+            SimulationService(1).submit(SKIRMISH, [].append, GOBLINS, iterations=2.5)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        encounter = make_duel()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.json")
+            options = dict(workers=1, seed=1, batch_size=100, progress=False, stats=True)
+            full = encounter.monte_carlo_simulation(600, checkpoint=os.path.join(directory, "full.json"), **options)
+            self.assertEqual(full.iterations,600)
+
+            calls = []
+            simulate = Encounter._simulate
+            def interrupted(self, *args, **kwargs):
+                calls.append(None)
+                if len(calls) == 3:
+                    raise KeyboardInterrupt
+                return simulate(self, *args, **kwargs)
+            with mock.patch.object(Encounter, "_simulate", interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    encounter.monte_carlo_simulation(600, checkpoint=path, checkpoint_every=0, **options)
+            state = checkpoint.Checkpoint.load(path)
+            self.assertEqual(state.batches,2)
+            self.assertEqual(state.result.iterations,200)
+
+            resumed = encounter.monte_carlo_simulation(600, checkpoint=path, **options)
+            self.assertEqual(resumed,full)
+            self.assertEqual(resumed.stats.rounds,full.stats.rounds)
+            self.assertEqual(resumed.stats.damage,full.stats.damage)
+            with self.assertRaises(ValueError):
+                encounter.monte_carlo_simulation(700, checkpoint=path, seed=2, progress=False)
+            with self.assertRaises(ValueError):
+                Encounter(encounter.monsters, encounter.players).monte_carlo_simulation(700, checkpoint=path,
+                        progress=False)
+
+    def test_resume_keeps_the_stats_setting(self):
+        encounter = make_duel()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.json")
+            encounter.monte_carlo_simulation(100, workers=1, seed=1, progress=False, stats=True, checkpoint=path)
+            with self.assertRaises(ValueError):
+                encounter.monte_carlo_simulation(800, workers=1, seed=1, progress=False, checkpoint=path)
+            result = encounter.monte_carlo_simulation(1000, workers=1, seed=1, progress=False, stats=True,
+                    checkpoint=path)
+            self.assertEqual(result.stats.trials,1000)
+        with self.assertRaises(ValueError):
+            result.merge(SimulationResult(3, 5))
+        self.assertEqual(SimulationResult().merge(result).stats.trials,1000)
+
+    def test_resume_keeps_batch_size(self):
+        encounter = make_duel()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.json")
+            full = encounter.monte_carlo_simulation(400, workers=1, seed=1, batch_size=100, progress=False,
+                    checkpoint=os.path.join(directory, "full.json"))
+            encounter.monte_carlo_simulation(200, workers=1, seed=1, batch_size=100, progress=False,
+                    checkpoint=path)
+            resumed = encounter.monte_carlo_simulation(400, workers=1, seed=1, batch_size=300, progress=False,
+                    checkpoint=path)
+            self.assertEqual(resumed,full)
+            self.assertEqual(checkpoint.Checkpoint.load(path).batches,4)
+
+    def test_merge(self):
+        encounter = make_duel()
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, "{}.json".format(seed)) for seed in range(3)]
+            for seed, path in enumerate(paths):
+                encounter.monte_carlo_simulation(100, seed=seed, checkpoint=path, progress=False)
+            merged = checkpoint.merge(paths)
+            self.assertEqual(merged.iterations,300)
+            self.assertEqual(merged.wins,sum(checkpoint.Checkpoint.load(path).result.wins for path in paths))
+            with self.assertRaises(ValueError):
+                checkpoint.merge([paths[0], paths[0]])
+
+
+class TestAdventuringDay(unittest.TestCase):
+    def test_allocate(self):
+        states = {"a": 0.5, "b": 0.3, "c": 0.0001, "d": 0.1999}
+        allocation = _allocate(states, 100, random.Random(1))
+        self.assertEqual(sum(count for count, weight in allocation.values()),100)
+        self.assertEqual(allocation["a"],(50, 0.01))
+        self.assertIn(allocation["d"][0],(19, 20))
+
+    def test_single_fight(self):
+        encounter = make_duel()
+        exact = encounter.solve_exact().win_probability
+        result = AdventuringDay(encounter.players, [encounter]).run(trials=2000, seed=1, progress=False)
+        self.assertAlmostEqual(result.survival[0],exact,delta=0.04)
+        self.assertAlmostEqual(sum(result.states.values()),result.survival[0])
+        self.assertEqual(result.trials,2000)
+
+    def test_state_carries_over(self):
+        encounter = make_duel()
+        archer = encounter.players[0]
+        archer.hp_max = archer.hp_current = 80
+        archer.attacks[0].uses = 2
+        archer.attacks.append(Multiattack("Dagger", [Attack("Dagger", [("piercing", DiceRoll([4],3))], archer,
+                attack_roll=5, attack_range=5)]))
+        archer.reset()
+        goblin = Actor("Goblin",7,15,distance=30)
+        goblin.attacks = [Multiattack("Scimitar", [Attack("Scimitar", [("slashing", DiceRoll([6],2))], goblin,
+                attack_roll=4, attack_range=5)])]
+        day = AdventuringDay([archer], [[goblin], [goblin.copy()], encounter])
+        result = day.run(trials=500, seed=1, progress=False)
+        self.assertEqual(result.trials,1500)
+        self.assertGreaterEqual(result.survival[0],result.survival[1])
+        self.assertGreater(result.survival[1],result.survival[2])
+        self.assertEqual(result.wipe_probabilities()[0],1 - result.survival[0])
+        for (hp, uses), in result.states:
+            self.assertLessEqual(hp,80)
+            self.assertEqual(uses[0],0)
+        self.assertAlmostEqual(result.death_probabilities()["Archer"],1 - result.survival[2])
+
+        binned = AdventuringDay([archer], [[goblin], [goblin.copy()]], hp_bin=10).run(trials=500, seed=1,
+                progress=False)
+        self.assertTrue(all(hp % 10 == 0 or hp == 80 for (hp, uses), in binned.states))
+        self.assertEqual(archer.hp_current,80)
+
+
+def make_poking_duel(policy):
+    encounter = make_duel()
+    troll = encounter.monsters[0]
+    troll.policy = policy
+    troll.attacks = [Multiattack("Poke", [Attack("Poke", [("piercing", DiceRoll([4],0))], troll, attack_roll=7,
+            attack_range=5)])] + troll.attacks
+    troll.reset()
+    return encounter
+
+
+class TestPolicy(unittest.TestCase):
+    def test_greedy_is_the_default(self):
+        encounter = make_duel()
+        greedy = make_duel()
+        for actor in greedy.players + greedy.monsters:
+            actor.policy = GreedyPolicy()
+        self.assertEqual(greedy.monte_carlo_simulation(50, seed=1, progress=False, stats=True).stats.damage,
+                encounter.monte_carlo_simulation(50, seed=1, progress=False, stats=True).stats.damage)
+
+    def test_lookahead_chooses_the_better_multiattack(self):
+        default = make_poking_duel(None).monte_carlo_simulation(100, seed=1, progress=False)
+        lookahead = make_poking_duel(LookaheadPolicy(evaluations=16)).monte_carlo_simulation(100, seed=1,
+                progress=False)
+        self.assertEqual(default.wins,100)
+        self.assertLess(lookahead.wins,90)
+        self.assertEqual(lookahead,make_poking_duel(LookaheadPolicy(evaluations=16)).monte_carlo_simulation(100,
+                seed=1, progress=False))
+
+    def test_budget(self):
+        rollouts = []
+        rollout = LookaheadPolicy._rollout
+        def counted(self, *args):
+            rollouts.append(None)
+            return rollout(self, *args)
+        encounter = make_poking_duel(LookaheadPolicy(evaluations=10))
+        archer, troll = encounter.players[0], encounter.monsters[0]
+        troll.move(60)
+        with mock.patch.object(LookaheadPolicy, "_rollout", counted):
+            troll.policy.decide(troll, [archer])
+            self.assertEqual(len(rollouts),10)
+            troll.policy = LookaheadPolicy(evaluations=10, time_budget=0)
+            self.assertEqual(troll.policy.decide(troll, [archer]),(0, None))
+            self.assertEqual(len(rollouts),11)
+
+    def test_decide_restores_state(self):
+        encounter = make_poking_duel(LookaheadPolicy(evaluations=20))
+        archer, troll = encounter.players[0], encounter.monsters[0]
+        troll.move(60)
+        random.seed(1)
+        random.getrandbits(64)
+        expected = random.random()
+        random.seed(1)
+        sink = RingBufferSink()
+        tilt = DiceTilt(1)
+        with mock.patch.object(model, "dice_tilt", tilt):
+            self.assertEqual(troll.policy.decide(troll, [archer]),(1, None))
+            self.assertIs(model.dice_tilt,tilt)
+        self.assertEqual(random.random(),expected)
+        self.assertEqual(tilt.log_weight,0)
+        self.assertTrue(model.recording)
+        self.assertEqual((archer.hp_current, troll.hp_current, troll.mobility),(40, 32, 60))
+        with mock.patch.object(model, "recording", False):
+            troll.policy.decide(troll, [archer])
+            self.assertFalse(model.recording)
+
+    def test_exact_and_fingerprint(self):
+        encounter = make_poking_duel(LookaheadPolicy())
+        with self.assertRaises(ValueError):
+            encounter.solve_exact()
+        self.assertNotEqual(fingerprint(encounter),fingerprint(make_poking_duel(None)))
+
+
+class TestCalibrator(unittest.TestCase):
+    def test_count_parameter(self):
+        variant = Sweep(make_duel(), {"Troll.count": [3]}).variant({"Troll.count": 3})
+        self.assertEqual([monster.name for monster in variant.monsters],["Troll 1", "Troll 2", "Troll 3"])
+        variant.monsters[0].lose_hp(5)
+        self.assertEqual(variant.monsters[1].hp_current,32)
+
+    def test_solve(self):
+        calibrator = Calibrator(make_duel(), "Troll.hp_max", range(10, 100))
+        calibration = calibrator.solve(0.6, seed=1)
+        self.assertLessEqual(calibration.low,calibration.value)
+        self.assertLessEqual(calibration.value,calibration.high)
+        self.assertLessEqual(calibration.high - calibration.low,1)
+        self.assertGreater(calibration.results[calibration.low].win_rate,0.6)
+        self.assertLess(calibration.results[calibration.high].win_rate,0.6)
+        # far values are decided on a single batch
+        self.assertEqual(calibration.results[10].iterations,200)
+        self.assertGreater(calibration.results[calibration.value].iterations,200)
+
+        iterations = calibration.iterations
+        self.assertEqual(calibrator.solve(0.6, seed=1).iterations,iterations)
+        self.assertEqual(calibrator.solve(0.9, seed=1).results[10].iterations,200)
+
+    def test_target_not_crossed(self):
+        calibrator = Calibrator(make_duel(), "Troll.count", range(2, 5))
+        with self.assertRaises(ValueError):
+            calibrator.solve(0.9, seed=1)
+
+
+class TestBench(unittest.TestCase):
+    def test_scenarios_run(self):
+        import bench
+        for name, scenario in bench.SCENARIOS.items():
+            result = scenario().monte_carlo_simulation(iterations=5, seed=1, progress=False)
+            self.assertEqual(result.iterations,5)
+
+    def test_run_and_compare(self):
+        import bench
+        results = bench.run_benchmarks(["dice_roll", "attack"], scale=0.01, repeat=1)
+        self.assertEqual(set(results["benchmarks"]),{"dice_roll", "attack"})
+        baseline = {"benchmarks": {
+            "dice_roll": dict(results["benchmarks"]["dice_roll"]),
+            "attack": dict(results["benchmarks"]["attack"])}}
+        baseline["benchmarks"]["attack"]["per_call_us"] /= 10
+        rows = {row[0]: row for row in bench.compare(results, baseline, tolerance=0.25)}
+        self.assertFalse(rows["dice_roll"][4])
+        self.assertTrue(rows["attack"][4])
+
+
+@unittest.skipUnless(numpy, "requires numpy")
+class TestBatchEncounter(unittest.TestCase):
+    def setUp(self):
+        self.encounter = make_duel()
+
+    def test_batch_seed_reproducible(self):
+        first = self.encounter.run_batch(2000, seed=3)
+        second = self.encounter.run_batch(2000, seed=3, batch_size=500)
+        self.assertEqual(first.iterations,2000)
+        self.assertEqual(first,self.encounter.run_batch(2000, seed=3))
+        self.assertTrue(0 < second.wins < 2000)
+
+    def test_batch_matches_encounter(self):
+        batch = self.encounter.run_batch(20000, seed=1)
+        sequential = self.encounter.monte_carlo_simulation(iterations=2000, seed=1)
+        self.assertLess(abs(batch.win_rate - sequential.win_rate),0.05)
+
+    def test_batch_save_attack(self):
+        wizard = Actor("Wizard",30,12, distance=60, resistances=["slashing"])
+        blast = Attack("Blast", [("fire", DiceRoll([6,6,6],0))], wizard,
+                save_dc = 14, save_ability = "dexterity", attack_range = 120)
+        wizard.attacks = [Multiattack("Blast", [blast])]
+        encounter = Encounter([wizard], self.encounter.monsters)
+        batch = encounter.run_batch(20000, seed=1)
+        sequential = encounter.monte_carlo_simulation(iterations=2000, seed=1)
+        self.assertLess(abs(batch.win_rate - sequential.win_rate),0.05)
+
 
 if __name__ == '__main__':
     unittest.main()